@@ -3,7 +3,7 @@
 import datetime
 import json
 import os
-from uuid import uuid4
+from itertools import islice
 
 from flask import Flask, abort, jsonify, request, make_response
 
@@ -13,17 +13,25 @@ from sqlalchemy.sql import (
 from pyfiles.common_helpers import stop_clusters
 
 from pyfiles.constants import (
+    DATA_UPLOAD_MAX_POINTS,
     DEST_RADIUS_MAX,
     DESTINATIONS_LIMIT,
+    DEVICE_DATA_SPOOL_MAX_BYTES,
+    DEVICE_DATA_SPOOL_RETRY_AFTER,
     INCLUDE_DESTINATIONS_BETWEEN)
 
-from pyfiles.database_interface import (init_db, users_table_insert, users_table_update, devices_table_insert, device_data_table_insert,
-                                        verify_user_id, update_last_activity, update_messaging_token, get_device_table_id,
-                                        get_device_table_id_for_session, get_users_table_id, get_session_token_for_device, get_user_id_from_device_id,
-                                        activity_types,
+from pyfiles.database_interface import (init_db, authenticate_device, register_device, device_data_table_insert,
+                                        device_data_table_copy, ewkb_point,
+                                        update_messaging_token,
+                                        get_device_table_id_for_session,
+                                        get_session_ids, session_cache,
     client_log_table_insert, get_svg)
 
 from pyfiles.server_common import common_setlegmode, common_path
+from pyfiles.device_data_spool import DeviceDataSpool, SpoolFull
+from pyfiles.upload_helper import (
+    BINARY_POINTS_MIMETYPE, iter_binary_records, iter_data_points,
+    json_point_record, upload_stream, UploadError)
 
 
 from pyfiles.authentication_helper import user_hash, authenticate_with_google_oauth
@@ -62,6 +70,15 @@ else:
 
 db, store = init_db(app)
 
+# Optional write-behind spool for /data uploads
+device_data_spool = None
+if app.config.get('DEVICE_DATA_SPOOL_DIR'):
+    device_data_spool = DeviceDataSpool(
+        app.config['DEVICE_DATA_SPOOL_DIR'],
+        app.config.get(
+            'DEVICE_DATA_SPOOL_MAX_BYTES', DEVICE_DATA_SPOOL_MAX_BYTES))
+    device_data_spool.start()
+
 # REST interface:
 
 @app.route('/register', methods=['POST'])
@@ -90,45 +107,15 @@ def register_post():
     # The following hash value is also generated in client and used in authentication
     user_id = user_hash(account_google_id)
 
-    users_table_id = None
-
-    # 2. Check if user has registered previously
-    ext_users_table_id = get_users_table_id(user_id)
-    if ext_users_table_id >= 0:
-        users_table_id = ext_users_table_id
-
-    # 3. Check if same device has registered with same user
-    devices_table_id = get_device_table_id(
-        users_table_id, device_id, installation_id)
-
-    # 4. create/update user to db
-    if users_table_id is None:
-        users_table_id = users_table_insert(str(user_id), str(validation_data['refresh_token']), str(validation_data['access_token']))
-    else:
-        print 're-registration for same user detected -> using existing user account'
-        users_table_update(str(users_table_id), str(validation_data['refresh_token']), str(validation_data['access_token']))
-
-    # 5. Create/update device to db
-    if devices_table_id is None:
-        session_token = uuid4().hex
-        devices_table_id = devices_table_insert(
-            users_table_id,
-            device_id,
-            installation_id,
-            device_model,
-            session_token,
-            client_version)
-    else:
-        print 'device re-registration detected -> using same device'
-        update_last_activity(devices_table_id, client_version)
-        session_token = get_session_token_for_device(devices_table_id)
-
-    # 6. Log the registration
-    client_log_table_insert(
-        devices_table_id,
-        users_table_id,
-        "MOBILE-REGISTER",
-        "ClientVersion:" + (client_version or ""))
+    # 2. Create/update user and device, and log the registration
+    devices_table_id, users_table_id, session_token = register_device(
+        str(user_id),
+        str(validation_data['refresh_token']),
+        str(validation_data['access_token']),
+        device_id,
+        installation_id,
+        device_model,
+        client_version)
 
     resp = jsonify({'sessionToken': session_token})
     return resp
@@ -144,27 +131,18 @@ def authenticate_post():
     client_version = json.get('clientVersion')
     messaging_token = json.get('messagingToken', '')
 
-    # 1. check that user exists or abort
-    users_table_id = verify_user_id(user_id)
+    if not user_id:
+        print 'empty user_id'
+        abort(403)
 
-    devices_table_id = get_device_table_id(
-        users_table_id, device_id, installation_id)
-    session_token = get_session_token_for_device(devices_table_id)
-    if session_token is None:
+    # Update activity and messaging token if included, and log, or abort if
+    # the user or device is not registered
+    row = authenticate_device(
+        user_id, device_id, installation_id, client_version, messaging_token)
+    if row is None:
         print 'User is not registered. userId=' + user_id
         abort(403)
-
-    # 2. Update messaging token, if included
-    if len(messaging_token) > 1:
-        update_messaging_token(devices_table_id, messaging_token)
-    update_last_activity(devices_table_id, client_version)
-
-    # 3. Update log
-    client_log_table_insert(
-        devices_table_id,
-        get_user_id_from_device_id(devices_table_id),
-        "MOBILE-AUTHENTICATE",
-        "ClientVersion:" + (client_version or ""))
+    session_token = row[2]
 
     return jsonify({
         'sessionToken': session_token
@@ -173,17 +151,15 @@ def authenticate_post():
 
 @app.route('/msgtokenrefresh/<session_token>')
 def fbrefresh(session_token):
-    device_id = get_device_table_id_for_session(session_token)
-    if device_id < 0:
+    ids = get_session_ids(session_token)
+    if ids is None:
         return ""
+    device_id, user_id = ids
     # get the token
     messaging_token = request.args.get("messaging_token")
     if len(messaging_token) > 1:
         update_messaging_token(device_id, messaging_token)
 
-    user_id = get_user_id_from_device_id(device_id)
-    if user_id < 0:
-        return ""
     client_log_table_insert(device_id, user_id, "MOBILE-FCM-TOKEN", "")
     return make_response(json.dumps('Ack'), 200)
 
@@ -198,70 +174,95 @@ def data_post():
     if device_id < 0:
         abort(403)  # not registered user
 
-    data_points = request.json['dataPoints']
+    # Point records are decoded one at a time as they are consumed below
+    try:
+        stream = upload_stream(request)
+        if request.mimetype == BINARY_POINTS_MIMETYPE:
+            records = iter_binary_records(stream, app.config.get(
+                'DATA_UPLOAD_MAX_POINTS', DATA_UPLOAD_MAX_POINTS))
+        else:
+            records = (json_point_record(x) for x in iter_data_points(stream))
+    except UploadError:
+        abort(400)
 
     # Remember, if a single point fails, the whole batch fails
     batch_size = 1024
 
     def batch_chunks(x):
-        for i in xrange(0, len(x), batch_size):
-            yield x[i:i + batch_size]
+        x = iter(x)
+        while True:
+            chunk = list(islice(x, batch_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def prepare_point(record):
+        return {
+            'device_id': device_id,
+            'coordinate': 'POINT(%f %f)' % record[:2],
+            'accuracy': record[2],
+            'time': datetime.datetime.fromtimestamp(record[3] / 1000.0),
+            'activity_1': record[4],
+            'activity_1_conf': record[5],
+            'activity_2': record[6],
+            'activity_2_conf': record[7],
+            'activity_3': record[8],
+            'activity_3_conf': record[9]}
+
+    def copy_row(record):
+        return (
+            device_id,
+            ewkb_point(*record[:2]),
+            record[2],
+            datetime.datetime.fromtimestamp(record[3] / 1000.0)) + record[4:]
 
-    def prepare_point(point):
-        location = point['location']
+    def spool_row(record):
+        return (device_id,) + record
+
+    try:
+        if device_data_spool is not None:
+            # Validate everything before acknowledging, the writer can't
+            # reject
+            try:
+                device_data_spool.append(spool_row(x) for x in records)
+            except SpoolFull:
+                response = make_response(jsonify({'error': 'Spool full'}), 503)
+                response.headers['Retry-After'] = str(
+                    DEVICE_DATA_SPOOL_RETRY_AFTER)
+                return response
+
+        elif app.config.get('DEVICE_DATA_COPY'):
+            # One COPY round trip for the whole upload
+            device_data_table_copy(copy_row(x) for x in records)
+
+        else:
+            for chunk in batch_chunks(records):
+                batch = [prepare_point(x) for x in chunk]
+                device_data_table_insert(batch)
+
+    except UploadError:
+        abort(400)
 
-        result = {
-            'device_id': device_id,
-            'coordinate': 'POINT(%f %f)' % (float(location['longitude']), float(location['latitude'])),
-            'accuracy': float(location['accuracy']),
-            'time': datetime.datetime.fromtimestamp(long(point['time']) / 1000.0)
-        }
-        result.update(prepare_point_activities(point))
-        return result
-
-    def prepare_point_activities(point):
-        if 'activityData' not in point or 'activities' not in point['activityData']:
-            return
-        activities = point['activityData']['activities']
-
-        def parse_activities():
-            for activity in activities:
-                activity_type = activity['activityType']
-                if activity_type in activity_types:
-                    yield {
-                        'type': activity_type,
-                        'confidence': int(activity['confidence'])
-                    }
-
-        sorted_activities = sorted(parse_activities(), key=lambda x: x['confidence'], reverse=True)
-        result = {}
-
-        if len(sorted_activities) > 0:
-            result['activity_1'] = sorted_activities[0]['type']
-            result['activity_1_conf'] = sorted_activities[0]['confidence']
-            if len(sorted_activities) > 1:
-                result['activity_2'] = sorted_activities[1]['type']
-                result['activity_2_conf'] = sorted_activities[1]['confidence']
-                if len(sorted_activities) > 2:
-                    result['activity_3'] = sorted_activities[2]['type']
-                    result['activity_3_conf'] = sorted_activities[2]['confidence']
-                else:
-                    result['activity_3'] = 'UNKNOWN'
-                    result['activity_3_conf'] = 0
-            else:
-                result['activity_2'] = 'UNKNOWN'
-                result['activity_2_conf'] = 0
-                result['activity_3'] = 'UNKNOWN'
-                result['activity_3_conf'] = 0
-        return result
-
-    for chunk in batch_chunks(data_points):
-        batch = [prepare_point(x) for x in chunk]
-        device_data_table_insert(batch)
     return jsonify({
     })
 
 
+@app.route('/spool')
+def spool():
+    """Depth of the device data upload spool, for monitoring."""
+    if device_data_spool is None:
+        return jsonify({'enabled': False})
+    result = device_data_spool.depth()
+    result['enabled'] = True
+    return jsonify(result)
+
+
+@app.route('/sessioncache')
+def sessioncache():
+    """Session token cache counters, for monitoring."""
+    return jsonify(session_cache.stats())
+
+
 @app.route('/destinations/<session_token>')
 def destinations(session_token):
 
@@ -330,8 +331,9 @@ def destinations(session_token):
         del f["properties"]["coordinates"] # included in geometry
         f["properties"]["visits"] = len(f["properties"]["visits"])
 
-    devices_table_id = get_device_table_id_for_session(session_token)
-    client_log_table_insert(devices_table_id, get_user_id_from_device_id(devices_table_id), "MOBILE-DESTINATIONS", "")
+    devices_table_id, users_table_id = \
+        get_session_ids(session_token) or (-1, None)
+    client_log_table_insert(devices_table_id, users_table_id, "MOBILE-DESTINATIONS", "")
 
     return jsonify(geojson)
 
@@ -373,10 +375,11 @@ def device(session_token):
 
 @app.route('/path/<session_token>')
 def path(session_token):
-    devices_table_id = get_device_table_id_for_session(session_token)
+    devices_table_id, users_table_id = \
+        get_session_ids(session_token) or (-1, None)
     client_log_table_insert(
         devices_table_id,
-        get_user_id_from_device_id(devices_table_id),
+        users_table_id,
         "MOBILE-PATH",
         request.args.get("date"))
     devices = db.metadata.tables["devices"]
@@ -407,12 +410,10 @@ def setlegmode_post():
 
 @app.route('/svg/<session_token>')
 def svg(session_token):
-    device_id = get_device_table_id_for_session(session_token)
-    if device_id < 0:
-        return ""
-    user_id = get_user_id_from_device_id(device_id)
-    if user_id < 0:
+    ids = get_session_ids(session_token)
+    if ids is None:
         return ""
+    device_id, user_id = ids
 
     firstlastday = [
         d in request.args and datetime.datetime.strptime(
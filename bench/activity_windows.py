@@ -0,0 +1,39 @@
+"""Benchmark of the activity windows of DeviceDataFilterer against the
+Counter implementation they replaced, on traces of one to seven days with a
+point every 30 seconds on average. Run from the repository root with
+
+    python -m bench.activity_windows
+"""
+
+import time
+
+from pyfiles.constants import ACTIVITY_WIN
+from pyfiles.device_data_filterer import DeviceDataFilterer
+
+from tests.traces import activity_trace, counter_activities
+
+
+def best_time(f, repeat=3):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def main():
+    print "%5s %7s %10s %10s %7s" % (
+        "days", "points", "counter s", "arrays s", "speedup")
+    for days in (1, 3, 7):
+        points = activity_trace(days * 86400 // 30, seed=days)
+        old = best_time(
+            lambda: counter_activities(points, ACTIVITY_WIN / 2))
+        new = best_time(
+            lambda: list(DeviceDataFilterer()._analyse_activities(points)))
+        print "%5i %7i %10.3f %10.3f %6.1fx" % (
+            days, len(points), old, new, old / new)
+
+
+if __name__ == "__main__":
+    main()
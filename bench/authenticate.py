@@ -0,0 +1,110 @@
+"""Load test of /authenticate under a reconnect storm, comparing the single
+statement authenticate_device with the sequence of statements it replaced.
+
+DEVICES devices are registered, then each round every device authenticates
+once, from CONCURRENCY threads sharing the engine's connection pool as the
+server's request threads do. Latencies are per authentication, including
+waiting for a pooled connection. The registered users and devices and their
+client_log rows are deleted at the end. Every statement saved is a round
+trip saved, so the difference grows with the latency to the database; run it
+from where the server runs. Run from the repository root with
+
+    python -m bench.authenticate [concurrency ...]
+"""
+
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+
+from pyfiles.database_interface import (
+    authenticate_device, client_log_table_insert, get_device_table_id,
+    get_session_token_for_device, get_user_id_from_device_id,
+    register_device, update_last_activity, update_messaging_token,
+    verify_user_id)
+
+from bench.database import bench_db, percentile
+
+DEVICES = 500
+ROUNDS = 3
+CONCURRENCY = (1, 8, 32, 64)
+
+
+def sequential(user_id, device_id, installation_id, client_version,
+               messaging_token):
+    """The /authenticate statements before authenticate_device."""
+    users_table_id = verify_user_id(user_id)
+    devices_table_id = get_device_table_id(
+        users_table_id, device_id, installation_id)
+    session_token = get_session_token_for_device(devices_table_id)
+    if len(messaging_token) > 1:
+        update_messaging_token(devices_table_id, messaging_token)
+    update_last_activity(devices_table_id, client_version)
+    client_log_table_insert(
+        devices_table_id,
+        get_user_id_from_device_id(devices_table_id),
+        "MOBILE-AUTHENTICATE",
+        "ClientVersion:" + (client_version or ""))
+    return session_token
+
+
+def timed(flow):
+    """Function calling flow with a client's arguments, returning seconds."""
+    def call(client):
+        t0 = time.time()
+        flow(*client)
+        return time.time() - t0
+    return call
+
+
+def main():
+    db = bench_db()
+
+    concurrency = [int(x) for x in sys.argv[1:]] or CONCURRENCY
+    run = uuid4().hex[:8]
+    clients = []
+    try:
+        for i in range(DEVICES):
+            client = (
+                "bench-%s-%i" % (run, i), "bench-device", str(uuid4()),
+                "bench", "bench-%s-%i" % (run, i))
+            register_device(
+                client[0], "", "", client[1], client[2], "bench", client[3])
+            clients.append(client)
+
+        print "%-12s %7s %8s %8s %8s %9s" % (
+            "flow", "threads", "p50 ms", "p95 ms", "p99 ms", "auth/s")
+        for threads in concurrency:
+            pool = ThreadPool(threads)
+            for name, flow in [
+                    ("sequential", sequential),
+                    ("single", authenticate_device)]:
+                latencies = []
+                t0 = time.time()
+                for r in range(ROUNDS):
+                    latencies += pool.map(timed(flow), clients, 1)
+                dt = time.time() - t0
+                print "%-12s %7i %8.1f %8.1f %8.1f %9.0f" % (
+                    name, threads,
+                    1000 * percentile(latencies, 50),
+                    1000 * percentile(latencies, 95),
+                    1000 * percentile(latencies, 99),
+                    len(latencies) / dt)
+            pool.close()
+            pool.join()
+    finally:
+        db.engine.execute("""
+            WITH u AS (
+                SELECT id FROM users WHERE user_id LIKE %s
+            ), l AS (
+                DELETE FROM client_log WHERE user_id IN (SELECT id FROM u)
+            ), d AS (
+                DELETE FROM devices WHERE user_id IN (SELECT id FROM u)
+            )
+            SELECT 1""", "bench-%s-%%" % run)
+        db.engine.execute(
+            "DELETE FROM users WHERE user_id LIKE %s", "bench-%s-%%" % run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Database setup shared by the benchmarks that need PostgreSQL.
+
+These run against the database of the configuration, as loaded by the
+servers: the file named by REGULARROUTES_SETTINGS, else regularroutes.cfg.
+They add and remove their own rows only, but load it meanwhile, so use a
+development database.
+"""
+
+import os
+
+from flask import Flask
+
+from pyfiles.database_interface import init_db
+
+SETTINGS_FILE_ENV_VAR = 'REGULARROUTES_SETTINGS'
+
+
+def bench_db():
+    """Initialize the schema, return db."""
+    app = Flask(__name__)
+    if os.getenv(SETTINGS_FILE_ENV_VAR) is not None:
+        app.config.from_envvar(SETTINGS_FILE_ENV_VAR)
+    else:
+        app.config.from_pyfile(os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            'regularroutes.cfg'))
+    db, store = init_db(app)
+    return db
+
+
+def percentile(values, p):
+    """Nearest-rank p'th percentile of values."""
+    values = sorted(values)
+    return values[max(0, int(-(-len(values) * p // 100)) - 1)]
@@ -0,0 +1,106 @@
+"""Benchmark of ReverseGeocoder against a local HTTP stub standing in for a
+slow reverse geocoding API, compared with the sequential loop label_places
+used before. Run from the repository root with
+
+    python -m bench.geocoding
+
+and compare labels/s with the configured queries per second.
+"""
+
+import json
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from pyfiles.geocoding import ReverseGeocoder, response_label
+
+# Seconds the stub takes to respond
+DELAY = 0.5
+
+RESPONSE = json.dumps({"features": [
+    {"properties": {"street": "Mannerheimintie", "name": "Kiasma, Helsinki"}}]})
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers /reverse after DELAY, fails /fail, records request starts."""
+
+    protocol_version = "HTTP/1.1"
+    starts = []
+
+    def do_GET(self):
+        self.starts.append(time.time())
+        if self.path.startswith("/fail"):
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        time.sleep(DELAY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub():
+    """Start the stub in a thread, return its url template."""
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:%i/{path}?lat={{lat}}&lon={{lon}}" % (
+        server.server_address[1])
+
+
+def sequential(url_template, cells, qps):
+    """The label_places loop before ReverseGeocoder: query, then sleep."""
+    for geohash, lat, lon in cells:
+        url = url_template.format(lat=lat, lon=lon)
+        response_label(json.loads(urllib2.urlopen(url, timeout=5).read()))
+        time.sleep(1.0 / qps)
+
+
+def main():
+    template = start_stub()
+    reverse = template.format(path="reverse")
+    cells = [(str(i), 60 + i * 1e-3, 24.9) for i in range(60)]
+
+    for qps in (6, 20):
+        del StubHandler.starts[:]
+        geocoder = ReverseGeocoder(reverse, qps, 5)
+        t0 = time.time()
+        labels = list(geocoder.labels(cells, t0 + 60))
+        dt = time.time() - t0
+        starts = StubHandler.starts
+        print "qps %2i: %i labels in %.2f s, %.1f labels/s, " \
+            "closest request starts %.3f s apart" % (
+                qps, len(labels), dt, len(labels) / dt,
+                min(b - a for a, b in zip(starts, starts[1:])))
+
+    t0 = time.time()
+    sequential(reverse, cells[:12], 6)
+    print "sequential loop at qps 6: %.1f labels/s" % (12 / (time.time() - t0))
+
+    t0 = time.time()
+    labels = list(ReverseGeocoder(reverse, 6, 5).labels(cells, t0 + 2))
+    print "deadline 2 s: %i labels in %.2f s" % (len(labels), time.time() - t0)
+
+    try:
+        list(ReverseGeocoder(template.format(path="fail"), 6, 5).labels(
+            cells, time.time() + 60))
+        print "failing API: no error raised"
+    except Exception as e:
+        print "failing API: raised %s" % type(e).__name__
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark of /data ingest throughput, the batched INSERT path against
+DEVICE_DATA_COPY, in points per second.
+
+Uploads of each size are generated as decoded point records and stored the
+way data_post stores them, for a device registered for the benchmark. Each
+run uses its own time range, so no points are duplicates. The device, its
+user and their data are deleted at the end. Run from the repository root
+with
+
+    python -m bench.ingest [points per upload ...]
+"""
+
+import datetime
+import random
+import sys
+import time
+from itertools import islice
+from uuid import uuid4
+
+from pyfiles.database_interface import (
+    device_data_table_copy, device_data_table_insert, ewkb_point,
+    register_device)
+
+from bench.database import bench_db
+
+UPLOAD_SIZES = (100, 1000, 10000, 50000)
+
+# Total points per size and path, in as many uploads as that makes
+POINTS = 100000
+
+# As in data_post
+BATCH_SIZE = 1024
+
+
+def upload_records(n, start_ms):
+    """n point records, one a second from start_ms."""
+    rnd = random.Random(start_ms)
+    return [
+        (   24.9 + rnd.random() * 0.1, 60.15 + rnd.random() * 0.05,
+            float(rnd.choice([5, 10, 20, 50])), start_ms + 1000 * i,
+            "ON_FOOT", 60, "STILL", 30, "UNKNOWN", 0)
+        for i in xrange(n)]
+
+
+def insert(device_id, records):
+    """data_post without DEVICE_DATA_COPY."""
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, BATCH_SIZE))
+        if not chunk:
+            return
+        device_data_table_insert([{
+            'device_id': device_id,
+            'coordinate': 'POINT(%f %f)' % record[:2],
+            'accuracy': record[2],
+            'time': datetime.datetime.fromtimestamp(record[3] / 1000.0),
+            'activity_1': record[4],
+            'activity_1_conf': record[5],
+            'activity_2': record[6],
+            'activity_2_conf': record[7],
+            'activity_3': record[8],
+            'activity_3_conf': record[9]} for record in chunk])
+
+
+def copy(device_id, records):
+    """data_post with DEVICE_DATA_COPY."""
+    device_data_table_copy((
+        device_id,
+        ewkb_point(*record[:2]),
+        record[2],
+        datetime.datetime.fromtimestamp(record[3] / 1000.0)) + record[4:]
+        for record in records)
+
+
+def main():
+    db = bench_db()
+    sizes = [int(x) for x in sys.argv[1:]] or UPLOAD_SIZES
+    user_id = "bench-%s" % uuid4().hex[:8]
+    device_id = None
+    try:
+        device_id = register_device(
+            user_id, "", "", "bench-device", str(uuid4()), "bench", "bench")[0]
+
+        # Consecutive uploads from a month back, as delayed client uploads
+        start = int(time.time() - 30 * 86400) * 1000
+        print "%8s %8s %12s %12s" % ("points", "uploads", "INSERT p/s", "COPY p/s")
+        for size in sizes:
+            uploads = max(1, POINTS // size)
+            rates = []
+            for store in insert, copy:
+                batches = []
+                for i in range(uploads):
+                    batches.append(upload_records(size, start))
+                    start += size * 1000
+                t0 = time.time()
+                for records in batches:
+                    store(device_id, records)
+                rates.append(size * uploads / (time.time() - t0))
+            print "%8i %8i %12.0f %12.0f" % ((size, uploads) + tuple(rates))
+    finally:
+        if device_id is not None:
+            db.engine.execute(
+                "DELETE FROM device_data WHERE device_id = %s", device_id)
+        db.engine.execute("""
+            WITH u AS (
+                SELECT id FROM users WHERE user_id = %s
+            ), l AS (
+                DELETE FROM client_log WHERE user_id IN (SELECT id FROM u)
+            ), d AS (
+                DELETE FROM devices WHERE user_id IN (SELECT id FROM u)
+            )
+            SELECT 1""", user_id)
+        db.engine.execute("DELETE FROM users WHERE user_id = %s", user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Check of device_data partition pruning: EXPLAIN of typical queries on the
+device_data partitions, printing the tables each plan scans and how. Queries
+bounded by time should scan the parent and the partitions in range only.
+Run from the repository root with
+
+    python -m bench.partitions [-v]
+
+where -v prints the whole plans. Nothing is written to the database.
+"""
+
+import datetime
+import re
+import sys
+
+from sqlalchemy import text
+
+from pyfiles.database_interface import device_data_partitions
+
+from bench.database import bench_db
+
+QUERIES = (
+    ("trace of a device for a day", """
+        SELECT * FROM device_data
+        WHERE device_id = :device AND time >= :day AND time < :nextday"""),
+    ("duplicate probe bounded by month, as in inserts", """
+        SELECT 1 FROM device_data
+        WHERE (device_id, time) = (:device, :day)
+            AND time >= :start AND time < :end"""),
+    ("duplicate probe of the insert rule, unbounded", """
+        SELECT 1 FROM device_data
+        WHERE (device_id, time) = (:device, :day)"""),
+    ("points of the month", """
+        SELECT count(*) FROM device_data
+        WHERE time >= :start AND time < :end"""),
+    ("unsnapped points, unbounded", """
+        SELECT id FROM device_data WHERE snapping_time IS NULL LIMIT 1000"""))
+
+SCAN = re.compile(r"(?:->\s+|^)(\w[\w ]*? Scan)(?: using (\w+))? on (\w+)")
+
+
+def main():
+    db = bench_db()
+    verbose = "-v" in sys.argv[1:]
+
+    months = device_data_partitions()
+    if not months:
+        print "no device_data partitions"
+        return
+    print "%i partitions, %s to %s" % (len(months), months[0], months[-1])
+
+    month = months[-1]
+    start = datetime.datetime(month.year, month.month, 1)
+    end = (start + datetime.timedelta(days=31)).replace(day=1)
+    params = {
+        "device": 1,
+        "day": start + datetime.timedelta(days=1),
+        "nextday": start + datetime.timedelta(days=2),
+        "start": start,
+        "end": end}
+
+    for name, query in QUERIES:
+        plan = [row[0] for row in db.engine.execute(
+            text("EXPLAIN " + query), **params)]
+        print
+        print name
+        if verbose:
+            for line in plan:
+                print "   ", line
+            continue
+        for line in plan:
+            for scan, index, relation in SCAN.findall(line):
+                print "    %-20s %-30s %s" % (scan, relation, index)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Benchmark of simplify_geometry as the path views call it, with the lazy
+heap simplify against the re-heapifying one it replaced, on traces of 1k,
+10k and 35k points. The old version takes minutes on 35k points, so it is
+only run on that with --all.
+
+The kept points can differ where metrics are equal. The old version broke
+those ties by comparing list nodes, the new one removes them in input order;
+tests/test_simplify.py checks that the two agree otherwise. Run from the
+repository root with
+
+    python -m bench.simplify [--all]
+"""
+
+import sys
+import time
+
+from pyfiles import common_helpers
+from pyfiles.common_helpers import simplify_geometry
+
+from tests.traces import heapify_simplify, location_trace
+
+MAXPTS = 100
+MINDIST = 10
+
+
+def timed(simplify, points):
+    """Seconds and result of simplify_geometry using simplify."""
+    saved = common_helpers.simplify
+    common_helpers.simplify = simplify
+    try:
+        t0 = time.time()
+        result = simplify_geometry(
+            points, maxpts=MAXPTS, mindist=MINDIST, keep_activity=True)
+        return time.time() - t0, result
+    finally:
+        common_helpers.simplify = saved
+
+
+def main():
+    old_max = "--all" in sys.argv[1:] and 35000 or 10000
+    print "%7s %9s %9s %7s" % ("points", "old s", "new s", "speedup")
+    for n in (1000, 10000, 35000):
+        points = location_trace(n, seed=n)
+        new = timed(common_helpers.simplify, points)[0]
+        if n <= old_max:
+            old = timed(heapify_simplify, points)[0]
+            print "%7i %9.3f %9.3f %6.1fx" % (n, old, new, old / new)
+        else:
+            print "%7i %9s %9.3f %7s" % (n, "-", new, "-")
+
+
+if __name__ == "__main__":
+    main()
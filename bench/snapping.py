@@ -0,0 +1,48 @@
+"""Benchmark of snapping points to waypoints with RoadIndex, in-process and
+with SnappingPool over several worker processes, on a synthetic road network
+the size of a city. Run from the repository root with
+
+    python -m bench.snapping [workers ...]
+
+Adding workers helps only up to the number of cores.
+"""
+
+import multiprocessing
+import sys
+import time
+
+from pyfiles.snapping import RoadIndex, SnappingPool
+
+from tests.traces import road_network, road_points
+
+ROADS = 50000
+POINTS = 200000
+WORKERS = (1, 2, 4, 8)
+
+
+def main():
+    workers = [int(x) for x in sys.argv[1:]] or WORKERS
+    roads, waypoints = road_network(ROADS, width=0.5)
+    points = road_points(roads, POINTS)
+
+    t0 = time.time()
+    index = RoadIndex(roads, waypoints)
+    print "%i roads, %i segments, %i waypoints indexed in %.2f s" % (
+        len(roads), len(index), len(waypoints), time.time() - t0)
+    print "%i points, %i cores" % (len(points), multiprocessing.cpu_count())
+
+    print "%7s %9s %9s %8s" % ("workers", "s", "points/s", "snapped")
+    for n in workers:
+        # The scheduler keeps its pool between runs, so forking is not timed
+        pool = SnappingPool(index, n)
+        t0 = time.time()
+        snapped = pool.snap(points)
+        dt = time.time() - t0
+        pool.close()
+        print "%7i %9.2f %9.0f %8i" % (
+            n, dt, len(points) / dt,
+            sum(1 for x in snapped if x[1] is not None))
+
+
+if __name__ == "__main__":
+    main()
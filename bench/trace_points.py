@@ -0,0 +1,74 @@
+"""Benchmark of the trace processing of a week-long device trace with plain
+geojson rows, as the queries returned before TracePoint, against TracePoints
+of lon, lat rows. Both go through the same code, which decodes geojson on
+every point_coordinates call for plain rows. Covered are the stop/move
+partitioning and activity analysis of generate_legs, the distance sum of
+update_user_distances, and the sidestep filtering, simplification and line
+rendering of the path views. Query time is not included. Run from the
+repository root with
+
+    python -m bench.trace_points [days]
+"""
+
+import sys
+import time
+
+from pyfiles.common_helpers import (
+    pairwise, point_distance, simplify_geometry, trace_linestrings,
+    trace_points)
+from pyfiles.device_data_filterer import DeviceDataFilterer
+from pyfiles.trace_kernels import trace_discard_sidesteps
+
+from pyfiles.constants import BAD_LOCATION_RADIUS
+
+from tests.traces import device_rows
+
+# location_trace points are on average 30.5 s apart
+POINTS_PER_DAY = 2833
+
+
+def legs(points):
+    """Moving and stationary segments, and activities of moving points."""
+    filterer = DeviceDataFilterer()
+    detector = filterer.leg_detector()
+    pairs = list(detector.push(points)) + list(detector.finish())
+    activities = [
+        a for (mov, seg), nextms in pairs if mov
+        for p, a in filterer._analyse_activities(seg)]
+    return [len(seg) for (mov, seg), nextms in pairs], activities
+
+
+def distance(points):
+    return sum(point_distance(p0, p1) for p0, p1 in pairwise(points))
+
+
+def path(points):
+    points = trace_discard_sidesteps(points, BAD_LOCATION_RADIUS)
+    points = simplify_geometry(points, mindist=10, keep_activity=True)
+    return list(trace_linestrings(points, ("activity",)))
+
+
+def main():
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 7
+    n = int(days * POINTS_PER_DAY)
+    plain = device_rows(n, geojson=True)
+    rows = device_rows(n)
+
+    print "%i points over %.1f days" % (n, days)
+    print "%-10s %9s %12s %7s" % ("stage", "geojson s", "TracePoint s", "speedup")
+    results = []
+    for name, stage in [
+            ("legs", legs), ("distance", distance), ("path", path)]:
+        t0 = time.time()
+        before = stage(plain)
+        t1 = time.time()
+        after = stage(trace_points(rows))
+        t2 = time.time()
+        print "%-10s %9.3f %12.3f %6.1fx" % (
+            name, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1))
+        results.append(before == after)
+    print "same results:", all(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import json
 
 from datetime import timedelta
+from collections import defaultdict
 from heapq import heapify, heappop, heappush
-from itertools import izip, tee
-from math import cos, pi
+from itertools import count, izip, product, tee
+from math import cos, floor, pi
 from pyfiles.constants import *
 
 
@@ -41,7 +42,59 @@ class Equirectangular:
         return lon, lat
 
 
+class TracePoint(object):
+    """Location trace point with its coordinates decoded once, from lon and
+    lat columns if present in the row, else from geojson. Supports the row
+    style p["key"] access of the trace functions; keys other than the slots
+    are looked up from the source row."""
+
+    __slots__ = ("lon", "lat", "time", "accuracy", "row")
+
+    fields = frozenset(("lon", "lat", "time", "accuracy"))
+
+    def __init__(self, row):
+        self.row = row
+        if "lon" in row:
+            self.lon = row["lon"]
+            self.lat = row["lat"]
+        else:
+            self.lon, self.lat = json.loads(row["geojson"])["coordinates"]
+        self.time = row["time"]
+        if "accuracy" in row:
+            self.accuracy = row["accuracy"]
+
+    @property
+    def geojson(self):
+        return json.dumps({"type": "Point", "coordinates": [self.lon, self.lat]})
+
+    def __getitem__(self, key):
+        if key in TracePoint.fields:
+            return getattr(self, key)
+        if key == "geojson":
+            return self.geojson
+        return self.row[key]
+
+    def __contains__(self, key):
+        if key == "accuracy":
+            return hasattr(self, "accuracy")
+        return key in TracePoint.fields or key == "geojson" or key in self.row
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [k for k in ("lon", "lat", "time", "accuracy") if k in self] \
+            + [k for k in self.row.keys() if k not in TracePoint.fields]
+
+
+def trace_points(rows):
+    """List of TracePoint of rows."""
+    return [TracePoint(x) for x in rows]
+
+
 def point_coordinates(p):
+    if isinstance(p, TracePoint):
+        return [p.lon, p.lat]
     return json.loads(p["geojson"])["coordinates"]
 
 
@@ -62,7 +115,7 @@ def simplify_geometry(
         keep_activity=False):
     """Simplify location trace by removing geometrically redundant points.
 
-    points -- [{
+    points -- [TracePoint or {
         "geojson": json.dumps({"coordinates": [lon, lat]}),
         "time": datetime} ...]
     maxpts -- simplify until given number of points remain
@@ -76,7 +129,7 @@ def simplify_geometry(
     if (not points or not mindist and (not maxpts or len(points) <= maxpts)):
         return points
 
-    ballpark = json.loads(points[0]['geojson'])['coordinates']
+    ballpark = point_coordinates(points[0])
     projector = Equirectangular(*ballpark)
 
     def distance_point_lineseg(p, l, par=None):
@@ -105,15 +158,13 @@ def simplify_geometry(
     def linedist(p0, p1, p2):
         """Distance of p1 from line segment between p0 and p2."""
         m0, m1, m2 = (
-            projector.d2m(*json.loads(x['geojson'])['coordinates'])
-            for x in (p0, p1, p2))
+            projector.d2m(*point_coordinates(x)) for x in (p0, p1, p2))
         return distance_point_lineseg(m1, (m0, m2))
 
     def timedist(p0, p1, p2):
         """Distance of p1 from its time interpolation between p0 and p2."""
         m0, m1, m2 = (
-            projector.d2m(*json.loads(x['geojson'])['coordinates'])
-            for x in (p0, p1, p2))
+            projector.d2m(*point_coordinates(x)) for x in (p0, p1, p2))
         fraction = point_interval(p0, p1) / point_interval(p0, p2)
         return distance_point_lineseg(m1, (m0, m2), fraction)
 
@@ -134,13 +185,14 @@ def simplify_geometry(
 def simplify(points, metric, maxpts=None, minmetric=None):
     """Remove points in order of lowest metric(predecessor, point, successor)
     until it reaches minmetric, and number of points is no greater than
-    maxpts."""
+    maxpts. Points of equal metric are removed in input order."""
 
     class Dll:
-        def __init__(self, value, before=None, after=None):
+        def __init__(self, value, index):
             self.value = value
-            self.before = before
-            self.after = after
+            self.index = index
+            self.before = None
+            self.after = None
         def unlink(self):
             if self.before:
                 self.before.after = self.after
@@ -150,28 +202,38 @@ def simplify(points, metric, maxpts=None, minmetric=None):
     def node_metric(node):
         return metric(node.before.value, node.value, node.after.value)
 
-    linked = [Dll(x) for x in points]
+    linked = [Dll(x, i) for i, x in enumerate(points)]
     for i in range(1, len(linked)):
         linked[i].before = linked[i-1]
     for i in range(len(linked) - 1):
         linked[i].after = linked[i+1]
 
-    heap = [[node_metric(node), node] for node in linked[1:-1]]
-    for node, heap_entry in zip(linked[1:-1], heap):
-        node.heap_entry = heap_entry
+    # Lazy deletion: an entry is stale unless its version is the node's
+    # latest, updated metrics are pushed anew
+    version = [0] * len(linked)
+    heap = [(node_metric(node), node.index, 0) for node in linked[1:-1]]
     heapify(heap)
+    live = len(heap)
+    last = len(linked) - 1
 
     while heap:
-        m, node = heappop(heap)
+        m, i, v = heappop(heap)
+        if v != version[i]:
+            continue
+        live -= 1
         # 3 == the endpoints not in heap, plus the one item popped above
-        if ((not maxpts or len(heap) <= maxpts - 3)
+        if ((not maxpts or live <= maxpts - 3)
                 and (not minmetric or m > minmetric)):
             break
+        node = linked[i]
         node.unlink()
         for neighbor in node.before, node.after:
-            if hasattr(neighbor, "heap_entry"):
-                neighbor.heap_entry[0] = node_metric(neighbor)
-        heapify(heap)
+            if 0 < neighbor.index < last:
+                version[neighbor.index] += 1
+                heappush(heap, (
+                    node_metric(neighbor),
+                    neighbor.index,
+                    version[neighbor.index]))
 
     node = linked[0]
     rv = []
@@ -437,7 +499,8 @@ def trace_discard_single_sidesteps(points, factor=2):
         # typically has movement, or at least greater noise. This is why if
         # both p1 and p2 look bad, we want to keep the one that looks worse,
         # due to getting a narrower neighbor base from the false side.
-        if (d(buf[0], buf[1]) > dict(buf[1]).get("accuracy", 0)
+        if (d(buf[0], buf[1]) > (
+                    buf[1]["accuracy"] if "accuracy" in buf[1] else 0)
                 and badness1 > factor
                 and (badness2 <= factor or badness1 <= badness2)):
             buf.pop(1)
@@ -472,7 +535,7 @@ def trace_discard_unmoved(points, radius=None):
 def trace_linestrings(points, keys=(), feature_properties=()):
     """Render sequence of points as geojson linestring features.
 
-    points -- [{geojson: json.dumps({coordinates: [lon, lat]})} ...]
+    points -- [TracePoint or {geojson: json.dumps({coordinates: [lon, lat]})}]
     keys -- render separate linestring when these values change in points
     feature_properties -- dict added to each feature's properties object
     """
@@ -621,7 +684,21 @@ def stop_clusters(stops, cluster_distance):
                 "time_end": x["time_end"]}]}
         for x in stops]
 
-    groups = do_cluster(dests, dest_merge, dest_dist, cluster_distance)
+    # Grid cells for neighbor search, sized to cover cluster_distance at the
+    # highest latitude present, with some slack for rounding. Merged centres
+    # stay within the latitude range.
+    cellfun = None
+    maxlat = max([abs(x["coordinates"][1]) for x in stops] or [0])
+    coslat = cos(maxlat / 180 * pi)
+    if cluster_distance > 0 and coslat > .01:
+        latcell = 1.01 * cluster_distance / 110574
+        loncell = 1.01 * cluster_distance / (110320 * coslat)
+        def cellfun(d):
+            lon, lat = d["coordinates"]
+            return int(floor(lon / loncell)), int(floor(lat / latcell))
+
+    groups = do_cluster(
+        dests, dest_merge, dest_dist, cluster_distance, cellfun)
 
     for g in groups:
         g["total_time"] = sum(
@@ -650,52 +727,106 @@ def stop_clusters(stops, cluster_distance):
     return groups
 
 
-def do_cluster(items, mergefun, distfun, distlim):
+def do_cluster(items, mergefun, distfun, distlim, cellfun=None):
     """Pairwise nearest merging clusterer.
     items -- list of dicts
     mergefun -- merge two items
     distfun -- distance function
     distlim -- stop merging when distance above this limit
+    cellfun -- optional grid cell of item as a tuple of ints, such that items
+        within distlim of each other are in the same or adjacent cells. Limits
+        neighbor search to adjacent cells; without it, every item is a
+        candidate, as needed for non-metric distances.
+
+    Repeatedly merges the item nearest to its nearest neighbor, distance
+    measured as distfun(item, neighbor), ties going to the earlier item.
     """
 
-    def heapitem(d0, dests):
-        """Find nearest neighbor for d0 as sortable [distance, nearest, d0]"""
-        return (min([distfun(d0, d1),
-                     d1] for d1 in dests if d1 is not d0)
-                  + [d0])
-
-    heap = [[None, None, d] for d in items]
-    d0 = d1 = merged = None
-    while len(heap) > 1:
-        for item in heap:
-            # rescan nearest where nearest was merged away, or not yet set
-            if item[1] in (None, d0, d1):
-                item[:] = heapitem(item[2], (x[2] for x in heap))
+    clusters = {} # id -> item
+    nearest = {} # id -> (distance, id of nearest neighbor)
+    nearest_of = defaultdict(set) # id -> ids having it as nearest
+    cells = defaultdict(set) # cell -> ids
+    cellof = {} # id -> cell
+    heap = [] # (distance, id, id of nearest), stale unless matches nearest
+    ids = count()
+
+    def neighborhood(i):
+        if cellfun is None:
+            return clusters.keys()
+        c = cellof[i]
+        return [j
+            for offset in product((-1, 0, 1), repeat=len(c))
+            for j in cells.get(tuple(a + b for a, b in izip(c, offset)), ())]
+
+    def set_nearest(i, best):
+        old = nearest.pop(i, None)
+        if old and old[1] in nearest_of:
+            nearest_of[old[1]].discard(i)
+        if best:
+            nearest[i] = best
+            nearest_of[best[1]].add(i)
+            heappush(heap, (best[0], i, best[1]))
+
+    def scan(i):
+        best = None
+        for j in neighborhood(i):
+            if j == i:
                 continue
+            distance = distfun(clusters[i], clusters[j])
+            if cellfun and distance > distlim:
+                continue
+            if best is None or (distance, j) < best:
+                best = distance, j
+        set_nearest(i, best)
+
+    def add(item):
+        i = next(ids)
+        clusters[i] = item
+        if cellfun:
+            cellof[i] = tuple(cellfun(item))
+            cells[cellof[i]].add(i)
+        return i
+
+    def remove(i):
+        set_nearest(i, None)
+        del clusters[i]
+        if cellfun:
+            cells[cellof[i]].discard(i)
+            del cellof[i]
+        return nearest_of.pop(i, set())
+
+    for item in items:
+        add(item)
+    for i in list(clusters):
+        scan(i)
 
-            # update others where merged now nearest
-            if item[2] is not merged:
-                distance = distfun(item[2], merged)
-                if item[0] > distance:
-                    item[0:2] = distance, merged
-
-        # arrange heap, pop out one end of shortest edge
-        heapify(heap)
-        distance, d1, d0 = item = heappop(heap)
+    while heap:
+        distance, i, j = heappop(heap)
+        if i not in clusters or nearest.get(i) != (distance, j):
+            continue # stale
 
-        # if shortest edge is long enough, unpop and stop
-        if distance is None or distance > distlim:
-            heappush(heap, item) # unspill the milk
+        if distance > distlim:
             break
 
-        # replace other end with merged destination
-        merged = mergefun(d0, d1)
-        for i in range(len(heap)):
-            if heap[i][2] is d1:
-                heap[i] = [None, None, merged]
-                break
+        merged = mergefun(clusters[i], clusters[j])
+        orphans = remove(i) | remove(j)
+        m = add(merged)
+        scan(m)
+
+        # Rescan where nearest was merged away, else check if merged nearer
+        for k in orphans:
+            if k in clusters:
+                scan(k)
+        for k in neighborhood(m):
+            if k == m or k in orphans:
+                continue
+            distance = distfun(clusters[k], merged)
+            if cellfun and distance > distlim:
+                continue
+            if k not in nearest or distance < nearest[k][0]:
+                set_nearest(k, (distance, m))
 
-    return [x[2] for x in heap]
+    return [clusters[k] for k in sorted(clusters)]
 
 
 def group_unsorted(iterable, keyfunc):
@@ -719,7 +850,21 @@ def trace_split_sparse(points, interval):
         yield segment
 
 
+# interpret_jore results by code, there are only so many lines
+jore_cache = {}
+
+
 def interpret_jore(jore_code):
+    """(line_name, line_type) of a JORE line code."""
+    result = jore_cache.get(jore_code)
+    if result is None:
+        if len(jore_cache) > 10000:
+            jore_cache.clear()
+        result = jore_cache[jore_code] = _interpret_jore(jore_code)
+    return result
+
+
+def _interpret_jore(jore_code):
     if re.search(jore_ferry_regex, jore_code):
         line_name = "Ferry"
         line_type = "FERRY"
@@ -57,6 +57,21 @@ INCLUDE_DESTINATIONS_BETWEEN = 200, 200000
 # Default maximum number of destinations to emit in client api
 DESTINATIONS_LIMIT = 5
 
+# Default size limit (bytes) of the device data upload spool, and the
+# Retry-After (s) given to clients when it is full
+DEVICE_DATA_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+DEVICE_DATA_SPOOL_RETRY_AFTER = 60
+
+# Default maximum number of points in a binary /data upload, which is
+# decoded whole as its columns come one after another
+DATA_UPLOAD_MAX_POINTS = 100000
+
+# Number of session tokens cached by the mobile api, and seconds to keep
+# each before looking it up again, which is also how long a deleted device's
+# token may still be accepted
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 600
+
 # Links to transit disruption pages
 DISRUPTION_URI_EN = "https://www.hsl.fi/en/news"
 DISRUPTION_URI_FI = "https://www.hsl.fi/ajankohtaista"
@@ -3,27 +3,32 @@
 import datetime
 from datetime import timedelta
 
-import json
+import struct
+from contextlib import contextmanager
+from uuid import UUID as parse_uuid, uuid4
 
 import geoalchemy2 as ga2
+import psycopg2
+from psycopg2.errorcodes import UNIQUE_VIOLATION
 from flask import abort
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from sqlalchemy import (
-    BigInteger, Column, Enum, Float, ForeignKey, Index, Integer, String, Table,
+    BigInteger, Boolean, Column, Enum, Float, ForeignKey, Index, Integer, String, Table,
     UniqueConstraint)
 
 from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TIMESTAMP, UUID
-from sqlalchemy.exc import DataError, ProgrammingError
+from sqlalchemy.exc import DataError, IntegrityError, ProgrammingError
 
 from sqlalchemy.sql import (
-    and_, between, column, exists, func, or_, select, text)
+    and_, between, cast, column, exists, func, or_, select, text)
 
 from pyfiles.energy_rating import EnergyRating
 from pyfiles.config_helper import get_config
 
 from pyfiles.common_helpers import (
-    get_distance_between_coordinates, trace_discard_sidesteps)
+    get_distance_between_coordinates, point_coordinates, trace_points)
+from pyfiles.trace_kernels import trace_discard_sidesteps
 
 from pyfiles.constants import (
     ALERT_RADIUS,
@@ -31,9 +36,12 @@ from pyfiles.constants import (
     DEST_RADIUS_MAX,
     DISRUPTION_URI_EN,
     DISRUPTION_URI_FI,
-    MAX_POINT_TIME_DIFFERENCE)
+    MAX_POINT_TIME_DIFFERENCE,
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL)
 
 from pyfiles.svg_generation import generate_energy_rating_svg
+from pyfiles.ttl_cache import TTLCache
 
 
 # from simplekv.memory import DictStore
@@ -51,6 +59,16 @@ These types are the same as are defined in:
 https://developer.android.com/reference/com/google/android/gms/location/DetectedActivity.html
 '''
 activity_types = ('IN_VEHICLE', 'ON_BICYCLE', 'ON_FOOT', 'RUNNING', 'STILL', 'TILTING', 'UNKNOWN', 'WALKING')
+# Skip inserting points already stored. Applies to inserts into the parent
+# only, so device_data_table_insert and device_data_table_copy, which insert
+# into partitions, check for duplicates themselves.
+device_data_duplicate_ignore_rule = '''
+    CREATE RULE "device_data_duplicate_ignore" AS ON INSERT TO "device_data"
+    WHERE EXISTS(SELECT 1 FROM device_data
+                 WHERE (device_id, time)=(NEW.device_id, NEW.time))
+    DO INSTEAD NOTHING;
+    '''
+
 activity_type_enum = Enum(*activity_types, name='activity_type_enum')
 
 '''
@@ -144,7 +162,11 @@ def init_db(app):
                               Column('waypoint_id', BigInteger),
                               Column('snapping_time', TIMESTAMP),
                               Index('idx_device_data_time', 'time'),
-                              Index('idx_device_data_device_id_time', 'device_id', 'time'))
+                              Index('idx_device_data_device_id_time', 'device_id', 'time', unique=True))
+
+    # On databases predating the unique index, duplicates are removed and
+    # the index made unique by scheduler.dedupe_device_data. Meanwhile the
+    # rule, created below, keeps new duplicates of stored points out.
 
     Index('idx_device_data_snapping_time_null', device_data_table.c.snapping_time, postgresql_where=device_data_table.c.snapping_time == None)
 
@@ -172,6 +194,12 @@ def init_db(app):
         Column('label_coordinate', # coords when label was fetched
             ga2.Geography('point', 4326, spatial_index=True)))
 
+    # Reverse geocoded labels by geohash cell, see pyfiles/geocoding.py
+    Table('geocoding_cache', metadata,
+        Column('geohash', String, primary_key=True),
+        Column('label', String, nullable=False), # empty if nothing named
+        Column('time', TIMESTAMP, nullable=False))
+
     # Clustered leg ends
     global leg_ends_table
     leg_ends_table = Table('leg_ends', metadata,
@@ -250,6 +278,58 @@ def init_db(app):
         Column('first', TIMESTAMP, nullable=False),
         UniqueConstraint('leg', 'waypoint'))
 
+    # Legs created or moved since their leg_waypoints were last set, filled
+    # by trigger, see sql/leg_waypoints.sql
+    Table('leg_waypoints_queue', metadata,
+        Column(
+            'leg',
+            ForeignKey('legs.id', ondelete="CASCADE"),
+            primary_key=True))
+
+    # Leg detector state to resume from, after the last point processed, and
+    # the greatest device_data id processed, to tell points received since
+    Table('leg_detector_state', metadata,
+        Column(
+            'device_id',
+            ForeignKey('devices.id', ondelete="CASCADE"),
+            primary_key=True),
+        Column('time', TIMESTAMP, nullable=False),
+        Column('state', String, nullable=False),
+        Column('last_id', Integer, nullable=False))
+
+    # Per user progress of incremental jobs: the data time to continue from,
+    # and the time up to which device activity has been accounted for. Null
+    # checked means the user is due regardless of activity.
+    Table('job_watermarks', metadata,
+        Column('job', String, primary_key=True),
+        Column(
+            'user_id',
+            ForeignKey('users.id', ondelete="CASCADE"),
+            primary_key=True),
+        Column('time', TIMESTAMP, nullable=False),
+        Column('checked', TIMESTAMP))
+
+    # Latest run of each scheduler job, see job_lock
+    Table('job_status', metadata,
+        Column('job', String, primary_key=True),
+        Column('owner', String, nullable=False),
+        Column('started', TIMESTAMP, nullable=False),
+        Column('heartbeat', TIMESTAMP, nullable=False),
+        Column('finished', TIMESTAMP))
+
+    # Timing and row counts of scheduler job runs, see job_metrics. Counters
+    # and spans are JSON.
+    Table('job_runs', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('job', String, nullable=False),
+        Column('started', TIMESTAMP, nullable=False),
+        Column('ok', Boolean, nullable=False),
+        Column('seconds', Float, nullable=False),
+        Column('db_seconds', Float, nullable=False),
+        Column('counters', String, nullable=False),
+        Column('spans', String, nullable=False),
+        Index('idx_job_runs_job_started', 'job', 'started'))
+
     # travelled distances per day per device
     global travelled_distances_table
     travelled_distances_table = Table('travelled_distances', metadata,
@@ -306,6 +386,10 @@ def init_db(app):
             DO INSTEAD NOTHING;
             '''))
 
+    # Rows inserted into mass_transit_data go to the daily partition of their
+    # time if there is one, see mass_transit_data_create_partition
+    _install_partition_route("mass_transit_data", "YYYYMMDD")
+
     # Public transport service alerts
     global hsl_alerts_table
     hsl_alerts_table = Table('hsl_alerts', metadata,
@@ -444,11 +528,32 @@ def init_db(app):
 
     metadata.create_all(checkfirst=True)
 
+    if not db.engine.execute(text(
+            "SELECT 1 FROM pg_rules WHERE rulename = :name"),
+            name="device_data_duplicate_ignore").first():
+        db.engine.execute(text(device_data_duplicate_ignore_rule))
+
+    # Rows inserted into device_data go to the monthly partition of their
+    # time if there is one, see device_data_create_partition
+    _install_partition_route("device_data", "YYYYMM")
+
     conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
     conn.execute("""ALTER TYPE client_function_enum
             ADD VALUE IF NOT EXISTS 'WEB-PATH-EDIT'""")
     conn.execute("""ALTER TYPE client_function_enum
             ADD VALUE IF NOT EXISTS 'WEB-TRIPS-LIST'""")
+
+    # Tripless user moves, the work list of scheduler.generate_trips. Few
+    # rows at any time, but legs is big enough to build it without locking.
+    if not conn.execute(text(
+            "SELECT 1 FROM pg_class "
+            "WHERE relname = :name AND pg_table_is_visible(oid)"),
+            name="idx_legs_tripless").first():
+        conn.execute("""
+            CREATE INDEX CONCURRENTLY idx_legs_tripless
+            ON legs (user_id, time_start)
+            WHERE trip IS NULL AND user_id IS NOT NULL
+                AND activity != 'STILL'""")
     conn.close()
 
     # Combined view of legs with migrated/detected/user modes and lines
@@ -533,6 +638,21 @@ CREATE OR REPLACE VIEW leg_modes AS SELECT
         t.execute(text("lock places in access exclusive mode"))
         t.execute(text(f.read()), clustdist=2*DEST_RADIUS_MAX)
 
+    # Trigger that queues legs for setting their waypoints. When first
+    # installed, queue the legs that have none yet.
+    with open("sql/leg_waypoints.sql") as f, db.engine.begin() as t:
+        t.execute(text("lock leg_waypoints_queue in access exclusive mode"))
+        seed = not t.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = :name"),
+            name="legs_queue_waypoints_trigger").first()
+        t.execute(text(f.read()))
+        if seed:
+            t.execute(text("""
+                INSERT INTO leg_waypoints_queue (leg)
+                SELECT id FROM legs
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM leg_waypoints WHERE leg = legs.id)"""))
+
     return db, store
 
 
@@ -647,12 +767,12 @@ def get_ratings_from_rows(filtered_data_rows, user_id):
         return ratings
     previous_time = rows[0]["time"]
     current_date = rows[0]["time"].replace(hour = 0, minute = 0, second = 0, microsecond = 0)
-    previous_location = json.loads(rows[0]["geojson"])["coordinates"]
+    previous_location = point_coordinates(rows[0])
     rating = EnergyRating(user_id, date=current_date)
     for row in rows[1:]:
         current_activity = row["activity"]
         current_time = row["time"]
-        current_location = json.loads(row["geojson"])["coordinates"]
+        current_location = point_coordinates(row)
 
         if (current_time - current_date).total_seconds() >= 60*60*24: #A full day
             current_date = current_time.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
@@ -801,6 +921,12 @@ def get_distinct_device_ids(datetime_start, datetime_end):
     '''), date_start=str(datetime_start), date_end=str(datetime_end))
 
 
+def coordinate_lonlat(coordinate):
+    """Select list of lon, lat of a point column, for TracePoint."""
+    geometry = cast(coordinate, ga2.Geometry)
+    return [func.ST_X(geometry).label("lon"), func.ST_Y(geometry).label("lat")]
+
+
 def get_filtered_device_data_points(user_id, datetime_start, datetime_end):
     """Get trace with activity stabilized and mass transit detected, fusing
     legs and raw device data."""
@@ -827,8 +953,8 @@ def get_filtered_device_data_points(user_id, datetime_start, datetime_end):
             legs.c.time_start <= datetime_end,
             legs.c.time_end >= datetime_start)).alias("lagged")
 
-    return db.engine.execute(select(
-        [   func.ST_AsGeoJSON(dd.c.coordinate).label("geojson"),
+    return trace_points(db.engine.execute(select(
+        coordinate_lonlat(dd.c.coordinate) + [
             dd.c.time,
             legs.c.activity,
             legs.c.line_type,
@@ -840,7 +966,7 @@ def get_filtered_device_data_points(user_id, datetime_start, datetime_end):
             legs.c.device_id == dd.c.device_id,
             between(dd.c.time, legs.c.time_start, legs.c.time_end),
             or_(legs.c.prev_end == None, dd.c.time > legs.c.prev_end))),
-        order_by=dd.c.time))
+        order_by=dd.c.time)))
 
 
 def get_filtered_device_data_points_OLD(user_id, datetime_start, datetime_end):
@@ -865,7 +991,8 @@ def get_filtered_device_data_points_OLD(user_id, datetime_start, datetime_end):
 def data_points_by_user_id_after(user_id, datetime_start, datetime_end):
     query = '''
         SELECT device_id,
-            ST_AsGeoJSON(coordinate) AS geojson,
+            ST_X(coordinate::geometry) AS lon,
+            ST_Y(coordinate::geometry) AS lat,
             activity_1, activity_1_conf,
             activity_2, activity_2_conf,
             activity_3, activity_3_conf,
@@ -878,7 +1005,7 @@ def data_points_by_user_id_after(user_id, datetime_start, datetime_end):
         ORDER BY time ASC
     '''
     points =  db.engine.execute(text(query), user_id=user_id, time_start=datetime_start, time_end=datetime_end)
-    return points
+    return trace_points(points)
 
 def data_points_snapping(device_id, datetime_start, datetime_end):
     qstart = '''
@@ -1386,17 +1513,10 @@ def verify_user_id(user_id):
 
 
 def verify_device_token(token):
-    try:
-        query = select([devices_table.c.id]) \
-            .where(devices_table.c.token==token)
-        row = db.engine.execute(query).first()
-
-        if not row:
-            abort(403)
-        return row[0]
-    except DataError as e:
-        print 'Exception: ' + e.message
+    ids = get_session_ids(token)
+    if ids is None:
         abort(403)
+    return ids[0]
 
 
 def update_last_activity(devices_table_id, client_version):
@@ -1424,17 +1544,55 @@ def update_messaging_token(devices_table_id, new_msg_token):
     db.engine.execute(update)
 
 
-def get_device_table_id_for_session(session_token):
+# Session token -> (devices.id, users.id). A token is issued once per device
+# and never reassigned, so entries only go stale when a device or user row is
+# deleted by hand; the cache is per process, so such a token keeps working in
+# each server process until its entry expires, SESSION_CACHE_TTL at most.
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _session_key(session_token):
+    """Canonical form of a session token, or None if not a valid UUID."""
     try:
-        query = select([devices_table.c.id]) \
-            .where(devices_table.c.token==session_token)
-        row = db.engine.execute(query).first()
-        if not row:
-            return -1
-        return int(row[0])
-    except DataError:
-        # invalid session token
+        return str(parse_uuid(session_token))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def get_session_ids(session_token):
+    """
+    :param session_token: devices.token
+    :return: (devices.id, users.id), or None for an unknown token
+    """
+    key = _session_key(session_token)
+    if key is None:
+        return None
+    ids = session_cache.get(key)
+    if ids is not None:
+        return ids
+    query = select([devices_table.c.id, devices_table.c.user_id]) \
+        .where(devices_table.c.token==key)
+    row = db.engine.execute(query).first()
+    if not row:
+        return None
+    ids = int(row[0]), int(row[1])
+    session_cache.set(key, ids)
+    return ids
+
+
+def get_device_table_id_for_session(session_token):
+    ids = get_session_ids(session_token)
+    if ids is None:
         return -1
+    return ids[0]
+
+
+def get_user_id_for_session(session_token):
+    ids = get_session_ids(session_token)
+    if ids is None:
+        return -1
+    return ids[1]
+
 
 def get_user_id_from_device_id(device_id):
     """
@@ -1573,8 +1731,590 @@ def devices_table_insert(
     return db.engine.execute(device_insertion).scalar()
 
 
+def authenticate_device(
+        user_id, device_id, installation_id, client_version, messaging_token):
+    """Update activity, client version and messaging token of a registered
+    device and log the authentication, all in one statement.
+
+    :return: (devices.id, users.id, session token), or None if the user or
+        device is not registered
+    """
+    return db.engine.execute(text("""
+        WITH device AS (
+            UPDATE devices d SET
+                last_activity = :now,
+                client_version = :client_version,
+                messaging_token = CASE WHEN length(:messaging_token) > 1
+                    THEN :messaging_token ELSE d.messaging_token END
+            FROM users u
+            WHERE u.user_id = :user_id
+                AND d.user_id = u.id
+                AND d.device_id = :device_id
+                AND d.installation_id = :installation_id
+            RETURNING d.id, d.user_id, d.token
+        ), log AS (
+            INSERT INTO client_log (device_id, user_id, function, info)
+            SELECT id, user_id, 'MOBILE-AUTHENTICATE', :info FROM device
+        )
+        SELECT id, user_id, token FROM device"""),
+        now=datetime.datetime.now(),
+        user_id=user_id,
+        device_id=device_id,
+        installation_id=installation_id,
+        client_version=client_version,
+        messaging_token=messaging_token or "",
+        info="ClientVersion:" + (client_version or "")).first()
+
+
+def register_device(
+        user_id, refresh_token, access_token, device_id, installation_id,
+        device_model, client_version):
+    """Create or update the user and device, and log the registration, all
+    in one statement. A new device gets a new session token.
+
+    :return: (devices.id, users.id, session token)
+    """
+    query = text("""
+        WITH old_user AS (
+            UPDATE users SET
+                google_refresh_token = :refresh_token,
+                google_server_access_token = :access_token
+            WHERE user_id = :user_id
+            RETURNING id
+        ), new_user AS (
+            INSERT INTO users (
+                user_id, google_refresh_token, google_server_access_token)
+            SELECT :user_id, :refresh_token, :access_token
+            WHERE NOT EXISTS (SELECT 1 FROM old_user)
+            RETURNING id
+        ), usr AS (
+            SELECT id FROM old_user UNION ALL SELECT id FROM new_user
+        ), old_device AS (
+            UPDATE devices d SET
+                last_activity = :now,
+                client_version = :client_version
+            FROM usr
+            WHERE d.user_id = usr.id
+                AND d.device_id = :device_id
+                AND d.installation_id = :installation_id
+            RETURNING d.id, d.user_id, d.token
+        ), new_device AS (
+            INSERT INTO devices (
+                user_id, device_id, installation_id, device_model, token,
+                client_version)
+            SELECT id, :device_id, :installation_id, :device_model, :token,
+                :client_version
+            FROM usr
+            WHERE NOT EXISTS (SELECT 1 FROM old_device)
+            RETURNING id, user_id, token
+        ), device AS (
+            SELECT * FROM old_device UNION ALL SELECT * FROM new_device
+        ), log AS (
+            INSERT INTO client_log (device_id, user_id, function, info)
+            SELECT id, user_id, 'MOBILE-REGISTER', :info FROM device
+        )
+        SELECT id, user_id, token FROM device""")
+
+    params = dict(
+        now=datetime.datetime.now(),
+        user_id=user_id,
+        refresh_token=refresh_token,
+        access_token=access_token,
+        device_id=device_id,
+        installation_id=installation_id,
+        device_model=device_model,
+        token=uuid4().hex,
+        client_version=client_version,
+        info="ClientVersion:" + (client_version or ""))
+
+    try:
+        return db.engine.execute(query, **params).first()
+    except IntegrityError as e:
+        if getattr(e.orig, 'pgcode', None) != UNIQUE_VIOLATION:
+            raise
+        # Raced with a concurrent registration of the same user or device,
+        # whose rows are visible now
+        return db.engine.execute(query, **params).first()
+
+
+# Array parameters of device_data_table_insert, the point of index i
+device_data_insert_rows = """(SELECT
+        (CAST(:device_id AS integer[]))[i] device_id,
+        (CAST(:coordinate AS text[]))[i] coordinate,
+        (CAST(:accuracy AS float8[]))[i] accuracy,
+        (CAST(:time AS timestamp[]))[i] "time",
+        (CAST(:activity_1 AS text[]))[i] activity_1,
+        (CAST(:activity_1_conf AS integer[]))[i] activity_1_conf,
+        (CAST(:activity_2 AS text[]))[i] activity_2,
+        (CAST(:activity_2_conf AS integer[]))[i] activity_2_conf,
+        (CAST(:activity_3 AS text[]))[i] activity_3,
+        (CAST(:activity_3_conf AS integer[]))[i] activity_3_conf
+    FROM generate_series(1, :n) i) n"""
+
+
+def _device_data_insert_month(t, month, points):
+    """Insert points of one month not already stored, into the partition of
+    the month if there is one, else into the parent."""
+    target = device_data_partition_name(month)
+    if not _relation_exists(t, target):
+        target = "device_data"
+
+    # Bypasses the routing trigger and the rule, which would look up the
+    # partition and probe every partition for a duplicate row by row. The
+    # month bounds limit the check to the parent and the one partition.
+    start, end = _month_range(month)
+    params = dict(
+        (c, [p[c] for p in points]) for c in device_data_copy_columns)
+    t.execute(text("""
+        INSERT INTO %(t)s (%(c)s)
+        SELECT n.device_id, CAST(n.coordinate AS geography), n.accuracy,
+            n.time,
+            CAST(n.activity_1 AS activity_type_enum), n.activity_1_conf,
+            CAST(n.activity_2 AS activity_type_enum), n.activity_2_conf,
+            CAST(n.activity_3 AS activity_type_enum), n.activity_3_conf
+        FROM %(rows)s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM device_data d
+            WHERE (d.device_id, d.time) = (n.device_id, n.time)
+                AND d.time >= :start AND d.time < :end)""" % {
+            "t": target,
+            "c": ", ".join(device_data_copy_columns),
+            "rows": device_data_insert_rows}),
+        n=len(points), start=start, end=end, **params)
+
+
 def device_data_table_insert(batch):
-    db.engine.execute(device_data_table.insert(batch))
+    """Insert device data points, skipping any already stored for the same
+    device and time. Coordinates are given as WKT. If a single point fails,
+    the whole batch fails."""
+
+    # Duplicates within the batch are dropped here, stored ones in SQL
+    seen = set()
+    months = {}
+    for point in batch:
+        key = point['device_id'], point['time']
+        if key not in seen:
+            seen.add(key)
+            month = point['time'].replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0)
+            months.setdefault(month, []).append(point)
+
+    def insert():
+        with db.engine.begin() as t:
+            for month in sorted(months):
+                _device_data_insert_month(t, month, months[month])
+
+    try:
+        insert()
+    except IntegrityError as e:
+        if getattr(e.orig, 'pgcode', None) != UNIQUE_VIOLATION:
+            raise
+        # Raced with a concurrent upload of the same points, which are
+        # visible now
+        insert()
+
+    devices_touch(set(key[0] for key in seen))
+
+
+def devices_touch(device_ids):
+    """Set last_activity of devices to now, so incremental jobs pick up
+    their new data. Must be called after the data is committed: a job
+    checking activity up to some time reads the data after that time, and
+    sees all data of devices touched before it."""
+    if not device_ids:
+        return
+    db.engine.execute(text("""
+        UPDATE devices SET last_activity = LOCALTIMESTAMP
+        WHERE id = ANY(:ids)"""), ids=sorted(device_ids))
+
+
+# Columns loaded by device_data_table_copy, in the order of the row tuples,
+# and by device_data_table_insert.
+device_data_copy_columns = (
+    'device_id', 'coordinate', 'accuracy', 'time',
+    'activity_1', 'activity_1_conf',
+    'activity_2', 'activity_2_conf',
+    'activity_3', 'activity_3_conf')
+
+
+def ewkb_point(lon, lat):
+    """Hex EWKB of a SRID 4326 point, accepted as is by geography input in
+    COPY, so no WKT parsing happens server-side."""
+    return '0101000020E6100000' + struct.pack('<dd', lon, lat).encode('hex')
+
+
+def _copy_text_value(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, float):
+        return repr(value) # str() would drop digits
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyTextReader(object):
+    """File-like object rendering rows into COPY text format as psycopg2
+    reads it, so a batch is encoded once and never held twice in memory."""
+
+    def __init__(self, rows):
+        self.lines = (
+            '\t'.join(_copy_text_value(x) for x in row) + '\n'
+            for row in rows)
+        self.buf = ''
+
+    def read(self, size=-1):
+        parts = [self.buf]
+        have = len(self.buf)
+        while size < 0 or have < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            have += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            self.buf = ''
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+
+@contextmanager
+def raw_transaction():
+    """DBAPI cursor in a transaction, for what SQLAlchemy doesn't wrap."""
+    conn = db.engine.raw_connection()
+    try:
+        yield conn.cursor()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def copy_rows(cursor, table_name, columns, rows):
+    """Load an iterable of row tuples into table_name with one COPY FROM
+    STDIN."""
+    cursor.copy_expert(
+        "COPY %s (%s) FROM STDIN" % (table_name, ", ".join(columns)),
+        _CopyTextReader(rows))
+
+
+def device_data_table_copy(rows):
+    """Bulk load device data with COPY, skipping points already stored for
+    the same device and time. Rows are tuples ordered as
+    device_data_copy_columns, with the coordinate given by ewkb_point. If a
+    single point fails, the whole batch fails."""
+
+    columns = ", ".join(device_data_copy_columns)
+    with raw_transaction() as cursor:
+        # COPY bypasses rules and would fail on duplicates, so stage it
+        cursor.execute("""
+            CREATE TEMP TABLE device_data_copy ON COMMIT DROP AS
+            SELECT %s FROM device_data LIMIT 0""" % columns)
+        copy_rows(cursor, 'device_data_copy', device_data_copy_columns, rows)
+
+        # Insert each month straight into its partition if there is one,
+        # rather than through the routing trigger and the rule probing every
+        # partition. Duplicates may also be in the parent until
+        # partition_device_data has moved them; the literal month bounds
+        # limit the check to the parent and the one partition.
+        cursor.execute("""
+            SELECT DISTINCT date_trunc('month', time) FROM device_data_copy""")
+        for month, in cursor.fetchall():
+            target = device_data_partition_name(month)
+            cursor.execute(
+                "SELECT 1 FROM pg_class "
+                "WHERE relname = %s AND pg_table_is_visible(oid)", (target,))
+            if cursor.fetchone() is None:
+                target = "device_data"
+
+            start, end = _month_range(month)
+            insert = cursor.mogrify("""
+                INSERT INTO %(t)s (%(c)s)
+                SELECT DISTINCT ON (device_id, time) %(c)s
+                FROM device_data_copy n
+                WHERE time >= %%(start)s AND time < %%(end)s AND NOT EXISTS (
+                    SELECT 1 FROM device_data d
+                    WHERE (d.device_id, d.time) = (n.device_id, n.time)
+                        AND d.time >= %%(start)s AND d.time < %%(end)s)
+                ORDER BY device_id, time""" % {"t": target, "c": columns},
+                {"start": start, "end": end})
+
+            cursor.execute("SAVEPOINT device_data_copy")
+            try:
+                cursor.execute(insert)
+            except psycopg2.IntegrityError as e:
+                if e.pgcode != UNIQUE_VIOLATION:
+                    raise
+                # Raced with a concurrent upload; retry on a fresh snapshot
+                cursor.execute("ROLLBACK TO SAVEPOINT device_data_copy")
+                cursor.execute(insert)
+
+        cursor.execute("SELECT DISTINCT device_id FROM device_data_copy")
+        device_ids = [row[0] for row in cursor.fetchall()]
+
+    devices_touch(device_ids)
+
+
+# Columns loaded by mass_transit_data_copy, in the order of the row tuples.
+mass_transit_data_copy_columns = (
+    'coordinate', 'time', 'line_type', 'line_name', 'vehicle_ref')
+
+
+def mass_transit_data_copy(rows):
+    """Bulk load vehicle positions with COPY, skipping those already stored
+    for the same vehicle and time. Rows are tuples ordered as
+    mass_transit_data_copy_columns, with the coordinate given by ewkb_point."""
+
+    columns = ", ".join(mass_transit_data_copy_columns)
+    with raw_transaction() as cursor:
+        # COPY bypasses the duplicate_ignore rule, so stage it
+        cursor.execute("""
+            CREATE TEMP TABLE mass_transit_data_copy ON COMMIT DROP AS
+            SELECT %s FROM mass_transit_data LIMIT 0""" % columns)
+        copy_rows(
+            cursor, 'mass_transit_data_copy', mass_transit_data_copy_columns,
+            rows)
+        cursor.execute("""
+            INSERT INTO mass_transit_data (%(c)s)
+            SELECT DISTINCT ON (vehicle_ref, time) %(c)s
+            FROM mass_transit_data_copy n
+            WHERE NOT EXISTS (
+                SELECT 1 FROM mass_transit_data d
+                WHERE (d.time, d.vehicle_ref) = (n.time, n.vehicle_ref))
+            ORDER BY vehicle_ref, time""" % {"c": columns})
+
+
+# mass_transit_data is partitioned by day and device_data by month through
+# inheritance. Partitions are named by period, with a check constraint on
+# time for constraint exclusion, so that queries bounded by time only scan
+# the partitions in range. Inserts into the parent are routed to the
+# partition by trigger; rows of periods without a partition stay in the
+# parent.
+
+partition_route_function = """
+CREATE OR REPLACE FUNCTION %(table)s_route() RETURNS trigger AS $$
+DECLARE
+    part text := '%(table)s_' || to_char(NEW.time, '%(format)s');
+BEGIN
+    IF NOT EXISTS (
+            SELECT 1 FROM pg_class
+            WHERE relname = part AND pg_table_is_visible(oid)) THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE 'INSERT INTO ' || quote_ident(part) || ' SELECT ($1).*' USING NEW;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""
+
+
+def _install_partition_route(table, format):
+    """Create or replace the routing trigger of table, partitions named by
+    to_char format of time."""
+    db.engine.execute(text(
+        partition_route_function % {"table": table, "format": format}))
+    if not db.engine.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = :name"),
+            name=table + "_route").first():
+        db.engine.execute("""
+            CREATE TRIGGER %(table)s_route
+            BEFORE INSERT ON %(table)s
+            FOR EACH ROW EXECUTE PROCEDURE %(table)s_route()"""
+            % {"table": table})
+
+
+def _relation_exists(t, name):
+    return t.execute(text(
+        "SELECT 1 FROM pg_class "
+        "WHERE relname = :name AND pg_table_is_visible(oid)"),
+        name=name).first() is not None
+
+
+def _partition_names(table):
+    return sorted(x[0] for x in db.engine.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:table AS regclass)"""), table=table))
+
+
+def _create_partition(table, name, start, end, indexes):
+    """Create partition name of table for time in [start, end) unless it
+    exists, with indexes given as (suffix, definition) pairs. Return whether
+    it was created."""
+    # Waiting for the lock queues behind running inserts and blocks new
+    # ones, so only take it when there is something to create
+    if _relation_exists(db.engine, name):
+        return False
+    with db.engine.begin() as t:
+        # Serialize with other creators
+        t.execute("LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE" % table)
+        if _relation_exists(t, name):
+            return False
+        t.execute(text("""
+            CREATE TABLE %(name)s (
+                CHECK (time >= :start AND time < :end))
+            INHERITS (%(table)s)""" % {"name": name, "table": table}),
+            start=start, end=end)
+        for suffix, definition in indexes:
+            t.execute(definition % {
+                "index": name + "_" + suffix, "name": name})
+    return True
+
+
+def _drop_partition(table, name):
+    with db.engine.begin() as t:
+        t.execute("ALTER TABLE %s NO INHERIT %s" % (name, table))
+        t.execute("DROP TABLE %s" % name)
+
+
+def _move_rows(table, name, start, end):
+    """Move rows with time in [start, end) stored in the parent table into
+    partition name. Return the number of rows moved."""
+    with db.engine.begin() as t:
+        return t.execute(text("""
+            WITH moved AS (
+                DELETE FROM ONLY %(table)s
+                WHERE time >= :start AND time < :end
+                RETURNING *)
+            INSERT INTO %(name)s SELECT * FROM moved"""
+                % {"table": table, "name": name}),
+            start=start, end=end).rowcount
+
+
+mass_transit_data_partition_indexes = (
+    ("time_vehicle_ref",
+        "CREATE UNIQUE INDEX %(index)s ON %(name)s (time, vehicle_ref)"),
+    ("time_coordinate",
+        "CREATE INDEX %(index)s ON %(name)s (time, coordinate)"))
+
+
+device_data_partition_indexes = (
+    ("device_id_time",
+        "CREATE UNIQUE INDEX %(index)s ON %(name)s (device_id, time)"),
+    # Points arrive roughly in time order, so until the partition is
+    # compacted, a small BRIN index prunes about as well as a btree
+    ("time_brin", "CREATE INDEX %(index)s ON %(name)s USING brin (time)"),
+    ("id", "CREATE UNIQUE INDEX %(index)s ON %(name)s (id)"),
+    ("snapping_time_null",
+        "CREATE INDEX %(index)s ON %(name)s (snapping_time) "
+        "WHERE snapping_time IS NULL"))
+
+
+def device_data_partition_name(month):
+    return "device_data_" + month.strftime("%Y%m")
+
+
+def _month_range(month):
+    start = datetime.datetime(month.year, month.month, 1)
+    end = datetime.datetime(
+        month.year + month.month // 12, month.month % 12 + 1, 1)
+    return start, end
+
+
+def device_data_partitions():
+    """First days of months of existing device_data partitions, in order."""
+    return [
+        datetime.datetime.strptime(x[-6:], "%Y%m").date()
+        for x in _partition_names("device_data")]
+
+
+def device_data_create_partition(month):
+    """Create the device_data partition of the month of date month unless it
+    exists. Return whether it was created."""
+    return _create_partition(
+        "device_data", device_data_partition_name(month),
+        *_month_range(month), indexes=device_data_partition_indexes)
+
+
+def device_data_move_rows(start, end):
+    """Move rows with time in [start, end), within one month, stored in the
+    device_data parent into the partition of the month, which must exist.
+    Return the number of rows moved."""
+    return _move_rows(
+        "device_data", device_data_partition_name(start), start, end)
+
+
+def device_data_compact_partition(month):
+    """Compact the device_data partition of a month that no longer gets
+    many new points by clustering it by (device_id, time), so that reading a
+    device's trace touches few pages. Locks the partition for the duration.
+    Return False if already done.
+
+    The BRIN index on time is replaced with a btree. Once clustered by
+    device, time no longer follows the physical order, so the BRIN index
+    would span the whole month in every block range and prune nothing.
+    Partitions created before the BRIN index have a btree already."""
+
+    name = device_data_partition_name(month)
+    clustered = db.engine.execute(text("""
+        SELECT indisclustered FROM pg_index
+        WHERE indexrelid = CAST(:index AS regclass)"""),
+        index=name + "_device_id_time").scalar()
+    btree = _relation_exists(db.engine, name + "_time")
+    brin = _relation_exists(db.engine, name + "_time_brin")
+    if clustered and btree and not brin:
+        return False
+
+    # In this order, an interrupted run leaves a time index to finish with
+    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        if not clustered:
+            conn.execute(
+                "CLUSTER %(n)s USING %(n)s_device_id_time" % {"n": name})
+        if not btree:
+            conn.execute(
+                "CREATE INDEX %(n)s_time ON %(n)s (time)" % {"n": name})
+        if brin:
+            conn.execute("DROP INDEX %s_time_brin" % name)
+        conn.execute("ANALYZE %s" % name)
+    finally:
+        conn.close()
+    return True
+
+
+def mass_transit_data_partition_name(day):
+    return "mass_transit_data_" + day.strftime("%Y%m%d")
+
+
+def _day_range(day):
+    start = datetime.datetime.combine(day, datetime.time())
+    return start, start + timedelta(days=1)
+
+
+def mass_transit_data_partitions():
+    """Days of existing mass_transit_data partitions, in order."""
+    return [
+        datetime.datetime.strptime(x[-8:], "%Y%m%d").date()
+        for x in _partition_names("mass_transit_data")]
+
+
+def mass_transit_data_create_partition(day):
+    """Create the mass_transit_data partition of day unless it exists.
+    Return whether it was created."""
+    return _create_partition(
+        "mass_transit_data", mass_transit_data_partition_name(day),
+        *_day_range(day), indexes=mass_transit_data_partition_indexes)
+
+
+def mass_transit_data_drop_partition(day):
+    """Detach and drop the mass_transit_data partition of day."""
+    _drop_partition(
+        "mass_transit_data", mass_transit_data_partition_name(day))
+
+
+def mass_transit_data_move_day(day):
+    """Move rows of day stored in the mass_transit_data parent into its
+    partition, which must exist. Return the number of rows moved."""
+    return _move_rows(
+        "mass_transit_data", mass_transit_data_partition_name(day),
+        *_day_range(day))
+
 
 def device_data_filtered_table_insert(batch):
     db.engine.execute(device_data_filtered_table.insert(batch))
@@ -1592,11 +2332,82 @@ def db_engine_execute(query):
     return db.engine.execute(query)
 
 
-def device_data_delete_duplicates():
+def device_data_delete_duplicates(tstart=None, tend=None):
+    """Delete duplicate device_data points with time in [tstart, tend),
+    unbounded where None, keeping the first stored."""
     with open('sql/delete_duplicate_device_data.sql', 'r') as sql_file:
-        return db_engine_execute(text(sql_file.read())).rowcount
+        return db.engine.execute(
+            text(sql_file.read()), tstart=tstart, tend=tend).rowcount
+
+
+def device_data_unique_index_valid():
+    """Whether the (device_id, time) index of device_data is unique."""
+    return bool(db.engine.execute(text("""
+        SELECT indisunique AND indisvalid FROM pg_index
+        WHERE indexrelid = 'idx_device_data_device_id_time'::regclass
+        """)).scalar())
+
+
+def device_data_make_unique_index():
+    """Replace the (device_id, time) index of device_data with a unique one
+    without blocking writes. Fails if duplicates remain."""
+    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        # Leftover from an earlier failed attempt would be invalid
+        conn.execute(
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_device_data_device_id_time_u")
+        conn.execute("""
+            CREATE UNIQUE INDEX CONCURRENTLY idx_device_data_device_id_time_u
+            ON device_data (device_id, time)""")
+    finally:
+        conn.close()
+    with db.engine.begin() as t:
+        t.execute("DROP INDEX idx_device_data_device_id_time")
+        t.execute("""
+            ALTER INDEX idx_device_data_device_id_time_u
+            RENAME TO idx_device_data_device_id_time""")
 
 
 def device_data_waypoint_snapping():
     with open('sql/snapping.sql') as sql_file:
         return db.engine.execute(text(sql_file.read())).rowcount
+
+
+def snapping_roads():
+    """(osm_id, GeoJSON) of all roads."""
+    return db.engine.execute(text(
+        "SELECT osm_id, ST_AsGeoJSON(geo) FROM roads")).fetchall()
+
+
+def snapping_waypoints():
+    """(road id, waypoint id, lon, lat) of all waypoints of roads."""
+    return db.engine.execute(text("""
+        SELECT rw.road_id, w.id, ST_X(w.geo::geometry), ST_Y(w.geo::geometry)
+        FROM roads_waypoints rw
+        JOIN waypoints w ON w.id = rw.waypoint_id""")).fetchall()
+
+
+def device_data_unsnapped(limit):
+    """Up to limit (id, lon, lat) of device data not yet snapped."""
+    return db.engine.execute(text("""
+        SELECT id, ST_X(coordinate::geometry), ST_Y(coordinate::geometry)
+        FROM device_data
+        WHERE snapping_time IS NULL
+        LIMIT :limit"""), limit=limit).fetchall()
+
+
+def device_data_set_waypoints(snapped):
+    """Store (id, waypoint id) pairs of device data as snapped now, with one
+    UPDATE. Return the number of rows updated."""
+
+    if not snapped:
+        return 0
+    with raw_transaction() as cursor:
+        values = ",".join(
+            cursor.mogrify("(%s::bigint, %s::bigint)", x) for x in snapped)
+        cursor.execute("""
+            UPDATE device_data d
+            SET waypoint_id = v.waypoint_id, snapping_time = now()
+            FROM (VALUES %s) v (id, waypoint_id)
+            WHERE d.id = v.id""" % values)
+        return cursor.rowcount
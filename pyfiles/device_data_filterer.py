@@ -1,16 +1,17 @@
 import json
 
-from itertools import chain
+import numpy as np
 
 from pyfiles.common_helpers import (
     get_distance_between_coordinates,
     pairwise,
+    point_coordinates,
     point_distance,
     point_interval,
     trace_center,
-    trace_discard_inaccurate,
-    trace_discard_sidesteps,
-    trace_partition_movement)
+    trace_discard_inaccurate)
+
+from pyfiles.leg_detector import LegDetector
 
 from pyfiles.constants import (
     ACTIVITY_WIN,
@@ -27,6 +28,7 @@ from pyfiles.constants import (
     STOP_BREAK_INTERVAL)
 
 from pyfiles.database_interface import (
+    activity_types,
     device_data_filtered_table_insert,
     match_mass_transit_filtered,
     match_mass_transit_legs,
@@ -39,6 +41,43 @@ from pyfiles.mass_transit_match_planner import (
 # if enabled, records matching results of each user in a separate csv file
 DUMP_CSV_FILES = False
 
+
+def activity_window_sums(points, halfwin, types):
+    """Sums of activity confidences over the points less than halfwin seconds
+    after and at most halfwin seconds before each point, as an (n, len(types))
+    array with columns in types order, and a boolean array of the same shape
+    telling which types have occurred in any point up to the window end.
+
+    Points list activities in activity_1..3 and confidences in the matching
+    _conf keys; a type listed twice in a point counts with its last
+    confidence. Points must be in time order."""
+
+    n = len(points)
+    k = len(types)
+    column = dict((t, i) for i, t in enumerate(types))
+
+    # Row i + 1 holds point i, so that prefix sums start from zero
+    conf = np.zeros((n + 1, k), dtype=np.int64)
+    seen = np.zeros((n + 1, k), dtype=bool)
+    us = np.empty(n, dtype=np.int64)
+    for i, p in enumerate(points):
+        dt = p["time"] - points[0]["time"]
+        us[i] = (dt.days * 86400 + dt.seconds) * 10**6 + dt.microseconds
+        for slot in ("activity_1", "activity_2", "activity_3"):
+            j = column.get(p[slot])
+            if j is not None:
+                conf[i + 1, j] = p[slot + "_conf"] or 0
+                seen[i + 1, j] = True
+
+    win = halfwin * 10**6
+    head = np.searchsorted(us, us + win, "left")
+    tail = np.searchsorted(us, us - win, "left")
+
+    conf = conf.cumsum(axis=0)
+    seen = np.maximum.accumulate(seen, axis=0)
+    return conf[head] - conf[tail], seen[head]
+
+
 class DeviceDataFilterer:
 
     def __init__(self):
@@ -98,87 +137,110 @@ class DeviceDataFilterer:
         return matches
 
 
-    def generate_device_legs(self, points, start=None):
+    def generate_device_legs(self, points, start=None, detector=None):
         """Generate sequence of stationary and moving segments of same activity
         from the raw trace of one device. Legs found in points before the start
-        time, if given, are not emitted."""
+        time, if given, are not emitted.
 
-        # Filter out bogus location points.
-        points = trace_discard_sidesteps(points, BAD_LOCATION_RADIUS)
+        If detector is given, continue from its state. Legs that no later
+        points can change are generated first; detector.checkpoint is then set
+        to the state to continue from with later points, and the legs of the
+        trailing segments generated last."""
 
-        lastpt = None
+        if detector is None:
+            detector = self.leg_detector()
 
-        # Ignore undecided points between segments
-        partitioned = ((mov, seg) for (mov, seg) in trace_partition_movement(
-                points,
-                DEST_RADIUS_MAX,
-                DEST_DURATION_MIN,
-                STOP_BREAK_INTERVAL)
-            if mov is not None)
+        for ms, nextms in detector.push(points):
+            for leg in self._segment_legs(detector, ms, nextms, start):
+                yield leg
 
-        # Partition stationary and moving spans, with peekahead to next item
-        for ms, nextms in pairwise(chain(partitioned, [(None, None)])):
-            (mov, seg), (nextmov, nextseg) = (ms, nextms)
+        detector.checkpoint = detector.dumps()
 
-            # Emit stationary span, with rough centre as coordinate_start.
-            if not mov:
-                if len(seg) < 2:
-                    continue
+        for ms, nextms in detector.finish():
+            for leg in self._segment_legs(detector, ms, nextms, start):
+                yield leg
 
-                lastpt = seg[-1]
 
-                if start and seg[0]["time"] < start:
-                    continue
+    def leg_detector(self, state=None):
+        """LegDetector for generate_device_legs, continuing from serialized
+        state if given."""
+        args = (
+            BAD_LOCATION_RADIUS,
+            DEST_RADIUS_MAX,
+            DEST_DURATION_MIN,
+            STOP_BREAK_INTERVAL)
+        if state is not None:
+            return LegDetector.loads(state, *args)
+        return LegDetector(*args)
 
-                yield {
-                    "time_start": seg[0]["time"],
-                    "time_end": seg[-1]["time"],
-                    "geojson_start": json.dumps({
-                        "type": "Point",
-                        "coordinates": trace_center(trace_discard_inaccurate(
-                            seg, DEST_RADIUS_MAX / 2))}),
-                    "activity": "STILL"}, {}
-                continue
 
-            # Join move segment to subsequent stop if it comes soon enough
-            if nextmov is False and point_interval(
-                    seg[-1], nextseg[0]) <= MAX_POINT_TIME_DIFFERENCE:
-                seg.append(nextseg[0])
+    def _segment_legs(self, detector, ms, nextms, start):
+        """Generate legs of segment ms, followed by nextms."""
 
-            # Feed moving span to activity stabilizer, mass transit detection.
-            # This loses unstabilizable point spans.
-            for legpts, legact in self._analyse_unfiltered_data(seg):
+        (mov, seg), (nextmov, nextseg) = (ms, nextms)
 
-                # Inaccurate points can be useful at the activity detection
-                # stage, but for mass transit matching and clustering, location
-                # needs to be more accurate.
-                legpts = list(trace_discard_inaccurate(
-                    legpts, DEST_RADIUS_MAX / 2))
+        # Emit stationary span, with rough centre as coordinate_start.
+        if not mov:
+            if len(seg) < 2:
+                return
 
-                if len(legpts) < 2:
-                    continue # too few points to make a move, drop leg
+            detector.lastpt = seg[-1]
+            detector.legs_end = seg[-1]["time"]
 
-                # Join to previous leg on shared point if close enough in time
-                if lastpt and point_interval(
-                        lastpt, legpts[0]) <= MAX_POINT_TIME_DIFFERENCE:
-                    legpts.insert(0, lastpt)
-                lastpt = legpts[-1]
+            if start and seg[0]["time"] < start:
+                return
 
-                if start and legpts[0]["time"] < start:
-                    continue
+            yield {
+                "time_start": seg[0]["time"],
+                "time_end": seg[-1]["time"],
+                "geojson_start": json.dumps({
+                    "type": "Point",
+                    "coordinates": trace_center(trace_discard_inaccurate(
+                        seg, DEST_RADIUS_MAX / 2))}),
+                "activity": "STILL"}, {}
+            return
 
-                km = .001 * sum(
-                    point_distance(p0, p1) for p0, p1 in pairwise(legpts))
+        # Join move segment to subsequent stop if it comes soon enough
+        if nextmov is False and point_interval(
+                seg[-1], nextseg[0]) <= MAX_POINT_TIME_DIFFERENCE:
+            seg.append(nextseg[0])
+
+        # Feed moving span to activity stabilizer, mass transit detection.
+        # This loses unstabilizable point spans.
+        for legpts, legact in self._analyse_unfiltered_data(seg):
+
+            # Inaccurate points can be useful at the activity detection
+            # stage, but for mass transit matching and clustering, location
+            # needs to be more accurate.
+            legpts = list(trace_discard_inaccurate(
+                legpts, DEST_RADIUS_MAX / 2))
+
+            if len(legpts) < 2:
+                continue # too few points to make a move, drop leg
+
+            # Join to previous leg on shared point if close enough in time
+            lastpt = detector.lastpt
+            if lastpt and point_interval(
+                    lastpt, legpts[0]) <= MAX_POINT_TIME_DIFFERENCE:
+                legpts.insert(0, lastpt)
+            detector.lastpt = legpts[-1]
+            detector.legs_end = legpts[-1]["time"]
+
+            if start and legpts[0]["time"] < start:
+                continue
 
-                leg = {
-                    "time_start": legpts[0]["time"],
-                    "time_end": legpts[-1]["time"],
-                    "geojson_start": legpts[0]["geojson"],
-                    "geojson_end": legpts[-1]["geojson"],
-                    "activity": legact,
-                    "km": km}
+            km = .001 * sum(
+                point_distance(p0, p1) for p0, p1 in pairwise(legpts))
 
-                yield leg, self._match_mass_transit(legpts, legact, None)
+            leg = {
+                "time_start": legpts[0]["time"],
+                "time_end": legpts[-1]["time"],
+                "geojson_start": legpts[0]["geojson"],
+                "geojson_end": legpts[-1]["geojson"],
+                "activity": legact,
+                "km": km}
+
+            yield leg, self._match_mass_transit(legpts, legact, None)
 
 
     def generate_filtered_data(self, device_data_rows, user_id):
@@ -216,8 +278,8 @@ class DeviceDataFilterer:
             end_row = device_data_queue[trip_leg_points-1]
 
             # do the rest ...:
-            start_location = json.loads(start_row["geojson"])["coordinates"]
-            end_location = json.loads(end_row["geojson"])["coordinates"]
+            start_location = point_coordinates(start_row)
+            end_location = point_coordinates(end_row)
             start_time  = start_row['time']
             end_time  = end_row['time']
             distance = get_distance_between_coordinates(start_location, end_location) # TODO: should get 'distance' value from the calculated more realistic traveled distances
@@ -295,7 +357,7 @@ class DeviceDataFilterer:
         filtered_device_data = []
 
         for device_data_row in device_data_queue:
-            current_location = json.loads(device_data_row["geojson"])["coordinates"]
+            current_location = point_coordinates(device_data_row)
             filtered_device_data.append({"activity" : activity,
                                          "user_id" : user_id,
                                          'coordinate': 'POINT(%f %f)' % (float(current_location[0]), float(current_location[1])),
@@ -356,45 +418,38 @@ class DeviceDataFilterer:
 
 
     def _analyse_activities(self, points):
-
-        def activities(point):
-            return {
-                point["activity_1"]: point["activity_1_conf"] or 0,
-                point["activity_2"]: point["activity_2_conf"] or 0,
-                point["activity_3"]: point["activity_3_conf"] or 0}
-
-        def dseconds(p0, p1):
-            return (p1["time"] - p0["time"]).total_seconds()
+        """Generate (point, activity) pairs of points and the best activity
+        in the ACTIVITY_WIN window of summed confidences around each."""
 
         good_activities = ('IN_VEHICLE', 'ON_BICYCLE', 'RUNNING', 'WALKING')
         on_foot_activities = ('RUNNING', 'WALKING')
 
-        def best_activity(activities):
-            on_foot = False
-            for activity, cconf in activities.most_common():
-                if activity == "ON_FOOT":
-                    on_foot = True
-                elif on_foot and activity not in on_foot_activities:
-                    pass
-                elif activity in good_activities:
-                    return activity
-            if on_foot:
-                return "WALKING"
-            return "NOT_SET"
-
-        from collections import Counter
-        probs = Counter()
-        head = tail = 0
-        halfwin = ACTIVITY_WIN / 2
-        np = len(points)
-        for i in range(np):
-            while head < np and dseconds(points[i], points[head]) < halfwin:
-                probs.update(activities(points[head]))
-                head += 1
-            while tail < np and dseconds(points[tail], points[i]) > halfwin:
-                probs.subtract(activities(points[tail]))
-                tail += 1
-            yield points[i], best_activity(probs)
+        # Rank activities of each window by confidence sum, ties going to the
+        # earlier in activity_types, -1 for those not seen in the trace yet.
+        sums, seen = activity_window_sums(
+            points, ACTIVITY_WIN / 2, activity_types)
+        k = len(activity_types)
+        rank = np.where(seen, sums * k + np.arange(k - 1, -1, -1), -1)
+
+        def best_of(activities):
+            cols = rank[:, [activity_types.index(x) for x in activities]]
+            return (
+                np.array(activities)[cols.argmax(axis=1)].tolist(),
+                cols.max(axis=1))
+
+        good, good_rank = best_of(good_activities)
+        on_foot, on_foot_rank = best_of(on_foot_activities)
+        foot_rank = rank[:, activity_types.index("ON_FOOT")]
+
+        # The best good activity, unless ON_FOOT ranks above it; then the
+        # best on foot activity, or WALKING when none.
+        for i, point in enumerate(points):
+            if good_rank[i] > foot_rank[i]:
+                yield point, good[i]
+            elif foot_rank[i] >= 0:
+                yield point, on_foot_rank[i] >= 0 and on_foot[i] or "WALKING"
+            else:
+                yield point, "NOT_SET"
 
 
     def _dump_csv_file_open(self, user_id):
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""Write-behind spool for device data uploads.
+
+Validated upload batches are appended to a directory of fsync'ed segment
+files and acknowledged immediately. A background writer drains the
+segments into device_data, coalescing many uploads into one COPY. Segments
+left over from a previous run are picked up on start, so nothing
+acknowledged is lost on restart.
+
+Segment rows are JSON lists:
+    [device_id, lon, lat, accuracy, time_ms,
+     activity_1, activity_1_conf, activity_2, activity_2_conf,
+     activity_3, activity_3_conf]
+"""
+
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+from sqlalchemy.exc import DataError, IntegrityError, ProgrammingError
+
+from pyfiles.database_interface import device_data_table_copy, ewkb_point
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+TEMP_SUFFIX = ".tmp"
+QUARANTINE_SUFFIX = ".bad"
+
+# Errors that will not go away by retrying the same rows; COPY runs on a
+# raw connection so its errors come unwrapped from psycopg2
+PERMANENT_ERRORS = (
+    DataError, IntegrityError, ProgrammingError,
+    psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class DeviceDataSpool(object):
+
+    def __init__(self, directory, max_bytes, batch_rows=50000, interval=1.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.serial = 0
+        self.thread = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Several server processes may share the directory, only the one
+        # holding this lock drains it
+        self.lockfile = open(os.path.join(directory, "writer.lock"), "a")
+
+        self._sweep()
+        self._refresh(self._segments())
+
+    def _sweep(self):
+        """Remove partial segments left by writers that died mid-append,
+        telling those from the process id in the name."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(TEMP_SUFFIX):
+                continue
+            try:
+                pid = int(name.split("-")[1])
+            except (IndexError, ValueError):
+                continue
+            try:
+                os.kill(pid, 0)
+                continue # still running
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    continue # running as someone else
+            try:
+                os.unlink(os.path.join(self.directory, name))
+                log.info("removed stale spool file %s", name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _segments(self):
+        """Pending segments as (path, size) in arrival order."""
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                result.append((path, os.path.getsize(path)))
+            except OSError as e:
+                if e.errno != errno.ENOENT: # drained meanwhile
+                    raise
+        return result
+
+    def append(self, rows):
+        """Durably store an iterable of rows, raise SpoolFull when over
+        limit. Rows are written out as they come, if iterating them fails
+        nothing is stored."""
+
+        # Only the process draining the spool sees it shrink, others count
+        # again before refusing
+        with self.lock:
+            full = self.bytes >= self.max_bytes
+        if full:
+            self._refresh(self._segments())
+
+        with self.lock:
+            if self.bytes >= self.max_bytes:
+                raise SpoolFull()
+            self.serial += 1
+            # Time first so lexical order is arrival order
+            name = "%.6f-%d-%d" % (time.time(), os.getpid(), self.serial)
+
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path + TEMP_SUFFIX, "wb") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            os.rename(path + TEMP_SUFFIX, path + SEGMENT_SUFFIX)
+            dirfd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except:
+            if os.path.exists(path + TEMP_SUFFIX):
+                os.unlink(path + TEMP_SUFFIX)
+            raise
+
+        with self.lock:
+            self.bytes += size
+            self.segments += 1
+
+    def depth(self):
+        self._refresh(self._segments())
+        with self.lock:
+            return {
+                "segments": self.segments,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes}
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="device-data-spool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if not self._drain():
+                    time.sleep(self.interval)
+            except Exception:
+                log.exception("device data spool writer failed, retrying")
+                time.sleep(10 * self.interval)
+
+    def _drain(self):
+        """Load one coalesced batch, return whether anything was done."""
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        try:
+            segments = self._segments()
+            self._refresh(segments)
+
+            batch = []
+            rows = 0
+            for path, size in segments:
+                with open(path, "rb") as f:
+                    lines = f.read().splitlines()
+                batch.append((path, size, lines))
+                rows += len(lines)
+                if rows >= self.batch_rows:
+                    break
+            if not batch:
+                return False
+
+            try:
+                device_data_table_copy(
+                    copy_row(line) for _, _, lines in batch for line in lines)
+                done = batch
+            except PERMANENT_ERRORS:
+                # Find the bad segments, load the rest one by one
+                done = []
+                for seg in batch:
+                    try:
+                        device_data_table_copy(copy_row(x) for x in seg[2])
+                        done.append(seg)
+                    except PERMANENT_ERRORS:
+                        log.exception("quarantining spool segment %s", seg[0])
+                        os.rename(seg[0], seg[0] + QUARANTINE_SUFFIX)
+                        self._forget(seg[1])
+
+            for path, size, _ in done:
+                os.unlink(path)
+                self._forget(size)
+            return True
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def _forget(self, size):
+        with self.lock:
+            self.bytes -= size
+            self.segments -= 1
+
+    def _refresh(self, segments):
+        """Resync counts with the directory, other processes append too."""
+        with self.lock:
+            self.segments = len(segments)
+            self.bytes = sum(size for _, size in segments)
+
+
+def copy_row(line):
+    x = json.loads(line)
+    return (
+        x[0],
+        ewkb_point(x[1], x[2]),
+        x[3],
+        datetime.datetime.fromtimestamp(x[4] / 1000.0)) + tuple(x[5:])
@@ -0,0 +1,147 @@
+"""Rate limited reverse geocoding of place labels.
+
+Coordinates are quantized to geohash cells, and the geocoder is queried at
+the centre of each cell, so that one response serves every place in the
+cell and can be cached by the cell's geohash. Precision 7 cells are about
+150 m by 75 m in Finland, within DEST_RADIUS_MAX of their centre.
+
+Queries are started at most qps per second by a token bucket, in a pool of
+as many threads, so that up to qps queries are in flight at once while slow
+responses are waited on.
+"""
+
+import math
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+GEOHASH_PRECISION = 7
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_cell(lat, lon, precision=GEOHASH_PRECISION):
+    """Geohash of the cell containing lat, lon, and the lat, lon of its
+    centre."""
+    lats = [-90.0, 90.0]
+    lons = [-180.0, 180.0]
+    chars = []
+    even = True
+    bits = ch = 0
+    while len(chars) < precision:
+        interval, value = (lons, lon) if even else (lats, lat)
+        mid = (interval[0] + interval[1]) / 2
+        ch <<= 1
+        if value >= mid:
+            ch |= 1
+            interval[0] = mid
+        else:
+            interval[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[ch])
+            bits = ch = 0
+    return "".join(chars), sum(lats) / 2, sum(lons) / 2
+
+
+def response_label(response):
+    """Label of up to two distinct street or place names in a GeoJSON reverse
+    geocoding response, streets first; empty if none."""
+    names, nameslower = [], set()
+    for prop in ["street", "name"]:
+        for feat in response["features"]:
+            name = feat["properties"].get(prop)
+            name = name and name.split(",")[0]
+            if name and name.lower() not in nameslower:
+                names.append(name)
+                nameslower.add(name.lower())
+    return " / ".join(names[:2])
+
+
+class TokenBucket(object):
+    """Rate limiter handing out rate tokens per second, up to burst at once.
+    Tokens are reserved on take, so waiters are served in order."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait for a token."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ReverseGeocoder(object):
+
+    def __init__(self, url_template, qps, timeout):
+        """url_template takes lat and lon format fields, timeout is per
+        query in seconds."""
+        self.url_template = url_template
+        self.timeout = timeout
+        self.bucket = TokenBucket(qps)
+        self.workers = int(math.ceil(qps))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def label(self, lat, lon):
+        """Label at lat, lon, waiting for the rate limit."""
+        self.bucket.take()
+        return self._query(lat, lon)
+
+    def _query(self, lat, lon):
+        response = self.session.get(
+            self.url_template.format(lat=lat, lon=lon), timeout=self.timeout)
+        response.raise_for_status()
+        return response_label(response.json())
+
+    def labels(self, cells, deadline):
+        """Generate (geohash, label) of (geohash, lat, lon) cells in order of
+        completion. No queries are started after the deadline, a time.time()
+        value, or after one has failed; the error of the first failure is
+        raised once the ones in flight are done."""
+
+        stop = threading.Event()
+
+        def run(cell):
+            geohash, lat, lon = cell
+            if stop.is_set() or time.time() >= deadline:
+                return geohash, None, None
+            self.bucket.take()
+            if stop.is_set() or time.time() >= deadline:
+                return geohash, None, None
+            try:
+                return geohash, self._query(lat, lon), None
+            except Exception:
+                stop.set()
+                return geohash, None, sys.exc_info()
+
+        error = None
+        pool = ThreadPool(self.workers)
+        try:
+            for geohash, label, exc_info in pool.imap_unordered(run, cells):
+                if label is not None:
+                    yield geohash, label
+                error = error or exc_info
+        finally:
+            stop.set()
+            pool.close()
+            pool.join()
+        if error:
+            raise error[0], error[1], error[2]
@@ -29,6 +29,18 @@ log.setLevel(logging.INFO)
 debug_input = False
 save_alert_sample = False
 
+# Keep-alive connections for the frequent vehicle position polls
+hsl_vehicle_session = requests.Session()
+
+
+def hsl_vehicle_request(timeout=(5, 20)):
+    """VehicleActivity list of the HSL Siri vehicle monitoring feed."""
+    url = "http://api.digitransit.fi/realtime/vehicle-positions/v1/siriaccess/vm/json"
+    response = hsl_vehicle_session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()["Siri"]["ServiceDelivery"][
+        "VehicleMonitoringDelivery"][0]["VehicleActivity"]
+
 
 def hsl_alert_request():
     debug_input_filename = "pyfiles/HSLAlertSample.txt"
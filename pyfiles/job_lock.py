@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""PostgreSQL advisory lock guard for scheduler jobs.
+
+Jobs sharing a lock name never run at the same time, on this node or any
+other scheduler node using the same database. A guarded job either waits
+for the lock or skips its run if the lock is held. Locks are held on a
+connection of their own, so PostgreSQL releases them if the node dies,
+and another node can take over on its next run.
+
+While a job runs, its row in job_status shows the node running it, when it
+started and a periodically refreshed heartbeat. When several nodes fire the
+same schedule, skip_within makes all but the first skip, telling from the
+start time in job_status whether the job already ran.
+"""
+
+import os
+import socket
+import threading
+from functools import wraps
+
+from sqlalchemy.sql import text
+
+# First key of the two-key advisory locks taken here, to keep clear of any
+# other advisory lock use; the second is a hash of the lock name
+LOCK_CLASS = 0x5252
+
+HEARTBEAT_INTERVAL = 60
+
+
+class JobGuard(object):
+
+    def __init__(self, engine, owner=None, heartbeat=HEARTBEAT_INTERVAL):
+        self.engine = engine
+        self.owner = owner or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.heartbeat = heartbeat
+
+    def guard(self, function, lock=None, wait=False, skip_within=None):
+        """Wrap function to run under the advisory lock named lock, by
+        default the function name. With wait, block until the lock is free,
+        otherwise skip the run if it is held. With skip_within, a timedelta,
+        also skip if the job started that recently on any node."""
+
+        name = function.__name__
+        lock = lock or name
+
+        @wraps(function)
+        def guarded(*args, **kwargs):
+            conn = self.engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT")
+            try:
+                if wait:
+                    conn.execute(text(
+                        "SELECT pg_advisory_lock(:c, hashtext(:lock))"),
+                        c=LOCK_CLASS, lock=lock)
+                elif not conn.execute(text(
+                        "SELECT pg_try_advisory_lock(:c, hashtext(:lock))"),
+                        c=LOCK_CLASS, lock=lock).scalar():
+                    print "%s skipped, lock %s is held" % (name, lock)
+                    return
+                try:
+                    if skip_within and self._started_within(
+                            conn, name, skip_within):
+                        print "%s skipped, already started within %s" % (
+                            name, skip_within)
+                        return
+                    return self._run(conn, name, function, args, kwargs)
+                finally:
+                    conn.execute(text(
+                        "SELECT pg_advisory_unlock(:c, hashtext(:lock))"),
+                        c=LOCK_CLASS, lock=lock)
+            finally:
+                conn.close()
+
+        return guarded
+
+    def _started_within(self, conn, name, within):
+        return conn.execute(text("""
+            SELECT 1 FROM job_status
+            WHERE job = :job AND started > LOCALTIMESTAMP - :within"""),
+            job=name, within=within).first() is not None
+
+    def _run(self, conn, name, function, args, kwargs):
+        values = dict(job=name, owner=self.owner)
+        if not conn.execute(text("""
+                UPDATE job_status
+                SET owner = :owner, started = LOCALTIMESTAMP,
+                    heartbeat = LOCALTIMESTAMP, finished = NULL
+                WHERE job = :job"""), **values).rowcount:
+            conn.execute(text("""
+                INSERT INTO job_status (job, owner, started, heartbeat)
+                VALUES (:job, :owner, LOCALTIMESTAMP, LOCALTIMESTAMP)"""),
+                **values)
+
+        stop = threading.Event()
+        beat = threading.Thread(target=self._beat, args=(name, stop))
+        beat.daemon = True
+        beat.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stop.set()
+            beat.join()
+            conn.execute(text("""
+                UPDATE job_status
+                SET heartbeat = LOCALTIMESTAMP, finished = LOCALTIMESTAMP
+                WHERE job = :job"""), job=name)
+
+    def _beat(self, name, stop):
+        while not stop.wait(self.heartbeat):
+            try:
+                self.engine.execute(text("""
+                    UPDATE job_status SET heartbeat = LOCALTIMESTAMP
+                    WHERE job = :job"""), job=name)
+            except Exception as e:
+                print "%s heartbeat failed: %s" % (name, e)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""Lightweight instrumentation of scheduler jobs.
+
+A run collects timing spans, row counters and time spent in database calls
+for one job. These come from the thread running the job and from the
+threads it hands work to with adopt. When the run ends, it is stored in
+job_runs and printed as one JSON line starting with "job_run".
+
+Spans are aggregated by name into count, seconds and database seconds. For
+spans given a key, such as a device id, the slowest keys are kept too.
+Spans in the thread of the run also count the database time of the threads
+it hands work to.
+
+Outside a run, spans, counters and database statements cost a thread local
+lookup.
+"""
+
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from sqlalchemy import event
+from sqlalchemy.sql import text
+
+# Keyed spans kept per span name
+SLOWEST = 10
+
+_local = threading.local()
+
+
+class Run(object):
+
+    def __init__(self, job):
+        self.job = job
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.t0 = time.time()
+        self.seconds = None
+        self.db_seconds = 0.0
+        self.counters = {}
+        self.spans = {} # name: [count, seconds, db seconds]
+        self.slowest = {} # name: [(seconds, key)]
+
+    def add_span(self, name, key, seconds, db_seconds):
+        with self.lock:
+            s = self.spans.setdefault(name, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += seconds
+            s[2] += db_seconds
+            if key is not None:
+                slowest = self.slowest.setdefault(name, [])
+                slowest.append((seconds, key))
+                slowest.sort(reverse=True)
+                del slowest[SLOWEST:]
+
+    def summary(self, ok):
+        return {
+            "job": self.job,
+            "started": self.started.isoformat(),
+            "ok": ok,
+            "seconds": round(self.seconds, 3),
+            "db_seconds": round(self.db_seconds, 3),
+            "counters": self.counters,
+            "spans": dict(
+                (k, [c, round(s, 3), round(d, 3)])
+                for k, (c, s, d) in self.spans.iteritems()),
+            "slowest": dict(
+                (k, [[round(s, 3), key] for s, key in v])
+                for k, v in self.slowest.iteritems())}
+
+
+def current():
+    return getattr(_local, "run", None)
+
+
+def adopt(run):
+    """Attribute work of this thread to run, None to stop."""
+    _local.run = run
+
+
+def _thread_db_seconds():
+    return getattr(_local, "db_seconds", 0.0)
+
+
+def count(name, n=1):
+    run = current()
+    if run is None:
+        return
+    with run.lock:
+        run.counters[name] = run.counters.get(name, 0) + n
+
+
+@contextmanager
+def span(name, key=None):
+    run = current()
+    if run is None:
+        yield
+        return
+    own = run.thread is threading.current_thread()
+    t0 = time.time()
+    db0 = run.db_seconds if own else _thread_db_seconds()
+    try:
+        yield
+    finally:
+        db1 = run.db_seconds if own else _thread_db_seconds()
+        run.add_span(name, key, time.time() - t0, db1 - db0)
+
+
+def timed(function):
+    """Decorator running function in a span named after it."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrument(engine):
+    """Measure time of statements executed on engine within runs."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and current() is not None:
+            context.job_metrics_t0 = time.time()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        t0 = getattr(context, "job_metrics_t0", None)
+        run = current()
+        if t0 is None or run is None:
+            return
+        seconds = time.time() - t0
+        _local.db_seconds = _thread_db_seconds() + seconds
+        with run.lock:
+            run.db_seconds += seconds
+
+
+def recorded(engine, function):
+    """Wrap function to run as a job run, recorded when done."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        run = Run(function.__name__)
+        adopt(run)
+        ok = False
+        try:
+            result = function(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            adopt(previous)
+            run.seconds = time.time() - run.t0
+            _store(engine, run, ok)
+
+    return wrapper
+
+
+def _store(engine, run, ok):
+    summary = run.summary(ok)
+    print "job_run", json.dumps(summary, sort_keys=True)
+    try:
+        engine.execute(text("""
+            INSERT INTO job_runs (
+                job, started, ok, seconds, db_seconds, counters, spans)
+            VALUES (
+                :job, :started, :ok, :seconds, :db_seconds, :counters,
+                :spans)"""),
+            job=run.job,
+            started=run.started,
+            ok=ok,
+            seconds=run.seconds,
+            db_seconds=run.db_seconds,
+            counters=json.dumps(summary["counters"], sort_keys=True),
+            spans=json.dumps(
+                {"spans": summary["spans"], "slowest": summary["slowest"]},
+                sort_keys=True))
+    except Exception as e:
+        # Losing the record must not fail the job
+        print "job_run of %s not stored: %s" % (run.job, e)
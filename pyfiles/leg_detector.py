@@ -0,0 +1,417 @@
+"""Resumable version of the stop/move partitioning of generate_device_legs.
+
+The trace_discard_sidesteps, trace_split_sparse and trace_partition_movement
+generators of common_helpers read ahead in their input as far as they need,
+so they can only be run over a complete trace. The stages here take points
+one at a time instead, keep what they are waiting on as explicit state, and
+emit what is decided so far. The state serializes to a string, so that
+processing can continue from where it left off with only the points received
+since, giving the same result as running the generators over the whole
+trace.
+
+The activity stabilizer needs no state of its own here, it is run on
+complete move segments.
+"""
+
+import datetime
+import json
+from collections import deque
+
+from pyfiles.common_helpers import TracePoint, point_distance, point_interval
+
+POINT_KEYS = (
+    "lon", "lat", "accuracy", "time", "device_id",
+    "activity_1", "activity_1_conf",
+    "activity_2", "activity_2_conf",
+    "activity_3", "activity_3_conf")
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class _Stage(object):
+    """State attributes are listed in state, those holding deques in
+    deques."""
+
+    state = ()
+    deques = ()
+
+    def get_state(self):
+        return dict((k, getattr(self, k)) for k in self.state)
+
+    def set_state(self, state):
+        for k in self.state:
+            v = state[k]
+            setattr(self, k, deque(v) if k in self.deques else v)
+
+
+class _Sidesteps(_Stage):
+    """trace_discard_sidesteps, one point at a time."""
+
+    state = (
+        "previous", "buf", "pending", "moved", "smooth", "discard")
+    deques = ("pending", "moved", "smooth")
+
+    def __init__(self, badradius=None, factor=2):
+        self.badradius = badradius
+        self.factor = factor
+        self.previous = None # trace_discard_unmoved
+        self.buf = [] # trace_discard_single_sidesteps
+        self.pending = deque() # points not yet decided
+        self.moved = deque() # output of the former not yet matched
+        self.smooth = deque() # output of the latter not yet matched
+        self.discard = None
+
+    def _badness(self, p0, p1, p2):
+        d = point_distance
+        hyp = d(p0, p2)
+        return hyp and (d(p0, p1) + d(p1, p2)) / hyp or float("inf")
+
+    def _push_moved(self, p):
+        self.moved.append(p)
+        buf = self.buf
+        buf.append(p)
+        if len(buf) < 4:
+            return
+        badness1 = self._badness(*buf[0:3])
+        badness2 = self._badness(*buf[1:4])
+        if (point_distance(buf[0], buf[1]) > (
+                    buf[1]["accuracy"] if "accuracy" in buf[1] else 0)
+                and badness1 > self.factor
+                and (badness2 <= self.factor or badness1 <= badness2)):
+            buf.pop(1)
+            return
+        self.smooth.append(buf.pop(0))
+
+    def push(self, p):
+        self.pending.append(p)
+        previous = self.previous
+        if previous is not None:
+            r = p["accuracy"] if self.badradius is None else self.badradius
+            if point_distance(previous, p) <= r:
+                return self._resolve(False)
+            self._push_moved(previous)
+        self.previous = p
+        return self._resolve(False)
+
+    def finish(self):
+        if self.previous is not None:
+            self._push_moved(self.previous)
+            self.previous = None
+        buf = self.buf
+        if len(buf) == 3 and self._badness(*buf) > self.factor:
+            buf.pop(1)
+        self.smooth.extend(buf)
+        self.buf = []
+        return self._resolve(True)
+
+    def _resolve(self, final):
+        """Pass on pending points as far as it is known whether they are in
+        the moved and smooth streams."""
+        out = []
+        pending, moved, smooth = self.pending, self.moved, self.smooth
+        while pending:
+            p = pending[0]
+            if not moved and not final:
+                break
+            if moved and moved[0] is p:
+                if not smooth and not final:
+                    break
+                moved.popleft()
+                self.discard = True
+                if smooth and smooth[0] is p: # good overrides bad
+                    smooth.popleft()
+                    self.discard = False
+            pending.popleft()
+            if not self.discard:
+                out.append(p)
+        return out
+
+
+class _Partition(_Stage):
+    """trace_partition_movement_nobreak, one point at a time.
+
+    The point windows of the generator are kept in pts, indexed from base;
+    the iterators over it become indices."""
+
+    state = (
+        "allpts", "pts", "base", "cur", "head", "itail", "ihead",
+        "next_ihead", "entryend", "exitend", "entrymax", "exitmax",
+        "moveseg", "stopseg", "nextseg")
+    deques = ("allpts",)
+
+    def __init__(self, distance, interval):
+        self.distance = distance
+        self.interval = interval
+        self.allpts = deque() # all points, for restoring the dropped ones
+        self.pts = [] # accurate points
+        self.base = 0
+        self.cur = 0
+        self.head = 0
+        self.itail = 0
+        self.ihead = None
+        self.next_ihead = 0
+        self.entryend = self.exitend = None
+        self.entrymax = self.exitmax = -float("inf")
+        self.moveseg, self.stopseg, self.nextseg = [], [], []
+        self.probe = None # (cur, index) of head window end scan
+
+    def set_state(self, state):
+        _Stage.set_state(self, state)
+        self.probe = None
+
+    def push(self, p):
+        self.allpts.append(p)
+        # worst-case inaccurate point pair can break up a destination
+        if p["accuracy"] <= self.distance / 2:
+            self.pts.append(p)
+            return self._restore(self._run(False))
+        return []
+
+    def finish(self):
+        out = self._run(True)
+        if self.exitend is not None:
+            self.stopseg += self.nextseg
+        else:
+            self.moveseg += self.nextseg
+        if self.moveseg:
+            out.append((True, self.moveseg))
+        if self.stopseg:
+            out.append((False, self.stopseg))
+        out = self._restore(out)
+        if self.allpts:
+            out.append((None, list(self.allpts)))
+        self.allpts.clear()
+        return out
+
+    def _restore(self, segments):
+        """Put the dropped points back in, between and within segments."""
+        out = []
+        allpts = self.allpts
+        for mov, inseg in segments:
+            outseg = []
+            p = allpts.popleft()
+            while p is not inseg[0]:
+                outseg.append(p)
+                p = allpts.popleft()
+            if outseg:
+                out.append((None, outseg)) # undecided points
+                outseg = []
+            while p is not inseg[-1]:
+                outseg.append(p)
+                p = allpts.popleft()
+            outseg.append(p)
+            out.append((mov, outseg))
+        return out
+
+    def _at(self, i):
+        return self.pts[i - self.base]
+
+    def _ready(self, point, end):
+        """Whether the lookahead windows of point close before end."""
+        if point_interval(point, self.pts[-1]) <= self.interval:
+            return False
+        if self.probe is None or self.probe[0] != self.cur:
+            self.probe = self.cur, self.head
+        i = self.probe[1]
+        while i < end and point_distance(point, self._at(i)) <= self.distance:
+            i += 1
+        self.probe = self.cur, i
+        return i < end
+
+    def _refine_entry(self):
+        self._refine_exit()
+        self.moveseg.extend(self.stopseg)
+        self.stopseg[:] = [self.moveseg.pop()] # current point first in stop
+
+    def _refine_exit(self):
+        self.stopseg.extend(self.nextseg)
+        self.nextseg[:] = []
+
+    def _run(self, final):
+        """See trace_partition_movement_dropsome."""
+        out = []
+        inf = float("inf")
+        distance, interval = self.distance, self.interval
+        end = self.base + len(self.pts)
+
+        while self.cur < end:
+            c = self.cur
+            point = self._at(c)
+            if not final and not self._ready(point, end):
+                break
+
+            self.nextseg.append(point)
+
+            while point_interval(self._at(self.itail), point) > interval:
+                self.itail += 1
+            while self.next_ihead < end and point_interval(
+                    point, self._at(self.next_ihead)) <= interval:
+                self.ihead = self.next_ihead
+                self.next_ihead += 1
+
+            stretch = (
+                min(distance, point_distance(point, self._at(self.ihead)))
+              - min(distance, point_distance(self._at(self.itail), point)))
+
+            if self.exitend is not None and stretch >= self.exitmax:
+                self.exitmax = stretch
+                self._refine_exit()
+
+            while self.head < end and point_distance(
+                    point, self._at(self.head)) <= distance:
+                if point_interval(point, self._at(self.head)) >= interval:
+                    if self.exitend is None:
+                        self.entrymax = -inf
+                        self.entryend = self.head
+                        if c == self.itail:
+                            self.entrymax = inf
+                            self._refine_entry()
+                    self.exitmax = -inf
+                    self.exitend = self.head
+                self.head += 1
+
+            if c == self.entryend:
+                self.entryend = None
+                if self.moveseg:
+                    out.append((True, self.moveseg))
+                self.moveseg = []
+
+            if c == self.exitend:
+                if c == self.ihead:
+                    self._refine_exit()
+                self.exitend = None
+                if self.stopseg:
+                    out.append((False, self.stopseg))
+                self.stopseg = []
+
+            if self.entryend is not None and -stretch > self.entrymax:
+                self.entrymax = -stretch
+                self._refine_entry()
+                self.exitmax = -inf
+
+            self.cur += 1
+
+        # Drop points behind all windows
+        drop = min(self.itail, self.cur) - self.base
+        if drop > 1000 or drop > len(self.pts) / 2:
+            del self.pts[:drop]
+            self.base += drop
+        return out
+
+
+class LegDetector(object):
+    """Stop/move partitioning of one device trace as in generate_device_legs:
+    discard sidesteps, split at gaps longer than break_interval, partition
+    into moving and stationary segments. Decided segments are paired with the
+    next one, undecided points between segments left out.
+
+    lastpt and legs_end are kept for the caller, the last point of the latest
+    leg and the end time of the latest leg that cannot change anymore."""
+
+    def __init__(self, badradius, distance, interval, break_interval):
+        self.distance = distance
+        self.interval = interval
+        self.break_interval = break_interval
+        self.sidesteps = _Sidesteps(badradius)
+        self.partition = _Partition(distance, interval)
+        self.last = None # last point partitioned
+        self.pending = None # decided segment awaiting the next
+        self.lastpt = None
+        self.legs_end = None
+
+    def push(self, points):
+        """Generate pairs of consecutive segments decided by points."""
+        for p in points:
+            for q in self.sidesteps.push(p):
+                for pair in self._pair(self._split(q)):
+                    yield pair
+
+    def finish(self):
+        """Generate the remaining pairs at end of trace; the last one is
+        paired with (None, None)."""
+        segments = []
+        for q in self.sidesteps.finish():
+            segments += self._split(q)
+        segments += self.partition.finish()
+        for pair in self._pair(segments):
+            yield pair
+        if self.pending:
+            yield self.pending, (None, None)
+            self.pending = None
+
+    def _split(self, p):
+        out = []
+        if (self.break_interval and self.last is not None
+                and point_interval(self.last, p) > self.break_interval):
+            out = self.partition.finish()
+            self.partition = _Partition(self.distance, self.interval)
+        self.last = p
+        return out + self.partition.push(p)
+
+    def _pair(self, segments):
+        for mov, seg in segments:
+            if mov is None:
+                continue
+            if self.pending:
+                yield self.pending, (mov, seg)
+            self.pending = mov, seg
+
+    def dumps(self):
+        """Serialize state."""
+        table = []
+        index = {}
+
+        def pack(x):
+            if isinstance(x, TracePoint):
+                k = index.get(id(x))
+                if k is None:
+                    k = index[id(x)] = len(table)
+                    table.append(
+                        [pack(x.get(key)) for key in POINT_KEYS])
+                return {"$p": k}
+            if isinstance(x, datetime.datetime):
+                return {"$t": x.strftime(TIME_FORMAT)}
+            if isinstance(x, (list, tuple, deque)):
+                return [pack(y) for y in x]
+            if isinstance(x, dict):
+                return dict((k, pack(v)) for k, v in x.iteritems())
+            return x
+
+        state = pack({
+            "sidesteps": self.sidesteps.get_state(),
+            "partition": self.partition.get_state(),
+            "last": self.last,
+            "pending": self.pending,
+            "lastpt": self.lastpt,
+            "legs_end": self.legs_end})
+        return json.dumps({"points": table, "state": state})
+
+    @classmethod
+    def loads(cls, data, badradius, distance, interval, break_interval):
+        """Detector continuing from serialized state."""
+        data = json.loads(data)
+        points = []
+
+        def unpack(x):
+            if isinstance(x, list):
+                return [unpack(y) for y in x]
+            if isinstance(x, dict):
+                if "$p" in x:
+                    return points[x["$p"]]
+                if "$t" in x:
+                    return datetime.datetime.strptime(x["$t"], TIME_FORMAT)
+                return dict((k, unpack(v)) for k, v in x.iteritems())
+            return x
+
+        for record in data["points"]:
+            points.append(TracePoint(dict(zip(POINT_KEYS, unpack(record)))))
+        state = unpack(data["state"])
+
+        detector = cls(badradius, distance, interval, break_interval)
+        detector.sidesteps.set_state(state["sidesteps"])
+        detector.partition.set_state(state["partition"])
+        detector.last = state["last"]
+        detector.pending = state["pending"] and tuple(state["pending"])
+        detector.lastpt = state["lastpt"]
+        detector.legs_end = state["legs_end"]
+        return detector
@@ -331,7 +331,7 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                     recordedtrip_endtime = end_recordedpoint['time']
                     
                     for point in recordedpoints:
-                        point_location = json.loads(point["geojson"])["coordinates"]
+                        point_location = point_coordinates(point)
                         point_location_str='{1},{0}'.format(point_location[0],point_location[1])
                         point_time  = point['time']                        
                         isgoodpoint = "---"
@@ -402,7 +402,7 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                         # TODO make more efficient, make less than O(n^2)                  
                         # traverse goodpoints and try to match each with a planpoint:      
                         for point in goodpoints:
-                            point_location = json.loads(point["geojson"])["coordinates"]
+                            point_location = point_coordinates(point)
                             point_location_str='{1},{0}'.format(point_location[0],point_location[1])
                             point_time  = point['time']                        
                             
@@ -414,7 +414,7 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                                            
                             for planpoint in plannedpoints: # traverse plannedpoints to find a match
                                 planpoint_reverse = planpoint[1],planpoint[0]                                                     
-                                delta = get_distance_between_coordinates(json.loads(point["geojson"])["coordinates"], planpoint_reverse)
+                                delta = get_distance_between_coordinates(point_coordinates(point), planpoint_reverse)
                                 deltas.append(delta)
                                 if delta <= MAX_DISTANCE_FOR_POINT_MATCH: #found a match
                                     matchfound = True
@@ -448,12 +448,12 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                     if LOG_DETAILS:          
                         print "@@@ printing recorded points (n=",len(recordedpoints),"): "                         
                         for point in recordedpoints:
-                            point_location = json.loads(point["geojson"])["coordinates"]
+                            point_location = point_coordinates(point)
                             point_location_str='{1},{0}'.format(point_location[0],point_location[1])                       
                             print point_location_str
                         print "@@@ printing goodpoints (n=",len(goodpoints),"): "                         
                         for point in goodpoints:
-                            point_location = json.loads(point["geojson"])["coordinates"]
+                            point_location = point_coordinates(point)
                             point_location_str='{1},{0}'.format(point_location[0],point_location[1])
                             print point_location_str
                         
@@ -473,7 +473,7 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                         print "@@@ matched goodpoints (n=",len(matchedpointpairs),"):"
                         for pointpair in matchedpointpairs:
                             point = pointpair.point1
-                            point_location = json.loads(point["geojson"])["coordinates"]
+                            point_location = point_coordinates(point)
                             point_location_str1='{1},{0}'.format(point_location[0],point_location[1])
                             point = pointpair.point2
                             point_location = point
@@ -482,7 +482,7 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                             print point_location_str                                        
                         print "@@@ unmatched goodpoints (n=",len(unmatchedpoints),"):"
                         for point in unmatchedpoints:
-                            point_location = json.loads(point["geojson"])["coordinates"]
+                            point_location = point_coordinates(point)
                             point_location_str='{1},{0}'.format(point_location[0],point_location[1])
                             print point_location_str                                        
                     
@@ -14,18 +14,19 @@ from sqlalchemy.sql import (
 from sqlalchemy.types import String
 
 from pyfiles.common_helpers import (
+    TracePoint,
     dict_groups,
     group_unsorted,
     mode_str,
     simplify_geometry,
-    trace_discard_sidesteps,
     trace_linestrings)
 
 from pyfiles.constants import BAD_LOCATION_RADIUS
 from pyfiles.routes import get_routes
+from pyfiles.trace_kernels import trace_discard_sidesteps
 
 from pyfiles.database_interface import (
-    mass_transit_types, update_user_distances)
+    coordinate_lonlat, mass_transit_types, update_user_distances)
 
 def common_trips_rows(request, db, user):
     firstday = request.args.get("firstday")
@@ -335,7 +336,7 @@ def common_path(request, db, where):
 
     # use user legs if available
     legsed = select(
-        [   func.ST_AsGeoJSON(dd.c.coordinate).label("geojson"),
+        coordinate_lonlat(dd.c.coordinate) + [
             cast(legs.c.mode, String).label("activity"),
             legs.c.line_name,
             legs.c.time_start.label("legstart"),
@@ -358,7 +359,7 @@ def common_path(request, db, where):
 
     # fall back on raw trace beyond end of user legs
     unlegsed = select(
-        [   func.ST_AsGeoJSON(dd.c.coordinate).label("geojson"),
+        coordinate_lonlat(dd.c.coordinate) + [
             cast(dd.c.activity_1, String).label("activity"),
             literal(None).label("line_name"),
             literal(None).label("legstart"),
@@ -376,7 +377,7 @@ def common_path(request, db, where):
     # Sort also by leg start time so join point repeats adjacent to correct leg
     query = legsed.union_all(unlegsed).order_by(text("time, legstart"))
     query = query.limit(35000) # sanity limit vs date range
-    points = db.engine.execute(query)
+    points = (TracePoint(x) for x in db.engine.execute(query))
 
     # re-split into legs, and the raw part
     segments = (
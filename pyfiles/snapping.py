@@ -0,0 +1,211 @@
+"""In-process version of the waypoint snapping of sql/snapping.sql.
+
+A point snaps to the waypoint nearest to it on the road nearest to it, if
+there is a road within MAX_DISTANCE meters, otherwise to no waypoint.
+
+RoadIndex keeps road segments in a grid of cells at least MAX_DISTANCE wide,
+so the roads near a point are those in its cell and the eight around it.
+Points are snapped a cell at a time, measuring distances to all candidate
+segments at once in numpy. Distances use the flat-earth approximation of
+get_distance_between_coordinates around each point instead of the spheroid
+of PostGIS, so the choice between two roads can differ from the SQL where
+their distances differ by less than about a part in a thousand.
+
+SnappingPool spreads batches of points over worker processes, which get the
+index from the parent process as it is when the pool is created. The workers
+are forked, inheriting open sockets, so create the pool before the process
+connects to the database, or right after disposing of the engine's
+connection pool.
+"""
+
+import json
+from math import cos, pi
+from multiprocessing import Pool
+
+import numpy as np
+
+MAX_DISTANCE = 100
+
+# Meters per degree, as in get_distance_between_coordinates
+LON_METERS = 110320
+LAT_METERS = 110574
+
+# Points measured against their candidate segments at once
+CHUNK = 1000
+
+
+def geojson_lines(geojson):
+    """Lists of (lon, lat) of a LineString or MultiLineString in GeoJSON."""
+    geometry = json.loads(geojson)
+    if geometry["type"] == "LineString":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiLineString":
+        return geometry["coordinates"]
+    return []
+
+
+class RoadIndex(object):
+
+    def __init__(self, roads, waypoints):
+        """roads are (road id, lines) with lines as from geojson_lines,
+        waypoints (road id, waypoint id, lon, lat)."""
+
+        road_ids = []
+        x1, y1, x2, y2, seg_road = [], [], [], [], []
+        for road, lines in roads:
+            r = len(road_ids)
+            road_ids.append(road)
+            for line in lines:
+                for (a, b), (c, d) in zip(line, line[1:]):
+                    x1.append(a)
+                    y1.append(b)
+                    x2.append(c)
+                    y2.append(d)
+                    seg_road.append(r)
+        self.road_ids = road_ids
+        self.x1, self.y1, self.x2, self.y2 = [
+            np.array(v, dtype=float) for v in (x1, y1, x2, y2)]
+        self.seg_road = np.array(seg_road, dtype=np.int64)
+
+        # Cells are wide enough in longitude up to a degree beyond the roads
+        maxlat = max(
+            [abs(v) for v in (y1 + y2)] or [0]) + 1
+        self.cell_lat = float(MAX_DISTANCE) / LAT_METERS
+        self.cell_lon = float(MAX_DISTANCE) / (
+            LON_METERS * cos(min(maxlat, 89) / 180.0 * pi))
+
+        cells = {}
+        for s in range(len(seg_road)):
+            i0, i1 = sorted((self._col(x1[s]), self._col(x2[s])))
+            j0, j1 = sorted((self._row(y1[s]), self._row(y2[s])))
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    cells.setdefault((i, j), []).append(s)
+        self.cells = dict(
+            (k, np.array(v, dtype=np.int64)) for k, v in cells.items())
+        self.near = {} # cell: segments in and around it
+
+        index = dict((road, r) for r, road in enumerate(road_ids))
+        byroad = {}
+        for road, waypoint, lon, lat in waypoints:
+            r = index.get(road)
+            if r is not None:
+                byroad.setdefault(r, []).append((waypoint, lon, lat))
+        self.waypoints = dict(
+            (r, (np.array([w[0] for w in v], dtype=np.int64),
+                 np.array([w[1] for w in v], dtype=float),
+                 np.array([w[2] for w in v], dtype=float)))
+            for r, v in byroad.items())
+
+    def __len__(self):
+        return len(self.seg_road)
+
+    def _col(self, lon):
+        return int(np.floor(lon / self.cell_lon))
+
+    def _row(self, lat):
+        return int(np.floor(lat / self.cell_lat))
+
+    def _near(self, cell):
+        near = self.near.get(cell)
+        if near is None:
+            i, j = cell
+            parts = [
+                self.cells[(i + di, j + dj)]
+                for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                if (i + di, j + dj) in self.cells]
+            near = self.near[cell] = np.unique(
+                np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+        return near
+
+    def snap(self, lon, lat):
+        """Waypoint ids for arrays of lon and lat, None where no road is
+        near enough or the road has no waypoints."""
+
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        road = np.full(len(lon), -1, dtype=np.int64)
+        cols = np.floor(lon / self.cell_lon).astype(np.int64)
+        rows = np.floor(lat / self.cell_lat).astype(np.int64)
+
+        groups = {}
+        for k, cell in enumerate(zip(cols.tolist(), rows.tolist())):
+            groups.setdefault(cell, []).append(k)
+        for cell, members in groups.items():
+            segs = self._near(cell)
+            if not len(segs):
+                continue
+            for c in range(0, len(members), CHUNK):
+                k = np.array(members[c:c+CHUNK])
+                road[k] = self._nearest_road(lon[k], lat[k], segs)
+
+        result = [None] * len(lon)
+        for r in np.unique(road[road >= 0]).tolist():
+            wps = self.waypoints.get(r)
+            if wps is None:
+                continue
+            k = np.nonzero(road == r)[0]
+            ids, wlon, wlat = wps
+            xs = (wlon[None, :] - lon[k, None]) * LON_METERS \
+                * np.cos(lat[k, None] / 180 * pi)
+            ys = (wlat[None, :] - lat[k, None]) * LAT_METERS
+            best = ids[np.argmin(xs * xs + ys * ys, axis=1)].tolist()
+            for i, w in zip(k.tolist(), best):
+                result[i] = w
+        return result
+
+    def _nearest_road(self, lon, lat, segs):
+        """Road index nearest to each point within MAX_DISTANCE, or -1."""
+        xscale = LON_METERS * np.cos(lat[:, None] / 180 * pi)
+        ax = (self.x1[segs][None, :] - lon[:, None]) * xscale
+        ay = (self.y1[segs][None, :] - lat[:, None]) * LAT_METERS
+        dx = (self.x2[segs][None, :] - lon[:, None]) * xscale - ax
+        dy = (self.y2[segs][None, :] - lat[:, None]) * LAT_METERS - ay
+        dd = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(dd > 0, dd, 1), 0, 1)
+        px = ax + t * dx
+        py = ay + t * dy
+        dist2 = px * px + py * py
+        nearest = np.argmin(dist2, axis=1)
+        within = dist2[np.arange(len(lon)), nearest] <= MAX_DISTANCE**2
+        return np.where(within, self.seg_road[segs][nearest], -1)
+
+
+_index = None # of worker processes
+
+
+def _snap_batch(batch):
+    ids, lon, lat = batch
+    return list(zip(ids, _index.snap(lon, lat)))
+
+
+class SnappingPool(object):
+    """Snap (id, lon, lat) points with index in workers processes, or in
+    this one if workers is at most one."""
+
+    def __init__(self, index, workers, batch=5000):
+        global _index
+        _index = index
+        self.batch = batch
+        self.pool = Pool(workers) if workers > 1 else None
+
+    def snap(self, points):
+        """List of (id, waypoint id) of points."""
+        batches = []
+        for i in range(0, len(points), self.batch):
+            chunk = points[i:i+self.batch]
+            batches.append((
+                [p[0] for p in chunk],
+                [p[1] for p in chunk],
+                [p[2] for p in chunk]))
+        if self.pool is None:
+            results = map(_snap_batch, batches)
+        else:
+            results = self.pool.map(_snap_batch, batches)
+        return [x for result in results for x in result]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
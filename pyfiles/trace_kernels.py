@@ -0,0 +1,151 @@
+"""Array versions of the trace_discard_* filters of common_helpers.
+
+The mask functions take lon, lat and accuracy arrays of a trace and return a
+boolean keep mask, identical to which points the generator versions would
+pass. Elementwise steps run in numpy. The sidestep filters are sequential,
+each decision depending on the previously kept points, so those loop over
+plain float lists using the same arithmetic as
+get_distance_between_coordinates, to give bit-identical results.
+
+The trace_discard_* functions here are drop-in replacements for those in
+common_helpers, taking and returning lists of points instead of iterators.
+"""
+
+from math import cos, pi
+
+import numpy as np
+
+from pyfiles.common_helpers import point_coordinates
+
+
+def trace_arrays(points):
+    """lon, lat, accuracy arrays of points; accuracy zero where missing."""
+    n = len(points)
+    lon = np.empty(n)
+    lat = np.empty(n)
+    acc = np.zeros(n)
+    for i, p in enumerate(points):
+        lon[i], lat[i] = point_coordinates(p)
+        if "accuracy" in p:
+            acc[i] = p["accuracy"]
+    return lon, lat, acc
+
+
+def _distance_function(lon, lat):
+    """Index distance function matching get_distance_between_coordinates."""
+    lon = lon.tolist()
+    lat = lat.tolist()
+    coslat = [cos(x / 180 * pi) for x in lat]
+    def distance(i, j):
+        x_diff = (lon[i] - lon[j]) * 110320 * coslat[j]
+        y_diff = (lat[i] - lat[j]) * 110574
+        return (x_diff * x_diff + y_diff * y_diff)**0.5
+    return distance
+
+
+def discard_inaccurate_mask(acc, accuracy):
+    return np.asarray(acc) <= accuracy
+
+
+def _unmoved_indices(index, d, acc, radius):
+    kept = []
+    previous = None
+    for i in index:
+        if previous is not None:
+            r = acc[i] if radius is None else radius
+            if d(previous, i) <= r:
+                continue
+            kept.append(previous)
+        previous = i
+    if previous is not None:
+        kept.append(previous)
+    return kept
+
+
+def _single_sidestep_indices(index, d, acc, factor):
+    def badness(i0, i1, i2):
+        hyp = d(i0, i2)
+        return hyp and (d(i0, i1) + d(i1, i2)) / hyp or float("inf")
+
+    kept = []
+    buf = []
+    for i in index:
+        buf.append(i)
+        if len(buf) < 4:
+            continue
+        badness1 = badness(*buf[0:3])
+        badness2 = badness(*buf[1:4])
+        if (d(buf[0], buf[1]) > acc[buf[1]]
+                and badness1 > factor
+                and (badness2 <= factor or badness1 <= badness2)):
+            buf.pop(1)
+            continue
+        kept.append(buf.pop(0))
+
+    if len(buf) == 3 and badness(*buf) > factor:
+        buf.pop(1)
+    return kept + buf
+
+
+def discard_unmoved_mask(lon, lat, acc, radius=None):
+    mask = np.zeros(len(lon), dtype=bool)
+    mask[_unmoved_indices(
+        range(len(lon)), _distance_function(lon, lat), list(acc), radius)] = 1
+    return mask
+
+
+def discard_single_sidesteps_mask(lon, lat, acc, factor=2):
+    mask = np.zeros(len(lon), dtype=bool)
+    mask[_single_sidestep_indices(
+        range(len(lon)), _distance_function(lon, lat), list(acc), factor)] = 1
+    return mask
+
+
+def discard_sidesteps_mask(lon, lat, acc, badradius=None, factor=2):
+    """See trace_discard_sidesteps."""
+    n = len(lon)
+    if not n:
+        return np.zeros(0, dtype=bool)
+    d = _distance_function(lon, lat)
+    acc = list(acc)
+    moved = _unmoved_indices(range(n), d, acc, badradius)
+    smooth = _single_sidestep_indices(moved, d, acc, factor)
+
+    # Each point takes the state of the latest moved (discard) or smooth
+    # (keep, overriding) event at or before it. The first point is always
+    # in moved, so every point has one.
+    event = np.zeros(n, dtype=np.int8)
+    event[moved] = 1
+    event[smooth] = 2
+    latest = np.maximum.accumulate(
+        np.where(event > 0, np.arange(n), 0))
+    return event[latest] == 2
+
+
+def _select(points, mask):
+    return [p for p, keep in zip(points, mask) if keep]
+
+
+def trace_discard_inaccurate(points, accuracy):
+    points = list(points)
+    return _select(points, discard_inaccurate_mask(
+        [p["accuracy"] for p in points], accuracy))
+
+
+def trace_discard_unmoved(points, radius=None):
+    points = list(points)
+    return _select(points, discard_unmoved_mask(
+        *trace_arrays(points), radius=radius))
+
+
+def trace_discard_single_sidesteps(points, factor=2):
+    points = list(points)
+    return _select(points, discard_single_sidesteps_mask(
+        *trace_arrays(points), factor=factor))
+
+
+def trace_discard_sidesteps(points, badradius=None, factor=2):
+    points = list(points)
+    return _select(points, discard_sidesteps_mask(
+        *trace_arrays(points), badradius=badradius, factor=factor))
+
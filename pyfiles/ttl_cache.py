@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe mapping with LRU eviction beyond maxsize entries and
+    expiry of entries older than ttl seconds. Counts hits and misses."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None or item[0] < now:
+                self.misses += 1
+                return default
+            self.data[key] = item # most recently used last
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = time.time() + self.ttl, value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses}
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""Decoding of /data upload bodies into point records
+
+    (lon, lat, accuracy, time_ms,
+     activity_1, activity_1_conf, activity_2, activity_2_conf,
+     activity_3, activity_3_conf)
+
+JSON bodies are decoded incrementally, so that memory use stays bounded
+regardless of upload size.
+
+The binary format, BINARY_POINTS_MIMETYPE, is columnar and little-endian:
+
+    "RRP1"                      magic
+    uint32 n                    number of points
+    uint8 k, k * (uint8 length, bytes)
+                                string table of activity types
+    n * int64                   time, ms since epoch
+    n * float64, n * float64    longitude, latitude
+    n * float32                 accuracy
+    3 * n * uint8               activity slots 1..3 as string table index,
+                                255 for none, by descending confidence
+    3 * n * uint8               confidences of the slots
+"""
+
+import struct
+import zlib
+from itertools import izip
+
+# The C backends of ijson parse several times faster than the default pure
+# Python one, which is left as a fallback
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson.backends.yajl2_cffi as ijson
+    except ImportError:
+        import ijson
+from ijson.common import JSONError
+
+from pyfiles.database_interface import activity_types
+
+BINARY_POINTS_MIMETYPE = "application/x-regularroutes-points"
+BINARY_POINTS_MAGIC = "RRP1"
+
+# Values of a binary upload column read at once
+COLUMN_CHUNK = 8192
+
+
+class UploadError(ValueError):
+    pass
+
+
+class DecompressingReader(object):
+    """File-like object inflating a gzip or deflate encoded stream."""
+
+    def __init__(self, stream, encoding, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.inflate = zlib.decompressobj(zlib.MAX_WBITS)
+        self.started = False
+        self.buf = ""
+
+    def _decompress(self, data, limit):
+        try:
+            return self.inflate.decompress(data, limit)
+        except zlib.error:
+            # Some clients send raw deflate without the zlib header
+            if self.encoding != "deflate" or self.started:
+                raise
+            self.inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.inflate.decompress(data, limit)
+        finally:
+            self.started = True
+
+    def read(self, size=-1):
+        # Inflate no more than asked for, so that a small body can't expand
+        # into a huge buffer at once
+        while size < 0 or len(self.buf) < size:
+            data = self.inflate.unconsumed_tail
+            if not data:
+                data = self.stream.read(self.chunk_size)
+            if not data:
+                self.buf += self.inflate.flush()
+                break
+            limit = max(size - len(self.buf), self.chunk_size) \
+                if size >= 0 else 0
+            self.buf += self._decompress(data, limit)
+        if size < 0:
+            data, self.buf = self.buf, ""
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def upload_stream(request):
+    """Body of request as a file-like object, decoded per Content-Encoding."""
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if encoding == "identity":
+        return request.stream
+    if encoding in ("gzip", "deflate"):
+        return DecompressingReader(request.stream, encoding)
+    raise UploadError("Unsupported Content-Encoding %s" % encoding)
+
+
+def iter_data_points(stream):
+    """Yield the items of the dataPoints array of a JSON upload one by one,
+    without decoding the whole body first."""
+    try:
+        for point in ijson.items(stream, "dataPoints.item"):
+            yield point
+    except (JSONError, zlib.error) as e:
+        raise UploadError("Malformed upload: %s" % e)
+
+
+def _pad_activities(activities):
+    """Top three (type, confidence) pairs flattened, padded with UNKNOWN if
+    there are any at all."""
+    if not activities:
+        return (None,) * 6
+    activities = activities[:3]
+    while len(activities) < 3:
+        activities.append(("UNKNOWN", 0))
+    return tuple(x for pair in activities for x in pair)
+
+
+def json_point_record(point):
+    """Point record of a JSON data point."""
+    location = point['location']
+    activities = []
+    if 'activityData' in point and 'activities' in point['activityData']:
+        activities = sorted(
+            ((x['activityType'], int(x['confidence']))
+             for x in point['activityData']['activities']
+             if x['activityType'] in activity_types),
+            key=lambda x: x[1], reverse=True)
+    return (
+        float(location['longitude']),
+        float(location['latitude']),
+        float(location['accuracy']),
+        long(point['time'])) + _pad_activities(activities)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise UploadError("Truncated upload")
+    return data
+
+
+def _read_column(stream, code, n, chunk=COLUMN_CHUNK):
+    """n values of struct code, read chunk values at a time."""
+    size = struct.calcsize(code)
+    column = []
+    for i in xrange(0, n, chunk):
+        m = min(chunk, n - i)
+        column.extend(struct.unpack(
+            "<%d%s" % (m, code), _read_exactly(stream, m * size)))
+    return column
+
+
+def iter_binary_records(stream, max_points):
+    """Yield point records of a binary upload of at most max_points."""
+    try:
+        for record in _iter_binary_records(stream, max_points):
+            yield record
+    except zlib.error as e:
+        raise UploadError("Malformed upload: %s" % e)
+
+
+def _iter_binary_records(stream, max_points):
+    if _read_exactly(stream, 4) != BINARY_POINTS_MAGIC:
+        raise UploadError("Bad magic in binary upload")
+    n, = struct.unpack("<I", _read_exactly(stream, 4))
+    if n > max_points:
+        raise UploadError("Too many points in binary upload: %d" % n)
+    k, = struct.unpack("<B", _read_exactly(stream, 1))
+    strings = []
+    for i in xrange(k):
+        length, = struct.unpack("<B", _read_exactly(stream, 1))
+        name = _read_exactly(stream, length)
+        # Unknown activity types are dropped, as in JSON uploads
+        strings.append(name if name in activity_types else None)
+    strings += [None] * (256 - len(strings))
+
+    times = _read_column(stream, "q", n)
+    lons = _read_column(stream, "d", n)
+    lats = _read_column(stream, "d", n)
+    accuracies = _read_column(stream, "f", n)
+    slots = _read_column(stream, "B", 3 * n)
+    confs = _read_column(stream, "B", 3 * n)
+
+    for i, (t, lon, lat, acc) in enumerate(izip(times, lons, lats, accuracies)):
+        activities = []
+        for j in xrange(i, 3 * n, n):
+            name = strings[slots[j]]
+            if name is not None:
+                activities.append((name, confs[j]))
+        yield (lon, lat, acc, t) + _pad_activities(activities)
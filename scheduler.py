@@ -1,17 +1,24 @@
 import datetime
 from datetime import timedelta
-from itertools import chain
 
-import json
 import os
-import re
 import sys
+import threading
 import time
-import urllib2
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
 from pyfiles.database_interface import (
-    init_db, data_points_by_user_id_after, device_data_delete_duplicates,
-    device_data_waypoint_snapping, generate_rankings,
+    init_db, coordinate_lonlat, data_points_by_user_id_after,
+    device_data_compact_partition, device_data_create_partition,
+    device_data_delete_duplicates, device_data_move_rows,
+    device_data_partitions, ewkb_point, mass_transit_data_copy,
+    mass_transit_data_create_partition, mass_transit_data_drop_partition,
+    mass_transit_data_move_day, mass_transit_data_partitions,
+    device_data_make_unique_index, device_data_unique_index_valid,
+    device_data_set_waypoints, device_data_unsnapped,
+    device_data_waypoint_snapping, generate_rankings, snapping_roads,
+    snapping_waypoints,
     hsl_alerts_insert, weather_forecast_insert, weather_observations_insert,
     traffic_disorder_insert, match_pubtrans_alert, match_pubtrans_alert_test,
     match_traffic_disorder, update_global_statistics, update_user_distances)
@@ -19,16 +26,20 @@ from pyfiles.database_interface import (
 from pyfiles.push_messaging import push_ptp_alert  # push_ptp_pubtrans, push_ptp_traffic,
 from pyfiles.push_messaging import PTP_TYPE_PUBTRANS, PTP_TYPE_DIGITRAFFIC
 from pyfiles.device_data_filterer import DeviceDataFilterer
+from pyfiles import job_metrics
+from pyfiles.geocoding import ReverseGeocoder, geohash_cell
+from pyfiles.job_lock import JobGuard
+from pyfiles.snapping import RoadIndex, SnappingPool, geojson_lines
 
 from pyfiles.common_helpers import (
     interpret_jore,
-    pairwise,
-    point_coordinates)
+    point_coordinates,
+    trace_points)
 
 from pyfiles.constants import DEST_RADIUS_MAX, TRIP_STOP_DURATION
 
 from pyfiles.information_services import (
-    hsl_alert_request, fmi_forecast_request, fmi_observations_request, traffic_disorder_request)
+    hsl_alert_request, hsl_vehicle_request, fmi_forecast_request, fmi_observations_request, traffic_disorder_request)
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask
 
@@ -60,6 +71,10 @@ else:
     app.debug = True
 
 db, store = init_db(app)
+job_metrics.instrument(db.engine)
+
+# Print per leg, trip and place progress
+TRACE = app.config.get("SCHEDULER_TRACE", False)
 
 users_table = db.metadata.tables['users']
 devices_table = db.metadata.tables['devices']
@@ -72,14 +87,41 @@ global_statistics_table = db.metadata.tables['global_statistics']
 
 def initialize():
     print "initialising scheduler"
-    scheduler = BackgroundScheduler()
+
+    # Jobs are guarded by database advisory locks, so that several scheduler
+    # nodes can run for failover. The hourly and daily tasks share a lock:
+    # the daily waits for a running hourly, the hourly is skipped while the
+    # daily, which includes it, runs. Of nodes firing the same schedule,
+    # skip_within lets only the first run. Runs other than the frequent HSL
+    # poll are recorded in job_runs.
+    guard = JobGuard(
+        db.engine, app.config.get("SCHEDULER_NODE")).guard
+    def record(function):
+        return job_metrics.recorded(db.engine, function)
+    hsl = guard(retrieve_hsl_data, skip_within=timedelta(seconds=15))
+    hourly = guard(
+        record(run_hourly_tasks), "legs",
+        skip_within=timedelta(minutes=30))
+    daily = guard(
+        record(run_daily_tasks), "legs", wait=True,
+        skip_within=timedelta(hours=12))
+    alerts = guard(
+        record(retrieve_transport_alerts), skip_within=timedelta(minutes=2))
+    weather = guard(
+        record(retrieve_weather_info), skip_within=timedelta(hours=12))
+
+    # Missed runs are made up once, if not too late, and never run twice at
+    # once within the node
+    scheduler = BackgroundScheduler(job_defaults={
+        "coalesce": True, "max_instances": 1})
     scheduler.start()
-    scheduler.add_job(retrieve_hsl_data, "cron", second="*/30")
-    run_daily_tasks()
-    scheduler.add_job(run_hourly_tasks, "cron", minute=24)
-    scheduler.add_job(run_daily_tasks, "cron", hour="3")
-    scheduler.add_job(retrieve_transport_alerts, "cron", minute="*/5")
-    scheduler.add_job(retrieve_weather_info, "cron", hour="6")
+    scheduler.add_job(hsl, "cron", second="*/30", misfire_grace_time=15)
+    daily()
+    scheduler.add_job(hourly, "cron", minute=24, misfire_grace_time=1800)
+    scheduler.add_job(daily, "cron", hour="3", misfire_grace_time=6*3600)
+    scheduler.add_job(
+        alerts, "cron", minute="*/5", misfire_grace_time=120)
+    scheduler.add_job(weather, "cron", hour="6", misfire_grace_time=6*3600)
     print "scheduler init done"
 
 
@@ -90,6 +132,7 @@ def run_daily_tasks():
     generate_distance_data()
     generate_global_statistics()
     mass_transit_cleanup()
+    device_data_maintenance()
 
 
 def run_hourly_tasks():
@@ -100,12 +143,217 @@ def run_hourly_tasks():
     generate_trips()
 
 
+def write_device_legs(t, device, start, newlegs):
+    """Write sequence of (leg, modes) generated for device, reusing legs that
+    are unchanged, updating the first leg overlapping each changed one since
+    the previous leg or start, and deleting the rest of the overlapping.
+
+    Existing legs and modes in the range are loaded in one query, and the
+    changes applied in a few set-based statements, with the same result as
+    applying the legs one at a time."""
+
+    if not newlegs:
+        return
+
+    legs = db.metadata.tables["legs"]
+    modes = db.metadata.tables["modes"]
+
+    # Columns of the new legs for array parameters
+    cols = {
+        "time_start": [], "time_end": [], "gj0": [], "gj1": [],
+        "activity": [], "km": []}
+    for leg, _ in newlegs:
+        cols["time_start"].append(leg["time_start"])
+        cols["time_end"].append(leg["time_end"])
+        cols["gj0"].append(leg.get("geojson_start"))
+        cols["gj1"].append(leg.get("geojson_end"))
+        cols["activity"].append(leg["activity"])
+        cols["km"].append(leg.get("km")) # not given, not compared, for stops
+
+    newcols = """
+            (CAST(:time_start AS timestamp[]))[i] time_start,
+            (CAST(:time_end AS timestamp[]))[i] time_end,
+            (CAST(:gj0 AS text[]))[i] gj0,
+            (CAST(:gj1 AS text[]))[i] gj1,
+            (CAST(:activity AS text[]))[i] activity,
+            (CAST(:km AS float8[]))[i] km"""
+    newrows = """(SELECT i, """ + newcols + """
+        FROM generate_series(1, :n) i) n"""
+
+    # Existing legs in range with their modes and index of the new leg they
+    # equal on all columns, if any
+    existing = t.execute(text("""
+        SELECT l.id, l.time_start, l.time_end, n.i, m.id, m.source, m.mode,
+            m.line
+        FROM legs l
+        LEFT JOIN """ + newrows + """
+            ON l.time_start = n.time_start AND l.time_end = n.time_end
+            AND CASE WHEN n.gj0 IS NULL THEN l.coordinate_start IS NULL
+                ELSE l.coordinate_start = ST_GeomFromGeoJSON(n.gj0) END
+            AND CASE WHEN n.gj1 IS NULL THEN l.coordinate_end IS NULL
+                ELSE l.coordinate_end = ST_GeomFromGeoJSON(n.gj1) END
+            AND l.activity = CAST(n.activity AS activity_type_enum)
+            AND (n.km IS NULL OR l.km = n.km)
+        LEFT JOIN modes m ON m.leg = l.id
+        WHERE l.device_id = :device
+            AND l.time_end > :start
+            AND l.time_start < :end
+        ORDER BY l.time_start, l.id"""),
+        device=device,
+        start=start,
+        end=max(cols["time_end"]),
+        n=len(newlegs),
+        **cols)
+
+    pending = [] # (id, time_start, time_end) in time_start order
+    equal = {} # new leg index: id
+    exmodes = {} # id: {source: (mode id, mode, line)}
+    for lid, lstart, lend, i, mid, source, mode, line in existing:
+        if lid not in exmodes:
+            pending.append((lid, lstart, lend))
+            exmodes[lid] = {}
+        if i is not None:
+            equal.setdefault(i - 1, lid)
+        if mid is not None:
+            exmodes[lid][source] = mid, mode, line
+    pending.reverse()
+
+    # Plan changes leg by leg. Overlap candidates are the existing legs not
+    # yet touched that start before the end of the new leg; those ending by
+    # the end of the previous new leg are out for good.
+    window = []
+    touched = set()
+    updates = [] # (id, index)
+    inserts = [] # index
+    deletes = []
+    modedels = []
+    modeins = [] # (id or None for inserted, index, source, mode, line)
+    unchanged = 0
+    for i, (leg, legmodes) in enumerate(newlegs):
+        trace = [] # what was done, printed if tracing
+
+        overlapstart = i and newlegs[i - 1][0]["time_end"] or start
+        while pending and pending[-1][1] < leg["time_end"]:
+            window.append(pending.pop())
+        window = [x for x in window
+                  if x[2] > overlapstart and x[0] not in touched]
+
+        legid = equal.get(i)
+        if legid and legid not in touched:
+            trace.append("-> unchanged")
+            touched.add(legid)
+            unchanged += 1
+        elif window:
+            legid, dels = window[0][0], [x[0] for x in window[1:]]
+            updates.append((legid, i))
+            touched.update(x[0] for x in window)
+            trace.append("-> update")
+            if dels:
+                deletes += dels
+                trace.append("-> delete %d" % len(dels))
+        else:
+            legid = None
+            inserts.append(i)
+            trace.append("-> insert")
+
+        # Delete mismatching modes, add new modes
+        ex = exmodes.get(legid, {})
+        for src in set(ex).union(legmodes):
+            exmode, numode = ex.get(src, (None, None, None)), legmodes.get(src)
+            if numode == exmode[1:]:
+                continue
+            if exmode[0] is not None:
+                trace.append(("-> del", src, exmode[1:]))
+                modedels.append(exmode[0])
+            if numode is not None:
+                trace.append(("-> ins", src, numode))
+                modeins.append((legid, i, src) + tuple(numode))
+
+        if TRACE:
+            print " ".join([
+                "d"+str(device),
+                str(leg["time_start"])[:19],
+                str(leg["time_end"])[:19],
+                leg["activity"]] + [
+                    " ".join(map(str, x)) if isinstance(x, tuple) else x
+                    for x in trace])
+
+    job_metrics.count("legs_unchanged", unchanged)
+    job_metrics.count("legs_updated", len(updates))
+    job_metrics.count("legs_inserted", len(inserts))
+    job_metrics.count("legs_deleted", len(deletes))
+    job_metrics.count("modes_deleted", len(modedels))
+    job_metrics.count("modes_inserted", len(modeins))
+
+    if deletes:
+        t.execute(legs.delete(legs.c.id.in_(deletes)))
+
+    if modedels:
+        t.execute(modes.delete(modes.c.id.in_(modedels)))
+
+    if updates:
+        idx = [i for _, i in updates]
+        t.execute(text("""
+            UPDATE legs SET
+                time_start = n.time_start,
+                time_end = n.time_end,
+                coordinate_start = ST_GeomFromGeoJSON(n.gj0),
+                coordinate_end = ST_GeomFromGeoJSON(n.gj1),
+                activity = CAST(n.activity AS activity_type_enum),
+                km = CASE WHEN n.km IS NULL THEN legs.km ELSE n.km END
+            FROM (SELECT (CAST(:id AS integer[]))[i] id, """ + newcols + """
+                FROM generate_series(1, :n) i) n
+            WHERE legs.id = n.id"""),
+            id=[x[0] for x in updates],
+            n=len(updates),
+            **dict((k, [v[i] for i in idx]) for k, v in cols.iteritems()))
+
+    if inserts:
+        # Ids are drawn before inserting, so each is known to belong to the
+        # new leg at its position in inserts
+        ids = dict((inserts[x[0] - 1], x[1]) for x in t.execute(text("""
+            WITH numbered AS (
+                SELECT n.*, nextval(pg_get_serial_sequence('legs', 'id')) id
+                FROM """ + newrows + """
+            ), inserted AS (
+                INSERT INTO legs (
+                    id, device_id, time_start, time_end, coordinate_start,
+                    coordinate_end, activity, km)
+                SELECT id, :device, time_start, time_end,
+                    ST_GeomFromGeoJSON(gj0), ST_GeomFromGeoJSON(gj1),
+                    CAST(activity AS activity_type_enum), km
+                FROM numbered
+                RETURNING id
+            )
+            SELECT i, id FROM numbered JOIN inserted USING (id)"""),
+            device=device,
+            n=len(inserts),
+            **dict((k, [v[i] for i in inserts]) for k, v in cols.iteritems())))
+        modeins = [
+            (mleg or ids[i], i, src, mode, line)
+            for mleg, i, src, mode, line in modeins]
+
+    if modeins:
+        t.execute(modes.insert().values([
+            {"leg": mleg, "source": src, "mode": mode, "line": line}
+            for mleg, _, src, mode, line in modeins]))
+
+
+@job_metrics.timed
 def generate_legs(keepto=None, maxtime=None, repair=False):
     """Record legs from stops and mobile activity found in device telemetry.
 
     keepto -- keep legs before this time, except last two or so for restart
     maxtime -- process device data up to this time
-    repair -- re-evaluate and replace all changed legs"""
+    repair -- re-evaluate and replace all changed legs
+
+    Unless keepto or repair is given, devices continue from the leg detector
+    state saved on the previous run, processing only points received since.
+    Devices without saved state restart a few legs back, as do devices that
+    have since received points dated at or before their saved state, from a
+    few legs before the earliest such point."""
+
+    resumable = not keepto and not repair
 
     now = datetime.datetime.now()
     if not keepto:
@@ -117,6 +365,34 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
 
     dd = db.metadata.tables["device_data"]
     legs = db.metadata.tables["legs"]
+    lds = db.metadata.tables["leg_detector_state"]
+
+    checkpoints = {}
+    last_ids = {}
+    for device, cptime, state, last_id in db.engine.execute(select(
+            [lds.c.device_id, lds.c.time, lds.c.state, lds.c.last_id])):
+        last_ids[device] = last_id
+        if resumable and cptime < maxtime:
+            checkpoints[device] = cptime, state
+
+    late = {}
+    if resumable:
+        # Earliest point received after each checkpoint but dated at or
+        # before it, so not seen by the detector. Ids are drawn as points
+        # are stored, so those received since have greater ids than any
+        # processed. The bound on all ids lets the scan start from the newest
+        # rows.
+        late = dict(db.engine.execute(text("""
+            SELECT d.device_id, min(d.time)
+            FROM device_data d
+            JOIN leg_detector_state s ON s.device_id = d.device_id
+            WHERE d.id > (SELECT min(last_id) FROM leg_detector_state)
+                AND d.id > s.last_id
+                AND d.time <= s.time
+            GROUP BY d.device_id""")).fetchall())
+        for device in late:
+            checkpoints.pop(device, None)
+        job_metrics.count("late_devices", len(late))
 
     # Find first and last point sent from each device.
     devmax = select(
@@ -175,9 +451,48 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
             devmax.c.firstpoint.label("start")])
 
     starts = starts.order_by(devmax.c.device_id)
-    for device, rewind, start in db.engine.execute(starts):
+
+    def late_start(device, late_time):
+        """Start row of device restarting a few legs before late_time, as
+        starts does before the latest legs."""
+        prior = [x[0] for x in db.engine.execute(select(
+            [legs.c.time_start],
+            and_(
+                legs.c.device_id == device,
+                legs.c.activity != None,
+                legs.c.time_start <= late_time),
+            order_by=desc(legs.c.time_start),
+            limit=4))]
+        first = db.engine.execute(select(
+            [func.min(dd.c.time)], dd.c.device_id == device)).scalar()
+        return (
+            device,
+            prior[3] if len(prior) > 3 else first,
+            prior[1] if len(prior) > 1 else first)
+
+    def device_legs(row):
+        with job_metrics.span("generate_legs.device", row[0]):
+            device_legs_span(row)
+
+    def device_legs_span(row):
+        device, rewind, start = row
+        filterer = DeviceDataFilterer() # not very objecty rly
+
+        checkpoint = checkpoints.get(device)
+        if checkpoint:
+            detector = filterer.leg_detector(checkpoint[1])
+            after = dd.c.time > checkpoint[0]
+            legstart = None
+            # Legs the detector can still change come after legs_end
+            start = detector.legs_end or start
+        else:
+            detector = filterer.leg_detector()
+            after = dd.c.time >= rewind
+            legstart = start
+
         query = select(
-            [   func.ST_AsGeoJSON(dd.c.coordinate).label("geojson"),
+            coordinate_lonlat(dd.c.coordinate) + [
+                dd.c.id,
                 dd.c.accuracy,
                 dd.c.time,
                 dd.c.device_id,
@@ -186,101 +501,79 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
                 dd.c.activity_3, dd.c.activity_3_conf],
             and_(
                 dd.c.device_id == device,
-                dd.c.time >= rewind,
+                after,
                 dd.c.time < maxtime),
             order_by=dd.c.time)
 
-        points = db.engine.execute(query).fetchall()
-
-        print "d"+str(device), "resume", str(start)[:19], \
-            "rewind", str(rewind)[:19], str(len(points))+"p"
-
-        filterer = DeviceDataFilterer() # not very objecty rly
-        lastend = None
-        newlegs = filterer.generate_device_legs(points, start)
-
-        for (prevleg, _), (leg, legmodes) in pairwise(
-                chain([(None, None)], newlegs)):
-
-          with db.engine.begin() as t:
-
-            lastend = leg["time_end"]
-
-            print " ".join([
-                "d"+str(device),
-                str(leg["time_start"])[:19],
-                str(leg["time_end"])[:19],
-                leg["activity"]]),
-
-            # Adjust leg for db entry
-            gj0 = leg.pop("geojson_start", None)
-            gj1 = leg.pop("geojson_end", None)
-            leg.update({
-                "device_id": device,
-                "coordinate_start": gj0 and func.ST_GeomFromGeoJSON(gj0),
-                "coordinate_end": gj1 and func.ST_GeomFromGeoJSON(gj1)})
-
-            # Deal with overlapping legs on rewind/repair
-            legid = t.execute(select(
-                [legs.c.id],
-                and_(*(legs.c[c] == leg[c] for c in leg.keys())))).scalar()
-            if legid:
-                print "-> unchanged",
-            else:
-                overlapstart = prevleg and prevleg["time_end"] or start
-                overlaps = [x[0] for x in t.execute(select(
-                    [legs.c.id],
-                    and_(
-                        legs.c.device_id == leg["device_id"],
-                        legs.c.time_start < leg["time_end"],
-                        legs.c.time_end > overlapstart),
-                    order_by=legs.c.time_start))]
-                if overlaps:
-                    legid, dels = overlaps[0], overlaps[1:]
-                    t.execute(legs.update(legs.c.id == legid, leg))
-                    print "-> update",
-                    if dels:
-                        t.execute(legs.delete(legs.c.id.in_(dels)))
-                        print "-> delete %d" % len(dels)
-                else:
-                    ins = legs.insert(leg).returning(legs.c.id)
-                    legid = t.execute(ins).scalar()
-                    print "-> insert",
-
-            # Delete mismatching modes, add new modes
-            modes = db.metadata.tables["modes"]
-            exmodes = {x[0]: x[1:] for x in t.execute(select(
-                [modes.c.source, modes.c.mode, modes.c.line],
-                legs.c.id == legid,
-                legs.join(modes)))}
-            for src in set(exmodes).union(legmodes):
-                ex, nu = exmodes.get(src), legmodes.get(src)
-                if nu == ex:
-                    continue
-                if ex is not None:
-                    print "-> del", src, ex,
-                    t.execute(modes.delete(and_(
-                        modes.c.leg == legid, modes.c.source == src)))
-                if nu is not None:
-                    print "-> ins", src, nu,
-                    t.execute(modes.insert().values(
-                        leg=legid, source=src, mode=nu[0], line=nu[1]))
-
-            print
-
-        # Emit null activity terminator leg to mark trailing undecided points,
-        # if any, to avoid unnecessary reprocessing on resume.
-        rejects = [x for x in points if not lastend or x["time"] > lastend]
-        if rejects:
-            db.engine.execute(legs.delete(and_(
-                legs.c.device_id == device,
-                legs.c.time_start <= rejects[-1]["time"],
-                legs.c.time_end >= rejects[0]["time"])))
-            db.engine.execute(legs.insert({
-                "device_id": device,
-                "time_start": rejects[0]["time"],
-                "time_end": rejects[-1]["time"],
-                "activity": None}))
+        with job_metrics.span("generate_legs.read"):
+            points = trace_points(db.engine.execute(query))
+        job_metrics.count("devices")
+        job_metrics.count("points_read", len(points))
+
+        if checkpoint:
+            print "d"+str(device), "resume", str(start)[:19], \
+                "checkpoint", str(checkpoint[0])[:19], str(len(points))+"p"
+        else:
+            print "d"+str(device), "resume", str(start)[:19], \
+                "rewind", str(rewind)[:19], str(len(points))+"p"
+
+        with job_metrics.span("generate_legs.detect"):
+            newlegs = list(
+                filterer.generate_device_legs(points, legstart, detector))
+
+        with job_metrics.span("generate_legs.write"), \
+                db.engine.begin() as t:
+            write_device_legs(t, device, start, newlegs)
+
+            # Save state for the next run to resume from, before the trailing
+            # legs that later points may change.
+            if points:
+                values = {
+                    "time": points[-1]["time"],
+                    "state": detector.checkpoint,
+                    "last_id": max(
+                        [p["id"] for p in points]
+                        + [last_ids.get(device, 0)])}
+                if not t.execute(lds.update(
+                        lds.c.device_id == device, values)).rowcount:
+                    values["device_id"] = device
+                    t.execute(lds.insert(values))
+
+            # Emit null activity terminator leg to mark trailing undecided
+            # points, if any, to avoid unnecessary reprocessing on resume.
+            # These may have been received on earlier runs, so look them up.
+            lastend = newlegs and newlegs[-1][0]["time_end"] \
+                or detector.legs_end
+            rejects = t.execute(select(
+                [func.min(dd.c.time), func.max(dd.c.time)],
+                and_(
+                    dd.c.device_id == device,
+                    dd.c.time >= rewind,
+                    dd.c.time < maxtime,
+                    *([dd.c.time > lastend] if lastend else [])))).first()
+            if rejects[0]:
+                t.execute(legs.delete(and_(
+                    legs.c.device_id == device,
+                    legs.c.time_start <= rejects[1],
+                    legs.c.time_end >= rejects[0])))
+                t.execute(legs.insert({
+                    "device_id": device,
+                    "time_start": rejects[0],
+                    "time_end": rejects[1],
+                    "activity": None}))
+                job_metrics.count("terminators")
+
+    # Late devices may have no points after their last leg, and need to
+    # go back further than the latest legs anyway
+    rows = dict((x[0], tuple(x)) for x in db.engine.execute(starts))
+    for device, late_time in late.items():
+        rows[device] = late_start(device, late_time)
+
+    # Devices are independent, so they can be processed in parallel
+    map_devices(
+        device_legs,
+        [rows[x] for x in sorted(rows)],
+        app.config.get("LEG_WORKERS", 1))
 
     # Attach device legs to users.
     devices = db.metadata.tables["devices"]
@@ -335,41 +628,49 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
             [owned.c.owner, func.min(owned.c.time_start)],
             group_by=owned.c.owner)
 
-    for user, start in db.engine.execute(starts.order_by(column("owner"))):
-        # Ignore the special legacy user linking userless data
-        if user == 0:
-            continue
-
-        print "u"+str(user), "start attach", start
-
-        # Get legs from user's devices in end time order, so shorter
-        # legs get attached in favor of longer legs from a more idle device.
-        s = select(
-            [   owned.c.id,
-                owned.c.time_start,
-                owned.c.time_end,
-                owned.c.user_id],
-            and_(owned.c.owner == user, owned.c.time_start >= start),
-            order_by=owned.c.time_end)
-
-        lastend = None
-        for lid, lstart, lend, luser in db.engine.execute(s):
-            print " ".join(["u"+str(user), str(lstart)[:19], str(lend)[:19]]),
-            if lastend and lstart < lastend:
-                if luser is None:
-                    print "-> detached"
-                    continue
-                db.engine.execute(legs.update(
-                    legs.c.id==lid).values(user_id=None)) # detach
-                print "-> detach"
-                continue
-            lastend = lend
-            if luser == user:
-                print "-> attached"
+    with job_metrics.span("generate_legs.attach"):
+        for user, start in db.engine.execute(
+                starts.order_by(column("owner"))):
+            # Ignore the special legacy user linking userless data
+            if user == 0:
                 continue
-            db.engine.execute(legs.update(
-                legs.c.id==lid).values(user_id=user)) # attach
-            print "-> attach"
+
+            if TRACE:
+                print "u"+str(user), "start attach", start
+
+            # Get legs from user's devices in end time order, so shorter
+            # legs get attached in favor of longer legs from a more idle
+            # device.
+            s = select(
+                [   owned.c.id,
+                    owned.c.time_start,
+                    owned.c.time_end,
+                    owned.c.user_id],
+                and_(owned.c.owner == user, owned.c.time_start >= start),
+                order_by=owned.c.time_end)
+
+            lastend = None
+            for lid, lstart, lend, luser in db.engine.execute(s):
+                if lastend and lstart < lastend:
+                    if luser is None:
+                        action = "-> detached"
+                    else:
+                        db.engine.execute(legs.update(
+                            legs.c.id==lid).values(user_id=None)) # detach
+                        job_metrics.count("legs_detached")
+                        action = "-> detach"
+                else:
+                    lastend = lend
+                    if luser == user:
+                        action = "-> attached"
+                    else:
+                        db.engine.execute(legs.update(
+                            legs.c.id==lid).values(user_id=user)) # attach
+                        job_metrics.count("legs_attached")
+                        action = "-> attach"
+                if TRACE:
+                    print " ".join([
+                        "u"+str(user), str(lstart)[:19], str(lend)[:19], action])
 
     # Cluster backlog in batches
     cluster_legs(1000)
@@ -378,6 +679,80 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
     label_places(60)
 
 
+class ThreadOutput(object):
+    """Stand-in for sys.stdout, sending writes from threads that have set
+    local.buffer there instead of the stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "buffer", None) or self.stream
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+    # print keeps track of pending separators in softspace
+    @property
+    def softspace(self):
+        return getattr(self.target(), "softspace", 0)
+
+    @softspace.setter
+    def softspace(self, value):
+        self.target().softspace = value
+
+
+def map_devices(function, items, workers):
+    """Call function on each item, in a pool of worker threads if workers is
+    greater than one. Output of each call is printed in order of items when
+    done. On error, the items not yet started are skipped, and the error is
+    raised once the running ones are finished."""
+
+    if workers <= 1:
+        for item in items:
+            function(item)
+        return
+
+    output = ThreadOutput(sys.stdout)
+    stop = threading.Event()
+    jobrun = job_metrics.current()
+
+    def run(item):
+        if stop.is_set():
+            return "", None
+        output.local.buffer = StringIO()
+        job_metrics.adopt(jobrun)
+        try:
+            function(item)
+            return output.local.buffer.getvalue(), None
+        except Exception:
+            stop.set()
+            return output.local.buffer.getvalue(), sys.exc_info()
+        finally:
+            output.local.buffer = None
+            job_metrics.adopt(None)
+
+    error = None
+    pool = ThreadPool(workers)
+    sys.stdout = output
+    try:
+        for out, exc_info in pool.imap(run, items):
+            output.stream.write(out)
+            error = error or exc_info
+    finally:
+        pool.close()
+        pool.join()
+        sys.stdout = output.stream
+
+    if error:
+        raise error[0], error[1], error[2]
+
+
+@job_metrics.timed
 def cluster_legs(limit):
     """New leg ends and places are clustered live by triggers; this can be used
     to cluster data created earlier."""
@@ -389,6 +764,7 @@ def cluster_legs(limit):
         t.execute(text("SELECT leg_ends_cluster(:limit)"), limit=limit)
 
 
+@job_metrics.timed
 def label_places(timeout):
     """Add labels to places that have no labels, or position has shifted
     significantly since labeling.
@@ -397,7 +773,11 @@ def label_places(timeout):
     example:
 
     REVERSE_GEOCODING_URI_TEMPLATE = 'https://search.mapzen.com/v1/reverse?api_key=API_KEY&sources=osm&size=20&point.lat={lat}&point.lon={lon}'
-    REVERSE_GEOCODING_QUERIES_PER_SECOND = 6"""
+    REVERSE_GEOCODING_QUERIES_PER_SECOND = 6
+
+    Up to that many queries are in flight at once. Responses are cached by
+    geohash cell, see pyfiles/geocoding.py, so places in a cell labeled
+    before are labeled without a query."""
 
     print "label_places up to %ds" % timeout
 
@@ -412,59 +792,148 @@ def label_places(timeout):
 
     places = db.metadata.tables["places"]
     labdist = func.ST_Distance(places.c.coordinate, places.c.label_coordinate)
-    t0 = time.time()
+    deadline = time.time() + timeout
+
+    # Places by cell, cells in order of their first place
+    cells = []
+    cell_places = {}
     for p in db.engine.execute(select(
             [   places.c.id,
                 func.ST_AsGeoJSON(places.c.coordinate).label("geojson")],
             or_(labdist == None, labdist > DEST_RADIUS_MAX), # = clust dist / 2
             order_by=nullsfirst(desc(labdist)))):
         lon, lat = point_coordinates(p)
-        url = url_template.format(lat=lat, lon=lon)
-        response = json.loads(urllib2.urlopen(url, timeout=timeout).read())
-        names, nameslower = [], set()
-        for prop in ["street", "name"]:
-            for feat in response["features"]:
-                name = feat["properties"].get(prop)
-                name = name and re.split(",", name)[0]
-                if name and name.lower() not in nameslower:
-                    names.append(name)
-                    nameslower.add(name.lower())
-
-        label = " / ".join(names[:2])
+        cell = geohash_cell(lat, lon)
+        if cell[0] not in cell_places:
+            cells.append(cell)
+            cell_places[cell[0]] = []
+        cell_places[cell[0]].append((p.id, lat, lon))
+    if not cells:
+        return
+
+    cached = dict(db.engine.execute(text("""
+        SELECT geohash, label FROM geocoding_cache
+        WHERE geohash = ANY(:geohashes)"""),
+        geohashes=[x[0] for x in cells]).fetchall())
+    job_metrics.count("geocoding_cache_hits", len(cached))
+    set_place_labels([
+        (place, label)
+        for geohash, label in cached.iteritems()
+        for place in cell_places[geohash]])
+
+    geocoder = ReverseGeocoder(url_template, qps, timeout)
+    for geohash, label in geocoder.labels(
+            [x for x in cells if x[0] not in cached], deadline):
+        job_metrics.count("geocoding_queries")
+        db.engine.execute(text("""
+            INSERT INTO geocoding_cache (geohash, label, time)
+            SELECT :geohash, :label, LOCALTIMESTAMP
+            WHERE NOT EXISTS (
+                SELECT 1 FROM geocoding_cache WHERE geohash = :geohash)"""),
+            geohash=geohash, label=label)
+        set_place_labels([(x, label) for x in cell_places[geohash]])
+
+
+def set_place_labels(labels):
+    """Store (place, label) pairs from label_places, with the place
+    coordinate as the label coordinate. Places labeled with nothing named
+    fall back to their coordinates."""
+
+    if not labels:
+        return
+    ids, names = [], []
+    for (place, lat, lon), label in labels:
         coordstr = "{:.4f}/{:.4f}".format(lat, lon)
         label = label or coordstr # fallback
+        ids.append(place)
+        names.append(label)
+
+        # Force encoding in case of pipe
+        if TRACE:
+            print coordstr, label.encode("utf-8")
+
+    db.engine.execute(text("""
+        UPDATE places p
+        SET label = n.label, label_coordinate = p.coordinate
+        FROM (
+            SELECT unnest(CAST(:ids AS integer[])) id,
+                unnest(CAST(:labels AS text[])) label) n
+        WHERE p.id = n.id"""),
+        ids=ids, labels=names)
+    job_metrics.count("places_labeled", len(labels))
+
+
+def seed_job_watermarks():
+    """Seed filter_device_data watermarks of databases predating them from
+    the data filtered so far. Left unchecked, so that each user is still
+    visited once."""
+    jw = db.metadata.tables["job_watermarks"]
+    if db.engine.execute(select(
+            [jw.c.job], jw.c.job == "filter_device_data").limit(1)).first():
+        return
+    rowcount = db.engine.execute(text("""
+        INSERT INTO job_watermarks (job, user_id, time)
+        SELECT 'filter_device_data', user_id, max(time)
+        FROM device_data_filtered
+        GROUP BY user_id""")).rowcount
+    print "seed_job_watermarks: %d filter_device_data watermarks" % rowcount
 
-        # Show progress due to rate limiting. Force encoding in case of pipe
-        print coordstr, label.encode("utf-8")
-
-        db.engine.execute(places.update(
-            places.c.id == p.id,
-            {"label": label, "label_coordinate": "POINT(%f %f)" % (lon, lat)}))
-
-        # Enforce configured API queries per second rate limit
-        time.sleep(1./qps)
 
-        if time.time() - t0 >= timeout:
-            break
+@job_metrics.timed
+def filter_device_data(maxtime=None):
+    """Filter new device data of users with device activity since their
+    previous run, continuing from the watermark of each."""
 
+    job = "filter_device_data"
+    jw = db.metadata.tables["job_watermarks"]
 
-def filter_device_data(maxtime=None):
+    # On the clock devices are touched with on ingest. Read before any data,
+    # so activity after it is left for the next run.
+    now = db.engine.execute(select([func.localtimestamp()])).scalar()
     if not maxtime:
-        maxtime = datetime.datetime.now()
+        maxtime = now
+    checked = min(now, maxtime)
 
     print "filter_device_data up to", maxtime
 
-    #TODO: Don't check for users that have been inactive for a long time.
-    user_ids =  db.engine.execute(text("SELECT id FROM users;"))
-    for id_row in user_ids:
-        time = get_max_time_from_table("time", "device_data_filtered", "user_id", id_row["id"])
+    seed_job_watermarks()
+
+    dirty = db.engine.execute(text("""
+        SELECT u.id, w.time
+        FROM users u
+        LEFT JOIN job_watermarks w ON w.job = :job AND w.user_id = u.id
+        WHERE w.checked IS NULL OR EXISTS (
+            SELECT 1 FROM devices d
+            WHERE d.user_id = u.id AND d.last_activity > w.checked)
+        ORDER BY u.id"""), job=job).fetchall()
+
+    for user_id, wm_time in dirty:
+        stored = wm_time is not None
+        if not stored:
+            wm_time = get_max_time_from_table(
+                "time", "device_data_filtered", "user_id", user_id)
         device_data_rows = data_points_by_user_id_after(
-            id_row["id"], time, maxtime)
+            user_id, wm_time, maxtime)
         device_data_filterer = DeviceDataFilterer()
         device_data_filterer.generate_filtered_data(
-            device_data_rows, id_row["id"])
+            device_data_rows, user_id)
+
+        values = {
+            "time": get_max_time_from_table(
+                "time", "device_data_filtered", "user_id", user_id),
+            "checked": checked}
+        if stored:
+            db.engine.execute(jw.update().values(values).where(and_(
+                jw.c.job == job, jw.c.user_id == user_id)))
+        else:
+            values.update(job=job, user_id=user_id)
+            db.engine.execute(jw.insert().values(values))
+
+    job_metrics.count("users_filtered", len(dirty))
+    print "filter_device_data: %d users with new activity" % len(dirty)
 
 
+@job_metrics.timed
 def generate_distance_data():
     user_ids =  db.engine.execute(text("SELECT id FROM users;"))
     last_midnight = datetime.datetime.now().replace(
@@ -481,6 +950,7 @@ def generate_distance_data():
         generate_rankings(row[0])
 
 
+@job_metrics.timed
 def generate_global_statistics():
     query = """
         SELECT COALESCE(
@@ -496,6 +966,7 @@ def generate_global_statistics():
     update_global_statistics(time_start, last_midnight)
 
 
+@job_metrics.timed
 def generate_trips():
     legs = db.metadata.tables["legs"]
     trips = db.metadata.tables["trips"]
@@ -511,173 +982,246 @@ def generate_trips():
         and_(legs.c.user_id.is_(None), legs.c.trip.isnot(None)))
     rowcount = db.engine.execute(trips.delete(or_(
         trips.c.id.in_(userless_od), trips.c.id.in_(userless_intra)))).rowcount
+    job_metrics.count("trips_deleted", rowcount)
     if rowcount:
         print "Deleted %d trips with userless legs" % rowcount
 
-    # Find tripless user moves
-    untripped = select([legs.c.user_id, legs.c.time_start]) \
-        .where(and_(
-            legs.c.user_id.isnot(None),
-            legs.c.activity.isnot(None),
-            legs.c.activity != "STILL",
-            legs.c.trip.is_(None))) \
-        .cte("untripped")
-
-    # Find nearest origin and destination longstops containing tripless. Doing
-    # this in one legs^3 join is ...slow... so do (legs^2)^2 instead
-    orig, dest = [
-        select([untripped.c.user_id,
-                untripped.c.time_start.label("move_start"),
-                aggregate(legs.c.time_start).label("time_start")]) \
-            .select_from(untripped.join(legs, and_(
-                beforeafter,
-                legs.c.user_id == untripped.c.user_id,
-                legs.c.activity == "STILL",
-                legs.c.time_end - legs.c.time_start >= TRIP_STOP_DURATION))) \
-            .group_by(untripped.c.user_id, untripped.c.time_start) \
-            .alias(alias)
-        for aggregate, beforeafter, alias
-        in [(func.max, legs.c.time_start < untripped.c.time_start, "orig"),
-            (func.min, legs.c.time_start > untripped.c.time_start, "dest")]]
-    tripends = select([orig.c.user_id, orig.c.time_start, dest.c.time_start]) \
-        .select_from(orig.join(dest, and_(
-            orig.c.user_id == dest.c.user_id,
-            orig.c.move_start == dest.c.move_start))) \
-        .distinct() \
-        .order_by(orig.c.user_id, orig.c.time_start)
-
-    for user, ostart, dstart in db.engine.execute(tripends):
-        with db.engine.begin() as t:
-            # Tripless legs may appear in the middle of an existing trip when
-            # user has multiple devices. Nuke trips that are in the way
-            overlap_orig = select([trips.c.id]) \
-                .select_from(trips.join(legs, and_(
-                    legs.c.user_id == user,
-                    legs.c.id == trips.c.origin,
-                    legs.c.time_start >= ostart,
-                    legs.c.time_start < dstart)))
-            overlap_dest = select([trips.c.id]) \
-                .select_from(trips.join(legs, and_(
-                    legs.c.user_id == user,
-                    legs.c.id == trips.c.destination,
-                    legs.c.time_start > ostart,
-                    legs.c.time_start <= dstart)))
-            overlap_intra = select([legs.c.trip]) \
-                .where(and_(
-                    legs.c.user_id == user,
-                    legs.c.time_start.between(ostart, dstart)))
-            dels = db.engine.execute(trips.delete(or_(
-                    trips.c.id.in_(overlap_orig),
-                    trips.c.id.in_(overlap_dest),
-                    trips.c.id.in_(overlap_intra))).returning(trips.c.id)) \
-                .fetchall()
-            if dels:
-                print "Deleted overlap trips %s" % " ".join(
-                    str(x[0]) for x in dels)
-
-            # Find and associate trip legs
-            sel = select([legs.c.id]) \
-                .where(and_(
-                    legs.c.user_id == user,
-                    legs.c.time_start.between(ostart, dstart))) \
-                .order_by(legs.c.time_start)
-            triplegs = [x[0] for x in t.execute(sel).fetchall()]
-            orig, intra, dest = triplegs[0], triplegs[1:-1], triplegs[-1]
-            ins = trips.insert() \
-                .values(origin=orig, destination=dest) \
-                .returning(trips.c.id)
-            trip = t.execute(ins).scalar()
-            upd = legs.update().values(trip=trip).where(legs.c.id.in_(intra))
-            t.execute(upd)
-            print "u"+str(user), "t"+str(trip), "ostart", str(ostart)[:16], \
-                "dstart", str(dstart)[:16], orig, intra, dest
-
+    # Each user with tripless moves is read from the nearest long stop before
+    # the earliest of them. Tripless moves before the first long stop of a
+    # user never make a trip, so are not looked at further.
+    starts = db.engine.execute(text("""
+        SELECT m.user_id, min(o.time_start)
+        FROM legs m
+        CROSS JOIN LATERAL (
+            SELECT s.time_start
+            FROM legs s
+            WHERE s.user_id = m.user_id
+                AND s.time_start < m.time_start
+                AND s.activity = 'STILL'
+                AND s.time_end - s.time_start >= CAST(:stop AS interval)
+            ORDER BY s.time_start DESC
+            LIMIT 1) o
+        WHERE m.trip IS NULL
+            AND m.user_id IS NOT NULL
+            AND m.activity != 'STILL'
+        GROUP BY m.user_id
+        ORDER BY m.user_id"""), stop=TRIP_STOP_DURATION).fetchall()
+
+    for user, start in starts:
+        with job_metrics.span("generate_trips.user", user):
+            with db.engine.begin() as t:
+                generate_user_trips(t, user, start)
+
+
+def generate_user_trips(t, user, start):
+    """Make trips of user's legs between consecutive long stops from start
+    on, where there are tripless moves in between."""
+
+    rows = t.execute(text("""
+        SELECT l.id, l.time_start, l.activity, l.trip,
+            l.activity = 'STILL'
+                AND l.time_end - l.time_start >= CAST(:stop AS interval),
+            o.id, d.id
+        FROM legs l
+        LEFT JOIN trips o ON o.origin = l.id
+        LEFT JOIN trips d ON d.destination = l.id
+        WHERE l.user_id = :user AND l.time_start >= :start
+        ORDER BY l.time_start"""),
+        user=user, start=start, stop=TRIP_STOP_DURATION).fetchall()
+
+    # Split at long stops into segments running from one to the next. Tripless
+    # legs may appear in the middle of an existing trip when user has multiple
+    # devices. Nuke trips that are in the way of a new one: those with origin
+    # in it before its end, destination in it after its start, or legs in it.
+    dels = set()
+    segments = []
+    segment = None
+    for leg in rows:
+        if segment is not None:
+            segment.append(leg)
+        if not leg[4]: # long stop
+            continue
+        if segment and any(
+                x[2] is not None and x[2] != "STILL" and x[3] is None
+                for x in segment[1:-1]):
+            dels.update(x[5] for x in segment[:-1])
+            dels.update(x[6] for x in segment[1:])
+            dels.update(x[3] for x in segment)
+            segments.append(segment)
+        segment = [leg]
+    dels.discard(None)
+
+    if dels:
+        dels = sorted(dels)
+        t.execute(text("DELETE FROM trips WHERE id = ANY(:ids)"), ids=dels)
+        job_metrics.count("trips_deleted", len(dels))
+        if TRACE:
+            print "Deleted overlap trips %s" % " ".join(str(x) for x in dels)
+
+    if not segments:
+        return
 
+    # Insert trips and associate their legs, a statement each for all
+    created = dict(t.execute(text("""
+        INSERT INTO trips (origin, destination)
+        SELECT unnest(CAST(:origins AS integer[])),
+            unnest(CAST(:destinations AS integer[]))
+        RETURNING origin, id"""),
+        origins=[x[0][0] for x in segments],
+        destinations=[x[-1][0] for x in segments]).fetchall())
+    job_metrics.count("trips_created", len(segments))
+
+    intra_ids = []
+    intra_trips = []
+    for segment in segments:
+        orig, intra, dest = \
+            segment[0][0], [x[0] for x in segment[1:-1]], segment[-1][0]
+        trip = created[orig]
+        intra_ids += intra
+        intra_trips += [trip] * len(intra)
+        if TRACE:
+            print "u"+str(user), "t"+str(trip), \
+                "ostart", str(segment[0][1])[:16], \
+                "dstart", str(segment[-1][1])[:16], \
+                orig, intra, dest
+
+    if intra_ids:
+        t.execute(text("""
+            UPDATE legs SET trip = n.trip
+            FROM (
+                SELECT unnest(CAST(:ids AS integer[])) id,
+                    unnest(CAST(:trips AS integer[])) trip) n
+            WHERE legs.id = n.id"""),
+            ids=intra_ids, trips=intra_trips)
+
+@job_metrics.timed
 def mass_transit_cleanup():
-    """Delete and vacuum mass transit live location data older than configured
-    interval, for example
+    """Create mass transit live location data partitions for the next few
+    days, and drop those older than configured interval, for example
         MASS_TRANSIT_LIVE_KEEP_DAYS = 7"""
 
+    today = create_mass_transit_partitions()
+
     # keep all data if nothing configured
     days = app.config.get("MASS_TRANSIT_LIVE_KEEP_DAYS")
     if not days:
         return
 
-    # Snap deletion to daystart; be noisy as these can take quite a long time.
-    # Also delete martians from the future, no use in preferring those forever.
-    log.info("Deleting mass_transit_data older than %d days...", days)
+    # Whole days are dropped, with no VACUUM needed to reclaim the space
+    keep = today - timedelta(days=days)
+    for day in mass_transit_data_partitions():
+        if day < keep:
+            mass_transit_data_drop_partition(day)
+            log.info("Dropped mass_transit_data partition of %s", day)
+
+    # Rows of days without partition stay in the parent, which only has
+    # martians from the future once partition_mass_transit_data has run. No
+    # use in preferring those forever.
     query = text("""
-        DELETE FROM mass_transit_data
+        DELETE FROM ONLY mass_transit_data
         WHERE time < date_trunc('day', now() - interval ':days days')
            OR time > date_trunc('day', now() + interval '2 days')""")
     delrows = db.engine.execute(query, days=days).rowcount
-    log.info("Deleted %d rows of mass_transit_data.", delrows)
-    if not delrows:
+    log.info("Deleted %d unpartitioned rows of mass_transit_data.", delrows)
+
+
+def create_mass_transit_partitions(ahead=2):
+    """Create mass_transit_data partitions from today to ahead days on.
+    Return today."""
+    today = datetime.date.today()
+    for days in range(ahead + 1):
+        day = today + timedelta(days=days)
+        if mass_transit_data_create_partition(day):
+            log.info("Created mass_transit_data partition of %s", day)
+    return today
+
+
+def partition_mass_transit_data(days=None):
+    """One-off online migration of mass_transit_data stored before it was
+    partitioned. Rows within MASS_TRANSIT_LIVE_KEEP_DAYS, or days if given,
+    are moved into partitions a day at a time, after which the parent is
+    truncated, releasing the space of older rows without a DELETE. Run by
+    hand on databases created before partitioning."""
+
+    days = days or app.config.get("MASS_TRANSIT_LIVE_KEEP_DAYS")
+    today = create_mass_transit_partitions() # new rows go there from now
+
+    tmin, tmax = db.engine.execute(
+        "SELECT min(time), max(time) FROM ONLY mass_transit_data").first()
+    if tmin is None:
+        print "partition_mass_transit_data: nothing to move"
         return
 
-    # vacuum to reuse space; cannot be wrapped in transaction, so another conn
-    log.info("Vacuuming and analyzing mass_transit_data...")
-    query = text("VACUUM ANALYZE mass_transit_data")
-    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
-    conn.execute(query)
-    conn.close()
-    log.info("Vacuuming and analyzing mass_transit_data complete.")
+    day = tmin.date()
+    if days:
+        day = max(day, today - timedelta(days=days))
+    total = 0
+    while day <= min(tmax.date(), today + timedelta(days=2)):
+        mass_transit_data_create_partition(day)
+        rowcount = mass_transit_data_move_day(day)
+        total += rowcount
+        print "partition_mass_transit_data %s: %d moved" % (day, rowcount)
+        day += timedelta(days=1)
+
+    # Left are rows past retention and martians, drop them all at once
+    db.engine.execute("TRUNCATE ONLY mass_transit_data")
+    print "partition_mass_transit_data moved %d rows" % total
 
-    # Note, to free space rather than mark for reuse, e.g. after configuring a
-    # lower retention limit, use VACUUM FULL. Not done automatically due to
-    # locking, additional temporary space usage, and potential OOM on reindex.
+
+# Latest RecordedAtTime stored per vehicle, of vehicles in the latest feed
+hsl_vehicles_stored = {}
 
 
 def retrieve_hsl_data():
-    url = "http://api.digitransit.fi/realtime/vehicle-positions/v1/siriaccess/vm/json"
-    response = urllib2.urlopen(url, timeout=50)
-    json_data = json.loads(response.read())
-    vehicle_data = json_data["Siri"]["ServiceDelivery"]["VehicleMonitoringDelivery"][0]["VehicleActivity"]
-
-    all_vehicles = []
-
-    def vehicle_row(vehicle):
-        timestamp = datetime.datetime.fromtimestamp(vehicle["RecordedAtTime"] / 1000) #datetime doesn't like millisecond accuracy
-        line_name, line_type = interpret_jore(vehicle["MonitoredVehicleJourney"]["LineRef"]["value"])
-        longitude = vehicle["MonitoredVehicleJourney"]["VehicleLocation"]["Longitude"]
-        latitude = vehicle["MonitoredVehicleJourney"]["VehicleLocation"]["Latitude"]
-        coordinate = 'POINT(%f %f)' % (longitude, latitude)
-        vehicle_ref = vehicle["MonitoredVehicleJourney"]["VehicleRef"]["value"]
-
-        return {
-            'coordinate': coordinate,
-            'line_name': line_name,
-            'line_type': line_type,
-            'time': timestamp,
-            'vehicle_ref': vehicle_ref
-        }
+    """Store new HSL vehicle positions. Records of a vehicle not newer
+    than the latest already stored are dropped before loading, and the
+    rest loaded with one COPY."""
+
+    global hsl_vehicles_stored
+
+    vehicle_data = hsl_vehicle_request()
+
+    rows = []
+    stored = {}
 
     for vehicle in vehicle_data:
         try:
-            all_vehicles.append(vehicle_row(vehicle))
+            journey = vehicle["MonitoredVehicleJourney"]
+            vehicle_ref = journey["VehicleRef"]["value"]
+            recorded = vehicle["RecordedAtTime"]
+            stored[vehicle_ref] = max(
+                recorded, stored.get(vehicle_ref, recorded))
+            if recorded <= hsl_vehicles_stored.get(vehicle_ref, -1):
+                continue
+            timestamp = datetime.datetime.fromtimestamp(recorded / 1000) #datetime doesn't like millisecond accuracy
+            line_name, line_type = interpret_jore(journey["LineRef"]["value"])
+            location = journey["VehicleLocation"]
+            rows.append((
+                ewkb_point(location["Longitude"], location["Latitude"]),
+                timestamp,
+                line_type,
+                line_name,
+                vehicle_ref))
         except Exception:
             log.exception("Failed to handle vehicle record: %s" % vehicle)
 
-    if all_vehicles:
-        db.engine.execute(mass_transit_data_table.insert(all_vehicles))
-    else:
+    if not vehicle_data:
         log.warning(
             "No mass transit data received at %s" % datetime.datetime.now())
+    if rows:
+        mass_transit_data_copy(rows)
+    hsl_vehicles_stored = stored
 
 
 def get_max_time_from_table(time_column_name, table_name, id_field_name, id):
     query = '''
         SELECT MAX({0}) as time
         FROM {1}
-        GROUP BY {2}
-        HAVING {2} = :id;
+        WHERE {2} = :id;
     '''.format(time_column_name, table_name, id_field_name)
-    time_row = db.engine.execute(text(query),
-                                 id = id).fetchone()
-    if time_row is None:
+    time = db.engine.execute(text(query), id = id).scalar()
+    if time is None:
         time = datetime.datetime.strptime("1971-01-01", '%Y-%m-%d')
-    else:
-        time = time_row["time"]
     return time
 
 
@@ -703,47 +1247,233 @@ def retrieve_weather_info():
     weather_observations_insert(fmi_observations_request())
 
 
+@job_metrics.timed
 def delete_device_data_duplicates():
-    rowcount = device_data_delete_duplicates()
+    """Delete duplicate device_data points of the last couple of days. Only
+    needed until dedupe_device_data has made the index unique, the
+    duplicate_ignore rule already keeps out points stored earlier."""
+    if device_data_unique_index_valid():
+        return
+    rowcount = device_data_delete_duplicates(
+        datetime.datetime.now() - timedelta(days=2))
+    job_metrics.count("duplicates_deleted", rowcount)
     print '%d duplicate device_data points were deleted' % rowcount
 
 
+def dedupe_device_data(days=1):
+    """One-off online removal of duplicate device_data points, a few days
+    at a time, after which the (device_id, time) index is made unique. Run
+    by hand on databases created before the index was."""
+
+    if device_data_unique_index_valid():
+        print "device_data already unique on (device_id, time)"
+        return
+
+    dd = db.metadata.tables["device_data"]
+    tmin, tmax = db.engine.execute(
+        select([func.min(dd.c.time), func.max(dd.c.time)])).first()
+    if tmin is None:
+        device_data_make_unique_index()
+        return
+
+    step = timedelta(days=days)
+    tstart = tmin
+    total = 0
+    while tstart <= tmax:
+        rowcount = device_data_delete_duplicates(tstart, tstart + step)
+        total += rowcount
+        print "dedupe_device_data %s: %d deleted" % (tstart.date(), rowcount)
+        tstart += step
+
+    # Duplicates could still race in with the rule in place, sweep the
+    # latest points again before indexing
+    device_data_delete_duplicates(tmax - step)
+    device_data_make_unique_index()
+    print "dedupe_device_data deleted %d duplicates, index unique" % total
+
+
+def month_start(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month(date):
+    return month_start(month_start(date) + timedelta(days=31))
+
+
+@job_metrics.timed
+def device_data_maintenance():
+    """Create device_data partitions of this and next month. Compact one
+    partition older than configured number of months per run, if set, for
+    example
+        DEVICE_DATA_COMPACT_AFTER_MONTHS = 3"""
+
+    this = month_start(datetime.date.today())
+    for month in [this, next_month(this)]:
+        if device_data_create_partition(month):
+            print "Created device_data partition of %s" % month
+
+    months = app.config.get("DEVICE_DATA_COMPACT_AFTER_MONTHS")
+    if not months:
+        return
+    cold = this
+    for _ in range(months):
+        cold = month_start(cold - timedelta(days=1))
+    for month in device_data_partitions():
+        if month < cold and device_data_compact_partition(month):
+            print "Compacted device_data partition of %s" % month
+            return
+
+
+def partition_device_data(days=1):
+    """One-off online migration of device_data stored before it was
+    partitioned. Partitions are created for all months with data, so new
+    points go there, and the stored points moved into them a few days at a
+    time. Run by hand on databases created before partitioning."""
+
+    device_data_maintenance()
+
+    tmin, tmax = db.engine.execute(
+        "SELECT min(time), max(time) FROM ONLY device_data").first()
+    if tmin is None:
+        print "partition_device_data: nothing to move"
+        return
+
+    # Points from the future beyond next month are left in the parent
+    last = next_month(next_month(datetime.date.today()))
+    month = month_start(tmin)
+    while month < last:
+        device_data_create_partition(month)
+        month = next_month(month)
+
+    step = timedelta(days=days)
+    tstart = datetime.datetime.combine(tmin.date(), datetime.time())
+    tlast = min(tmax, datetime.datetime.combine(last, datetime.time()))
+    total = 0
+    while tstart <= tlast:
+        # Steps end at month ends, each goes into one partition
+        tend = min(
+            tstart + step,
+            datetime.datetime.combine(next_month(tstart), datetime.time()))
+        rowcount = device_data_move_rows(tstart, tend)
+        total += rowcount
+        print "partition_device_data %s: %d moved" % (tstart, rowcount)
+        tstart = tend
+
+    # Release the space of the moved rows. Emptied and locked, so there's
+    # nothing to lose
+    with db.engine.begin() as t:
+        t.execute("LOCK TABLE ONLY device_data IN ACCESS EXCLUSIVE MODE")
+        if t.execute("SELECT 1 FROM ONLY device_data LIMIT 1").first():
+            print "partition_device_data: parent not empty, not truncated"
+        else:
+            t.execute("TRUNCATE ONLY device_data")
+    print "partition_device_data moved %d rows" % total
+
+
+# Roads and waypoints for in-process snapping, loaded on first use, and the
+# worker processes snapping with them
+road_index = None
+snapping_pool = None
+
+
+@job_metrics.timed
 def set_device_data_waypoints():
+    """Snap device data to waypoints, in SNAPPING_WORKERS processes if
+    configured, otherwise in the database, a limited number per run."""
     t = time.time()
-    rowcount = device_data_waypoint_snapping()
+    workers = app.config.get("SNAPPING_WORKERS", 0)
+    if workers:
+        rowcount = snap_device_data(workers)
+    else:
+        rowcount = device_data_waypoint_snapping()
+    job_metrics.count("points_snapped", rowcount)
     print "set_device_data_waypoints on %d points in %.2g seconds" % (
         rowcount, time.time() - t)
 
 
-def set_leg_waypoints():
-    t = time.time()
+def snap_device_data(workers, batch=50000):
+    """Snap all unsnapped device data with the in-process road index, batch
+    points per read and write."""
+
+    global road_index, snapping_pool
+    if road_index is None:
+        with job_metrics.span("snap_device_data.load"):
+            road_index = RoadIndex(
+                [(x[0], geojson_lines(x[1])) for x in snapping_roads()],
+                snapping_waypoints())
+        print "snap_device_data loaded %d road segments" % len(road_index)
+
+    if snapping_pool is None:
+        # The workers are forked from this threaded process, and would
+        # inherit the sockets of its pooled database connections. Close the
+        # idle ones first, so that no child holds a connection the parent
+        # goes on using; the workers never touch the database. The pool is
+        # kept for later runs, so this happens once.
+        db.engine.dispose()
+        snapping_pool = SnappingPool(road_index, workers)
+
+    total = 0
+    while True:
+        points = device_data_unsnapped(batch)
+        if not points:
+            break
+        with job_metrics.span("snap_device_data.snap"):
+            snapped = snapping_pool.snap(points)
+        with job_metrics.span("snap_device_data.write"):
+            rowcount = device_data_set_waypoints(snapped)
+        total += rowcount
+        if len(points) < batch or not rowcount:
+            break
+    return total
 
-    dd = db.metadata.tables["device_data"]
-    legs = db.metadata.tables["legs"]
-    glue = db.metadata.tables["leg_waypoints"]
-
-    legpoints = select(
-        [legs.c.id, dd.c.waypoint_id, dd.c.time, dd.c.snapping_time],
-        from_obj=dd.join(legs, and_(
-            dd.c.device_id == legs.c.device_id,
-            dd.c.time.between(legs.c.time_start, legs.c.time_end)))) \
-        .alias("legpoints")
-    done = select([glue.c.leg], distinct=True)
-    nounsnapped = select(
-        [legpoints.c.id],
-        legpoints.c.id.notin_(done),
-        group_by=legpoints.c.id,
-        having=func.bool_and(legpoints.c.snapping_time.isnot(None)))
-    newitems = select(
-        [legpoints.c.id, legpoints.c.waypoint_id, func.min(legpoints.c.time)],
-        legpoints.c.id.in_(nounsnapped),
-        group_by=[legpoints.c.id, legpoints.c.waypoint_id]).alias("newitems")
-
-    ins = glue.insert().from_select(["leg", "waypoint", "first"], newitems)
-    rowcount = db.engine.execute(ins).rowcount
-    print "set_leg_waypoints on %d rows in %.2g seconds" % (
-        rowcount, time.time() - t)
 
+@job_metrics.timed
+def set_leg_waypoints(batch=1000):
+    """Set leg_waypoints of queued legs whose points are all snapped, batch
+    legs per transaction."""
+
+    t0 = time.time()
+
+    # Legs still having unsnapped points stay queued for a later run
+    ready = [x[0] for x in db.engine.execute(text("""
+        SELECT q.leg
+        FROM leg_waypoints_queue q
+        JOIN legs l ON l.id = q.leg
+        WHERE NOT EXISTS (
+            SELECT 1 FROM device_data d
+            WHERE d.device_id = l.device_id
+                AND d.time BETWEEN l.time_start AND l.time_end
+                AND d.snapping_time IS NULL)
+        ORDER BY q.leg"""))]
+
+    rowcount = 0
+    for i in range(0, len(ready), batch):
+        chunk = ready[i:i+batch]
+        with db.engine.begin() as t:
+            # Waypoints of moved legs are set anew
+            t.execute(text(
+                "DELETE FROM leg_waypoints WHERE leg = ANY(:legs)"),
+                legs=chunk)
+            rowcount += t.execute(text("""
+                INSERT INTO leg_waypoints (leg, waypoint, first)
+                SELECT l.id, d.waypoint_id, min(d.time)
+                FROM legs l
+                JOIN device_data d
+                    ON d.device_id = l.device_id
+                    AND d.time BETWEEN l.time_start AND l.time_end
+                WHERE l.id = ANY(:legs)
+                GROUP BY l.id, d.waypoint_id"""),
+                legs=chunk).rowcount
+            t.execute(text(
+                "DELETE FROM leg_waypoints_queue WHERE leg = ANY(:legs)"),
+                legs=chunk)
+
+    seconds = time.time() - t0
+    job_metrics.count("legs_waypointed", len(ready))
+    job_metrics.count("leg_waypoints_inserted", rowcount)
+    print "set_leg_waypoints on %d legs, %d rows in %.2g seconds, " \
+        "%.0f rows/s" % (
+            len(ready), rowcount, seconds, rowcount / max(seconds, 1e-3))
 
 def main_loop():
     while 1:
@@ -4,7 +4,9 @@ WHERE id IN (
   FROM (
     SELECT id, row_number() OVER point AS row
     FROM device_data
-    WINDOW point AS (PARTITION BY device_id, time)
+    WHERE (CAST(:tstart AS timestamp) IS NULL OR time >= :tstart)
+      AND (CAST(:tend AS timestamp) IS NULL OR time < :tend)
+    WINDOW point AS (PARTITION BY device_id, time ORDER BY id)
   ) AS grouped_points
   WHERE row > 1
 );
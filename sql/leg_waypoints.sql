@@ -0,0 +1,21 @@
+-- Queue legs for scheduler.set_leg_waypoints when created, or when their
+-- device or time range changes so that their waypoints may have too.
+create or replace function legs_queue_waypoints() returns trigger as $$
+begin
+    if tg_op = 'UPDATE'
+            and new.device_id = old.device_id
+            and new.time_start = old.time_start
+            and new.time_end = old.time_end then
+        return null;
+    end if;
+    insert into leg_waypoints_queue (leg)
+        select new.id
+        where not exists (
+            select 1 from leg_waypoints_queue where leg = new.id);
+    return null;
+end;
+$$ language plpgsql volatile;
+drop trigger if exists legs_queue_waypoints_trigger on legs;
+create trigger legs_queue_waypoints_trigger
+after insert or update of device_id, time_start, time_end on legs
+for each row execute procedure legs_queue_waypoints();
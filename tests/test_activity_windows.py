@@ -0,0 +1,83 @@
+"""Checks of DeviceDataFilterer._analyse_activities against the Counter
+implementation it replaced.
+
+Tie-breaking rule: where activities have equal confidence sums in a window,
+the one listed earlier in activity_types ranks higher. The Counter version
+ordered them in the Counter's dict order instead, which depends on the
+string hashes and on which activities happened to enter the window first,
+so on equal sums the two can pick different activities. The reference is
+therefore checked with most_common ordered by the rule above, and with its
+own order only at points where no sums are equal.
+"""
+
+import unittest
+
+from pyfiles.constants import ACTIVITY_WIN
+from pyfiles.database_interface import activity_types
+from pyfiles.device_data_filterer import DeviceDataFilterer
+
+from tests.traces import activity_trace, counter_activities
+
+
+def ordered_most_common(counter):
+    """Counter items by descending sum, then in activity_types order."""
+    return sorted(
+        counter.items(),
+        key=lambda (activity, conf): (
+            -conf, activity_types.index(activity)
+            if activity in activity_types else len(activity_types)))
+
+
+def analyse(points):
+    return [a for p, a in DeviceDataFilterer()._analyse_activities(points)]
+
+
+class TestActivityWindows(unittest.TestCase):
+
+    TRACES = 200
+
+    def traces(self):
+        for seed in range(self.TRACES):
+            yield activity_trace(
+                10 + seed % 7 * 60, seed=seed, interval=5 + seed % 5 * 20)
+
+    def test_tie_rule(self):
+        for points in self.traces():
+            self.assertEqual(
+                analyse(points),
+                counter_activities(
+                    points, ACTIVITY_WIN / 2, ordered_most_common))
+
+    def test_untied_windows(self):
+        tied = total = 0
+
+        def most_common(counter):
+            # Remember if the sums in this window have any ties
+            most_common.tie = len(set(counter.values())) < len(counter)
+            return counter.most_common()
+
+        for points in self.traces():
+            new = analyse(points)
+            ties = []
+
+            def recording(counter):
+                items = most_common(counter)
+                ties.append(most_common.tie)
+                return items
+
+            old = counter_activities(points, ACTIVITY_WIN / 2, recording)
+            for a, b, tie in zip(new, old, ties):
+                total += 1
+                if tie:
+                    tied += 1
+                else:
+                    self.assertEqual(a, b)
+        # Both kinds of window must have come up
+        self.assertTrue(0 < tied < total)
+
+    def test_empty(self):
+        self.assertEqual(analyse([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Checks of common_helpers.do_cluster against the rescanning version it
+replaced, in both the exhaustive and the grid cell neighbor search. Random
+float coordinates keep distances from tying, where the two break ties
+differently."""
+
+import random
+import unittest
+from math import floor, hypot
+
+from pyfiles.common_helpers import do_cluster
+
+from tests.traces import rescan_cluster
+
+
+def dist(a, b):
+    return hypot(a["x"] - b["x"], a["y"] - b["y"])
+
+
+def merge(a, b):
+    n = a["n"] + b["n"]
+    return {
+        "x": (a["x"] * a["n"] + b["x"] * b["n"]) / n,
+        "y": (a["y"] * a["n"] + b["y"] * b["n"]) / n,
+        "n": n}
+
+
+def points(rnd, n):
+    return [{"x": rnd.random(), "y": rnd.random(), "n": 1} for i in range(n)]
+
+
+def canonical(clusters):
+    return sorted((c["n"], c["x"], c["y"]) for c in clusters)
+
+
+class TestDoCluster(unittest.TestCase):
+
+    def check(self, grid):
+        for seed in range(100):
+            rnd = random.Random(seed)
+            items = points(rnd, rnd.randint(0, 150))
+            distlim = rnd.choice([0.01, 0.05, 0.2, 2])
+            cellfun = None
+            if grid:
+                def cellfun(d):
+                    return int(floor(d["x"] / distlim)), \
+                        int(floor(d["y"] / distlim))
+            new = do_cluster(items, merge, dist, distlim, cellfun)
+            old = rescan_cluster(items, merge, dist, distlim)
+            self.assertEqual(canonical(new), canonical(old), seed)
+
+    def test_same_as_rescan(self):
+        self.check(grid=False)
+
+    def test_same_as_rescan_with_grid(self):
+        self.check(grid=True)
+
+    def test_all_merged(self):
+        rnd = random.Random(0)
+        clusters = do_cluster(points(rnd, 50), merge, dist, 2)
+        self.assertEqual([c["n"] for c in clusters], [50])
+
+
+if __name__ == "__main__":
+    unittest.main()
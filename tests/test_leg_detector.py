@@ -0,0 +1,90 @@
+"""Checks that LegDetector, fed a trace in chunks with its state serialized
+and restored between them, finds the segments of the generator pipeline run
+over the whole trace at once."""
+
+import random
+import unittest
+from datetime import timedelta
+
+from pyfiles.common_helpers import (
+    trace_discard_sidesteps, trace_partition_movement, trace_points)
+from pyfiles.constants import (
+    BAD_LOCATION_RADIUS, DEST_DURATION_MIN, DEST_RADIUS_MAX)
+from pyfiles.leg_detector import LegDetector
+
+from tests.traces import device_rows
+
+# Shorter than STOP_BREAK_INTERVAL, to split at the gaps of gappy_trace
+BREAK_INTERVAL = 3600
+
+ARGS = (BAD_LOCATION_RADIUS, DEST_RADIUS_MAX, DEST_DURATION_MIN, BREAK_INTERVAL)
+
+
+def gappy_trace(n, seed):
+    """TracePoints of device_rows with a few gaps of hours."""
+    rnd = random.Random(seed)
+    rows = device_rows(n, seed)
+    shift = timedelta()
+    for row in rows:
+        if rnd.random() < 0.005:
+            shift += timedelta(hours=rnd.choice([0.5, 2, 30]))
+        row["time"] += shift
+    return trace_points(rows)
+
+
+def segments(pairs):
+    """(moving, point times) of the first segment of each pair."""
+    return [(mov, [p["time"] for p in seg]) for (mov, seg), _ in pairs]
+
+
+def one_shot(points):
+    """Segment pairs of the generator pipeline generate_device_legs used."""
+    partitioned = [
+        (mov, seg) for mov, seg in trace_partition_movement(
+            trace_discard_sidesteps(points, BAD_LOCATION_RADIUS),
+            DEST_RADIUS_MAX, DEST_DURATION_MIN, BREAK_INTERVAL)
+        if mov is not None]
+    return zip(partitioned, partitioned[1:] + [(None, None)])
+
+
+def chunked(points, cuts):
+    """Segment pairs of LegDetector fed points split at cuts, restored from
+    its serialized state before each chunk."""
+    pairs = []
+    detector = LegDetector(*ARGS)
+    for a, b in zip([0] + cuts, cuts + [len(points)]):
+        detector = LegDetector.loads(detector.dumps(), *ARGS)
+        pairs += detector.push(points[a:b])
+    return pairs + list(detector.finish())
+
+
+class TestLegDetector(unittest.TestCase):
+
+    TRACES = 60
+
+    def test_chunks_match_one_shot(self):
+        moving = still = 0
+        for seed in range(self.TRACES):
+            rnd = random.Random(seed)
+            points = gappy_trace(rnd.randint(0, 2000), seed)
+            cuts = sorted(rnd.sample(
+                range(1, len(points) or 1), min(len(points) // 50, 20)))
+            expected = segments(one_shot(points))
+            self.assertEqual(segments(chunked(points, cuts)), expected)
+            moving += sum(1 for mov, seg in expected if mov)
+            still += sum(1 for mov, seg in expected if not mov)
+        # Both kinds of segment must have come up
+        self.assertTrue(moving and still)
+
+    def test_point_at_a_time(self):
+        points = gappy_trace(600, 1)
+        self.assertEqual(
+            segments(chunked(points, range(1, len(points)))),
+            segments(one_shot(points)))
+
+    def test_empty(self):
+        self.assertEqual(chunked([], []), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
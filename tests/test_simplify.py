@@ -0,0 +1,42 @@
+"""Checks of common_helpers.simplify against the re-heapifying version it
+replaced. Where metrics are equal the old version removed points in an
+arbitrary order, the new one in input order, so the comparison uses metrics
+that are never equal."""
+
+import random
+import unittest
+
+from pyfiles.common_helpers import simplify
+
+from tests.traces import heapify_simplify
+
+
+def offset(a, b, c):
+    """Offset of b from the midpoint of a and c."""
+    return abs(b - (a + c) / 2)
+
+
+class TestSimplify(unittest.TestCase):
+
+    def test_same_as_heapify(self):
+        rnd = random.Random(0)
+        for case in range(200):
+            values = [rnd.random() for i in range(rnd.randint(0, 300))]
+            maxpts = rnd.choice([None, 2, 3, 10, 50])
+            minmetric = rnd.choice([None, 0.01, 0.1])
+            self.assertEqual(
+                simplify(values, offset, maxpts, minmetric),
+                heapify_simplify(values, offset, maxpts, minmetric))
+
+    def test_ties_in_input_order(self):
+        self.assertEqual(
+            simplify(range(10), lambda a, b, c: 0, maxpts=5),
+            [0, 6, 7, 8, 9])
+
+    def test_endpoints_kept(self):
+        self.assertEqual(simplify([1, 2, 3], offset, maxpts=1), [1, 3])
+        self.assertEqual(simplify([1, 2], offset, maxpts=1), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
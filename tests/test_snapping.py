@@ -0,0 +1,45 @@
+"""Checks of RoadIndex.snap against measuring every point against every road
+segment. Random coordinates keep distances to two roads from being equal,
+where either could be chosen."""
+
+import unittest
+
+from pyfiles.snapping import RoadIndex, SnappingPool
+
+from tests.traces import brute_force_snap, road_network, road_points
+
+
+class TestRoadIndex(unittest.TestCase):
+
+    def test_same_as_brute_force(self):
+        for seed in range(3):
+            roads, waypoints = road_network(100, seed, width=0.05)
+            points = road_points(roads, 300, seed)
+            snapped = RoadIndex(roads, waypoints).snap(
+                [p[1] for p in points], [p[2] for p in points])
+            expected = [
+                brute_force_snap(roads, waypoints, lon, lat)
+                for i, lon, lat in points]
+            self.assertEqual(snapped, expected)
+            # Both snapped and unsnapped points, also for lack of waypoints
+            self.assertIn(None, snapped)
+            self.assertGreater(len(set(snapped)), 100)
+
+    def test_no_roads(self):
+        self.assertEqual(RoadIndex([], []).snap([24.9], [60.2]), [None])
+
+    def test_pool_in_process(self):
+        roads, waypoints = road_network(20)
+        points = road_points(roads, 50)
+        index = RoadIndex(roads, waypoints)
+        pool = SnappingPool(index, 1, batch=7)
+        try:
+            self.assertEqual(pool.snap(points), zip(
+                [p[0] for p in points],
+                index.snap([p[1] for p in points], [p[2] for p in points])))
+        finally:
+            pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
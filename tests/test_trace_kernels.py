@@ -0,0 +1,66 @@
+"""Checks that the trace_kernels filters keep exactly the points kept by the
+generator versions in common_helpers."""
+
+import unittest
+
+from pyfiles import common_helpers, trace_kernels
+
+from tests.traces import location_trace
+
+
+def ids(points):
+    return [p["id"] for p in points]
+
+
+class TestTraceKernels(unittest.TestCase):
+
+    TRACES = 200
+
+    def traces(self):
+        for seed in range(self.TRACES):
+            yield location_trace(seed % 10 * 40, seed=seed)
+
+    def check(self, name, *args, **kwargs):
+        kept = dropped = 0
+        for points in self.traces():
+            old = ids(getattr(common_helpers, name)(
+                iter(points), *args, **kwargs))
+            new = ids(getattr(trace_kernels, name)(points, *args, **kwargs))
+            self.assertEqual(new, old)
+            kept += len(new)
+            dropped += len(points) - len(new)
+        # The traces must exercise the filter both ways
+        self.assertTrue(kept and dropped)
+
+    def test_inaccurate(self):
+        self.check("trace_discard_inaccurate", 50)
+
+    def test_unmoved(self):
+        self.check("trace_discard_unmoved")
+
+    def test_unmoved_radius(self):
+        self.check("trace_discard_unmoved", 30)
+
+    def test_single_sidesteps(self):
+        self.check("trace_discard_single_sidesteps")
+
+    def test_single_sidesteps_factor(self):
+        self.check("trace_discard_single_sidesteps", factor=3)
+
+    def test_sidesteps(self):
+        self.check("trace_discard_sidesteps")
+
+    def test_sidesteps_badradius(self):
+        self.check("trace_discard_sidesteps", badradius=100, factor=1.5)
+
+    def test_mask(self):
+        points = location_trace(500, seed=1)
+        mask = trace_kernels.discard_sidesteps_mask(
+            *trace_kernels.trace_arrays(points))
+        self.assertEqual(
+            [p["id"] for p, keep in zip(points, mask) if keep],
+            ids(common_helpers.trace_discard_sidesteps(points)))
+
+
+if __name__ == "__main__":
+    unittest.main()
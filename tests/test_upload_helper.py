@@ -0,0 +1,221 @@
+"""Tests of /data upload decoding. Run from the repository root with
+
+    python -m unittest discover -s tests -t .
+"""
+
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import unittest
+import zlib
+from StringIO import StringIO
+
+from pyfiles.upload_helper import (
+    BINARY_POINTS_MAGIC, COLUMN_CHUNK, DecompressingReader, UploadError,
+    iter_binary_records, iter_data_points, json_point_record)
+
+POINT = {
+    "time": 1500000000000,
+    "location": {"longitude": 24.9384, "latitude": 60.1699, "accuracy": 10.0},
+    "activityData": {"activities": [
+        {"activityType": "ON_FOOT", "confidence": 60},
+        {"activityType": "STILL", "confidence": 30}]}}
+
+
+class GeneratedBody(object):
+    """File-like upload body of a points JSON object with n points, made up
+    as it is read, optionally gzip compressed, never held whole."""
+
+    def __init__(self, n, gzip=False):
+        self.parts = self._parts(n)
+        self.compress = gzip and zlib.compressobj(6, zlib.DEFLATED, 16 + 15)
+        self.buf = ""
+
+    def _parts(self, n):
+        yield '{"dataPoints": ['
+        for i in xrange(n):
+            point = dict(POINT, time=POINT["time"] + 1000 * i)
+            yield (i and ", " or "") + json.dumps(point)
+        yield ']}'
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            part = next(self.parts, None)
+            if part is None:
+                if self.compress:
+                    self.buf += self.compress.flush()
+                    self.compress = None
+                break
+            self.buf += self.compress.compress(part) if self.compress else part
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+N = 200000
+
+
+def stream_points(gzip):
+    """Decode a generated N point upload, print the number of points, the
+    last record and the growth of peak memory in MB as JSON."""
+    stream = GeneratedBody(N, gzip)
+    if gzip:
+        stream = DecompressingReader(stream, "gzip")
+    before = maxrss_mb()
+    n = 0
+    for point in iter_data_points(stream):
+        record = json_point_record(point)
+        n += 1
+    print json.dumps([n, record, maxrss_mb() - before])
+
+
+class TestDataPointStream(unittest.TestCase):
+
+    # Decoding the whole 200k point body at once takes several hundred MB
+    MAX_GROWTH_MB = 50
+
+    def check(self, gzip):
+        # Peak memory is per process, so each case gets a fresh one
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "from tests.test_upload_helper import stream_points; "
+            "stream_points(%r)" % gzip], cwd=root)
+        n, record, growth = json.loads(output.splitlines()[-1])
+        self.assertEqual(n, N)
+        self.assertEqual(record[:4], [
+            24.9384, 60.1699, 10.0, POINT["time"] + 1000 * (N - 1)])
+        self.assertEqual(
+            record[4:], ["ON_FOOT", 60, "STILL", 30, "UNKNOWN", 0])
+        self.assertLess(growth, self.MAX_GROWTH_MB)
+
+    def test_plain_memory_flat(self):
+        self.check(False)
+
+    def test_gzip_memory_flat(self):
+        self.check(True)
+
+
+def binary_body(records, n=None):
+    """Binary upload of point records, activity types None encoded as the
+    255 slot. n overrides the point count in the header."""
+    names = sorted(set(
+        x for r in records for x in r[4::2] if x is not None))
+    index = dict((x, i) for i, x in enumerate(names))
+    slots = [[index.get(r[4 + 2 * j], 255) for r in records]
+             for j in range(3)]
+    confs = [[r[5 + 2 * j] or 0 for r in records] for j in range(3)]
+    m = len(records)
+    return "".join(
+        [BINARY_POINTS_MAGIC,
+         struct.pack("<IB", len(records) if n is None else n, len(names))]
+        + [struct.pack("<B", len(x)) + x for x in names]
+        + [struct.pack("<%dq" % m, *[r[3] for r in records]),
+           struct.pack("<%dd" % m, *[r[0] for r in records]),
+           struct.pack("<%dd" % m, *[r[1] for r in records]),
+           struct.pack("<%df" % m, *[r[2] for r in records])]
+        + [struct.pack("<%dB" % m, *x) for x in slots]
+        + [struct.pack("<%dB" % m, *x) for x in confs])
+
+
+def gzipped(data):
+    compress = zlib.compressobj(6, zlib.DEFLATED, 16 + 15)
+    return compress.compress(data) + compress.flush()
+
+
+class CountingStream(object):
+    """File-like wrapper counting the bytes read from it."""
+
+    def __init__(self, data):
+        self.stream = StringIO(data)
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+def decode(body, max_points=10**6):
+    return list(iter_binary_records(StringIO(body), max_points))
+
+
+class TestBinaryRecords(unittest.TestCase):
+
+    RECORDS = [
+        (24.9384, 60.1699, 10.0, POINT["time"],
+         "IN_VEHICLE", 80, "ON_FOOT", 15, "STILL", 5),
+        (24.9385, 60.1698, 12.5, POINT["time"] + 1000,
+         None, None, None, None, None, None),
+        (-0.5, -45.25, 0.0, POINT["time"] + 2000,
+         "WALKING", 100, "UNKNOWN", 0, "UNKNOWN", 0)]
+
+    def test_round_trip(self):
+        self.assertEqual(decode(binary_body(self.RECORDS)), self.RECORDS)
+
+    def test_round_trip_gzip(self):
+        # More points than one column chunk, to cross chunk boundaries
+        records = [
+            r[:3] + (r[3] + 3000 * i,) + r[4:]
+            for i in xrange(COLUMN_CHUNK) for r in self.RECORDS]
+        stream = DecompressingReader(
+            StringIO(gzipped(binary_body(records))), "gzip")
+        self.assertEqual(list(iter_binary_records(stream, 10**6)), records)
+
+    def test_none_slot_and_unknown_types(self):
+        body = binary_body([
+            (0.0, 0.0, 1.0, 0, "TELEPORTING", 90, "WALKING", 70, None, 0),
+            (0.0, 0.0, 1.0, 1, "TELEPORTING", 90, None, 0, None, 0),
+            (0.0, 0.0, 1.0, 2, None, 0, "STILL", 40, None, 0)])
+        self.assertEqual(decode(body), [
+            (0.0, 0.0, 1.0, 0, "WALKING", 70, "UNKNOWN", 0, "UNKNOWN", 0),
+            (0.0, 0.0, 1.0, 1, None, None, None, None, None, None),
+            (0.0, 0.0, 1.0, 2, "STILL", 40, "UNKNOWN", 0, "UNKNOWN", 0)])
+
+    def test_bad_magic(self):
+        with self.assertRaises(UploadError):
+            decode("RRP0" + binary_body(self.RECORDS)[4:])
+
+    def test_truncated(self):
+        body = binary_body(self.RECORDS)
+        for size in range(len(body)):
+            with self.assertRaises(UploadError):
+                decode(body[:size])
+        with self.assertRaises(UploadError):
+            list(iter_binary_records(DecompressingReader(
+                StringIO(gzipped(body)[:-20]), "gzip"), 10**6))
+
+    def test_too_many_points_not_inflated(self):
+        # Header claiming 2**32-1 points followed by 256 MB of zeros
+        compress = zlib.compressobj(6, zlib.DEFLATED, 16 + 15)
+        parts = [compress.compress(BINARY_POINTS_MAGIC
+                                   + struct.pack("<IB", 2**32 - 1, 0))]
+        zeros = "\0" * 2**20
+        parts += [compress.compress(zeros) for i in xrange(256)]
+        body = "".join(parts) + compress.flush()
+        stream = CountingStream(body)
+        reader = DecompressingReader(stream, "gzip")
+        with self.assertRaisesRegexp(UploadError, "Too many points"):
+            list(iter_binary_records(reader, 10**6))
+        self.assertLessEqual(stream.count, reader.chunk_size)
+        self.assertLess(stream.count, len(body))
+        self.assertLess(len(reader.buf), 2**20)
+
+    def test_corrupt_gzip(self):
+        # Gzip header, then a deflate block of the reserved type
+        body = gzipped(binary_body(self.RECORDS))[:10] + "\xff" * 100
+        with self.assertRaisesRegexp(UploadError, "Malformed"):
+            list(iter_binary_records(
+                DecompressingReader(StringIO(body), "gzip"), 10**6))
+
+
+if __name__ == "__main__":
+    unittest.main()
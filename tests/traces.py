@@ -0,0 +1,304 @@
+"""Random traces and the reference implementations the array versions are
+checked and benchmarked against."""
+
+import json
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
+from math import cos, pi
+
+from pyfiles.database_interface import activity_types
+from pyfiles.snapping import LAT_METERS, LON_METERS, MAX_DISTANCE
+
+START = datetime(2017, 5, 1, 7)
+
+
+def activity_trace(n, seed=0, interval=30, start=START):
+    """n points with activity_1..3 and confidences as in device_data, on
+    average interval seconds apart. Confidences are multiples of five, so
+    equal window sums are common."""
+    rnd = random.Random(seed)
+    points = []
+    time = start
+    for i in xrange(n):
+        time += timedelta(seconds=rnd.expovariate(1.0 / interval))
+        types = rnd.sample(activity_types, 3)
+        confs = sorted((5 * rnd.randint(0, 20) for t in types), reverse=True)
+        point = {"time": time}
+        for j, slot in enumerate(("activity_1", "activity_2", "activity_3")):
+            missing = j and rnd.random() < 0.2
+            point[slot] = None if missing else types[j]
+            point[slot + "_conf"] = None if missing else confs[j]
+        points.append(point)
+    return points
+
+
+def location_trace(n, seed=0, start=START):
+    """n points with geojson, accuracy, activity and time as from
+    trace_points, walking and riding around Helsinki with stops, noise and
+    bogus jumps to the side and back, both single and repeated."""
+    rnd = random.Random(seed)
+    points = []
+    lon, lat = 24.94, 60.17
+    time = start
+    speed = 0
+    side = None
+    for i in xrange(n):
+        time += timedelta(seconds=rnd.randint(1, 60))
+        if rnd.random() < 0.1:
+            speed = rnd.choice([0, 0, 1.5, 5, 15]) / 111000.0
+        lon += rnd.gauss(0, speed * 10) + rnd.gauss(0, 2e-5)
+        lat += rnd.gauss(0, speed * 5) + rnd.gauss(0, 1e-5)
+        if side is None and rnd.random() < 0.05:
+            side = (
+                lon + rnd.gauss(0, 0.01), lat + rnd.gauss(0, 0.005),
+                rnd.choice([1, 1, 2, 4]))
+        if side is not None:
+            slon, slat, left = side
+            coords = [slon + rnd.gauss(0, 1e-6), slat + rnd.gauss(0, 1e-6)]
+            side = left > 1 and (slon, slat, left - 1) or None
+        else:
+            coords = [lon, lat]
+        points.append({
+            "id": i,
+            "activity": speed > 3 / 111000.0 and "IN_VEHICLE" or "WALKING",
+            "geojson": json.dumps({"type": "Point", "coordinates": coords}),
+            "accuracy": rnd.choice([3, 5, 10, 20, 50, 100, 500]),
+            "time": time})
+    return points
+
+
+def device_rows(n, seed=0, geojson=False):
+    """n device_data rows of location_trace with the activities of
+    activity_trace, the first also as activity, and coordinates in lon and
+    lat as coordinate_lonlat selects them, or if geojson, in geojson as
+    ST_AsGeoJSON did."""
+    rows = []
+    for loc, act in zip(
+            location_trace(n, seed), activity_trace(n, seed, interval=1)):
+        row = dict(
+            act, time=loc["time"], accuracy=loc["accuracy"],
+            activity=act["activity_1"])
+        if geojson:
+            row["geojson"] = loc["geojson"]
+        else:
+            row["lon"], row["lat"] = json.loads(loc["geojson"])["coordinates"]
+        rows.append(row)
+    return rows
+
+
+def counter_activities(points, halfwin, most_common=Counter.most_common):
+    """The Counter implementation DeviceDataFilterer._analyse_activities
+    replaced, as a list of activities. most_common orders (activity, sum)
+    items of a Counter; the default orders equal sums in dict order."""
+
+    def activities(point):
+        return {
+            point["activity_1"]: point["activity_1_conf"] or 0,
+            point["activity_2"]: point["activity_2_conf"] or 0,
+            point["activity_3"]: point["activity_3_conf"] or 0}
+
+    def dseconds(p0, p1):
+        return (p1["time"] - p0["time"]).total_seconds()
+
+    good_activities = ('IN_VEHICLE', 'ON_BICYCLE', 'RUNNING', 'WALKING')
+    on_foot_activities = ('RUNNING', 'WALKING')
+
+    def best_activity(activities):
+        on_foot = False
+        for activity, cconf in most_common(activities):
+            if activity == "ON_FOOT":
+                on_foot = True
+            elif on_foot and activity not in on_foot_activities:
+                pass
+            elif activity in good_activities:
+                return activity
+        if on_foot:
+            return "WALKING"
+        return "NOT_SET"
+
+    result = []
+    probs = Counter()
+    head = tail = 0
+    np = len(points)
+    for i in range(np):
+        while head < np and dseconds(points[i], points[head]) < halfwin:
+            probs.update(activities(points[head]))
+            head += 1
+        while tail < np and dseconds(points[tail], points[i]) > halfwin:
+            probs.subtract(activities(points[tail]))
+            tail += 1
+        result.append(best_activity(probs))
+    return result
+
+
+def heapify_simplify(points, metric, maxpts=None, minmetric=None):
+    """common_helpers.simplify as it was before it used a lazily invalidated
+    heap, re-heapifying after every removal."""
+
+    class Dll:
+        def __init__(self, value, before=None, after=None):
+            self.value = value
+            self.before = before
+            self.after = after
+        def unlink(self):
+            if self.before:
+                self.before.after = self.after
+            if self.after:
+                self.after.before = self.before
+
+    def node_metric(node):
+        return metric(node.before.value, node.value, node.after.value)
+
+    linked = [Dll(x) for x in points]
+    for i in range(1, len(linked)):
+        linked[i].before = linked[i-1]
+    for i in range(len(linked) - 1):
+        linked[i].after = linked[i+1]
+
+    heap = [[node_metric(node), node] for node in linked[1:-1]]
+    for node, heap_entry in zip(linked[1:-1], heap):
+        node.heap_entry = heap_entry
+    heapify(heap)
+
+    while heap:
+        m, node = heappop(heap)
+        # 3 == the endpoints not in heap, plus the one item popped above
+        if ((not maxpts or len(heap) <= maxpts - 3)
+                and (not minmetric or m > minmetric)):
+            break
+        node.unlink()
+        for neighbor in node.before, node.after:
+            if hasattr(neighbor, "heap_entry"):
+                neighbor.heap_entry[0] = node_metric(neighbor)
+        heapify(heap)
+
+    node = linked[0]
+    rv = []
+    while node:
+        rv.append(node.value)
+        node = node.after
+    return rv
+
+
+def rescan_cluster(items, mergefun, distfun, distlim):
+    """common_helpers.do_cluster as it was before it indexed neighbors,
+    rescanning and re-heapifying every cluster after each merge."""
+
+    def heapitem(d0, dests):
+        """Find nearest neighbor for d0 as sortable [distance, nearest, d0]"""
+        return (min([distfun(d0, d1),
+                     d1] for d1 in dests if d1 is not d0)
+                  + [d0])
+
+    heap = [[None, None, d] for d in items]
+    d0 = d1 = merged = None
+    while len(heap) > 1:
+        for item in heap:
+            # rescan nearest where nearest was merged away, or not yet set
+            if item[1] in (None, d0, d1):
+                item[:] = heapitem(item[2], (x[2] for x in heap))
+                continue
+
+            # update others where merged now nearest
+            if item[2] is not merged:
+                distance = distfun(item[2], merged)
+                if item[0] > distance:
+                    item[0:2] = distance, merged
+
+        # arrange heap, pop out one end of shortest edge
+        heapify(heap)
+        distance, d1, d0 = item = heappop(heap)
+
+        # if shortest edge is long enough, unpop and stop
+        if distance is None or distance > distlim:
+            heappush(heap, item) # unspill the milk
+            break
+
+        # replace other end with merged destination
+        merged = mergefun(d0, d1)
+        for i in range(len(heap)):
+            if heap[i][2] is d1:
+                heap[i] = [None, None, merged]
+                break
+
+    return [x[2] for x in heap]
+
+
+def road_network(n, seed=0, width=0.2):
+    """n roads of random walks around Helsinki within about width degrees
+    of longitude, as (road id, lines) with one or two lines per road, and
+    their vertices as waypoints (road id, waypoint id, lon, lat), except
+    for every tenth road, which has none."""
+    rnd = random.Random(seed)
+    roads = []
+    waypoints = []
+    for road in xrange(n):
+        lines = []
+        for part in range(rnd.choice([1, 1, 2])):
+            lon = 24.94 + rnd.uniform(-width / 2, width / 2)
+            lat = 60.17 + rnd.uniform(-width / 4, width / 4)
+            line = [[lon, lat]]
+            for i in range(rnd.randint(1, 8)):
+                lon += rnd.gauss(0, 0.002)
+                lat += rnd.gauss(0, 0.001)
+                line.append([lon, lat])
+            lines.append(line)
+        roads.append((road, lines))
+        if road % 10:
+            waypoints.extend(
+                (road, len(waypoints), lon, lat)
+                for line in lines for lon, lat in line)
+    return roads, waypoints
+
+
+def road_points(roads, n, seed=0):
+    """n (id, lon, lat) points, most within a few hundred meters of a road
+    vertex, the rest anywhere around the roads."""
+    rnd = random.Random(seed)
+    vertices = [v for road, lines in roads for line in lines for v in line]
+    lon0, lon1 = min(v[0] for v in vertices), max(v[0] for v in vertices)
+    lat0, lat1 = min(v[1] for v in vertices), max(v[1] for v in vertices)
+    points = []
+    for i in xrange(n):
+        if rnd.random() < 0.8:
+            lon, lat = rnd.choice(vertices)
+            lon += rnd.gauss(0, 0.002)
+            lat += rnd.gauss(0, 0.001)
+        else:
+            lon = rnd.uniform(lon0, lon1)
+            lat = rnd.uniform(lat0, lat1)
+        points.append((i, lon, lat))
+    return points
+
+
+def brute_force_snap(roads, waypoints, lon, lat):
+    """RoadIndex.snap of a single point measured against every segment of
+    every road and every waypoint of the nearest road."""
+    xscale = LON_METERS * cos(lat / 180 * pi)
+    best = None
+    for road, lines in roads:
+        for line in lines:
+            for (x1, y1), (x2, y2) in zip(line, line[1:]):
+                ax = (x1 - lon) * xscale
+                ay = (y1 - lat) * LAT_METERS
+                dx = (x2 - lon) * xscale - ax
+                dy = (y2 - lat) * LAT_METERS - ay
+                dd = dx * dx + dy * dy
+                t = min(max(-(ax * dx + ay * dy) / (dd or 1), 0), 1)
+                px = ax + t * dx
+                py = ay + t * dy
+                if best is None or px * px + py * py < best[0]:
+                    best = px * px + py * py, road
+    if best is None or best[0] > MAX_DISTANCE**2:
+        return None
+    nearest = None
+    for road, waypoint, wlon, wlat in waypoints:
+        if road != best[1]:
+            continue
+        x = (wlon - lon) * xscale
+        y = (wlat - lat) * LAT_METERS
+        if nearest is None or x * x + y * y < nearest[0]:
+            nearest = x * x + y * y, waypoint
+    return nearest and nearest[1]